@@ -0,0 +1,397 @@
+import sys
+import os
+import argparse
+import logging
+import json
+import time
+import resource
+import tracemalloc
+from argparse import Namespace
+from collections import OrderedDict
+import numpy as np
+import openslide
+from scipy import ndimage
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from benchmarks.synthetic_slides import generate_slides
+
+
+# python3 run_benchmarks.py ../../benchmarks --size=8192 --baseline=./baseline.json
+# python3 run_benchmarks.py ../../benchmarks --size=8192 --baseline=./baseline.json --save_baseline
+
+parser = argparse.ArgumentParser(description='Time the hot paths of the pipeline on synthetic'
+                                 ' slides with stand-in models, report throughput and memory and'
+                                 ' flag regressions against a stored baseline')
+parser.add_argument('work_dir', default=None, metavar='WORK_DIR', type=str,
+                    help='Directory of the synthetic slides and intermediate files')
+parser.add_argument('--size', default=8192, type=int, help='Level-0 size of the synthetic'
+                    ' slides, a power of 2, default 8192')
+parser.add_argument('--seed', default=0, type=int, help='random seed of the slides and'
+                    ' the samplers, default 0')
+parser.add_argument('--level', default=5, type=int, help='heatmap/tissue mask level, capped to'
+                    ' the last level of the synthetic pyramid, default 5')
+parser.add_argument('--image_size', default=256, type=int, help='patch size, default 256')
+parser.add_argument('--batch_size', default=16, type=int, help='batch size, default 16')
+parser.add_argument('--sampling_stride', default=2, type=int, help='Sampling pixels in tissue mask,'
+                    ' default 2')
+parser.add_argument('--num_workers', default=2, type=int, help='number of '
+                    'workers to use to make batch, default 2')
+parser.add_argument('--n_batches', default=20, type=int, help='batches of the data generator'
+                    ' benchmark, default 20')
+parser.add_argument('--n_points', default=500, type=int, help='points of the points extraction'
+                    ' benchmark, default 500')
+parser.add_argument('--repeat', default=3, type=int, help='timed runs per benchmark, the best'
+                    ' is reported, default 3')
+parser.add_argument('--only', default=None, type=str, help='comma separated benchmarks to run,'
+                    ' default all')
+parser.add_argument('--baseline', default=None, type=str, help='baseline json to compare with'
+                    ' (or to write with --save_baseline)')
+parser.add_argument('--save_baseline', action='store_true', help='store the results as the'
+                    ' new baseline instead of comparing')
+parser.add_argument('--tolerance', default=0.2, type=float, help='relative throughput drop or'
+                    ' memory growth flagged as a regression, default 0.2')
+parser.add_argument('--out_json', default=None, type=str, help='Path to save the results')
+parser.add_argument('--GPU', default='0', type=str, help='which GPU to use'
+                    ', default 0')
+
+# Configuration entries a baseline is only comparable under
+CONFIG_KEYS = ('size', 'seed', 'level', 'image_size', 'batch_size', 'sampling_stride',
+               'num_workers', 'n_batches', 'n_points')
+# Slack on the traced memory, small allocations are noisy
+MEMORY_SLACK_MB = 1.0
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def synthetic_heatmap(label_low, tissue, seed=0):
+    """
+    Heatmap-like map of a slide: blurred tumor label plus noise over the tissue
+    """
+    rng = np.random.RandomState(seed)
+    heatmap = ndimage.gaussian_filter((label_low > 0).astype(np.float32), sigma=2)
+    heatmap += rng.uniform(0, 0.3, heatmap.shape).astype(np.float32) * tissue
+    return np.clip(heatmap, 0, 1).astype(np.float32)
+
+
+def prepare(args):
+    """
+    Synthetic slide, its tissue mask, label mask and heatmap at the benchmark level
+    """
+    slide_path, mask_path = generate_slides(os.path.join(args.work_dir, 'slides'), args.size,
+                                            n_slides=1, seed=args.seed)[0]
+    slide = openslide.OpenSlide(slide_path)
+    level = min(args.level, slide.level_count - 1)
+    from helpers.mask_utils import TissueMaskGeneration
+    tissue = TissueMaskGeneration(slide, level)
+    tissue_mask_path = os.path.join(args.work_dir, 'tissue_mask.npy')
+    np.save(tissue_mask_path, tissue)
+    label_slide = openslide.OpenSlide(mask_path)
+    label_low = np.array(label_slide.read_region((0, 0), level,
+                         label_slide.level_dimensions[level]).convert('L')).T
+    heatmap = synthetic_heatmap(label_low, tissue, args.seed)
+    heatmap_path = os.path.join(args.work_dir, 'heatmap.npy')
+    np.save(heatmap_path, heatmap)
+    return Namespace(slide_path=slide_path, mask_path=mask_path, level=level, tissue=tissue,
+                     tissue_mask_path=tissue_mask_path, label_low=label_low, heatmap=heatmap,
+                     heatmap_path=heatmap_path, downsample=slide.level_downsamples[level])
+
+
+# Every benchmark does its setup and returns (run, unit), run() does the
+# timed work and returns the number of items processed
+
+def bench_tissue_mask(args, ctx):
+    from helpers.mask_utils import TissueMaskGeneration
+    slide = openslide.OpenSlide(ctx.slide_path)
+
+    def run():
+        TissueMaskGeneration(slide, ctx.level)
+        width, height = slide.level_dimensions[ctx.level]
+        return width * height / 1e6
+    return run, 'Mpx'
+
+
+def make_dataset(args, ctx, label=True):
+    from dataloader.inference_data_loader import WSIStridedPatchDataset
+    return WSIStridedPatchDataset(ctx.slide_path, ctx.tissue_mask_path, ctx.mask_path if label else None,
+                                  image_size=args.image_size, normalize=True, level=ctx.level,
+                                  sampling_stride=args.sampling_stride, roi_masking=True)
+
+
+def bench_dataset_iteration(args, ctx):
+    from dataloader.shared_batches import SharedBatchLoader, normalize_batch
+    dataset = make_dataset(args, ctx)
+
+    def run():
+        dataloader = SharedBatchLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                                       drop_last=True)
+        count = 0
+        for image_patches, _, _, _ in dataloader:
+            count += normalize_batch(image_patches).shape[0]
+        return count
+    return run, 'patches'
+
+
+def bench_get_probs_map(args, ctx):
+    from dataloader.shared_batches import SharedBatchLoader
+    from inference.probs_map import get_probs_map
+    from benchmarks.stand_in_models import tiny_fcn
+    model = tiny_fcn(seed=args.seed)
+    dataset = make_dataset(args, ctx, label=False)
+
+    def run():
+        dataloader = SharedBatchLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                                       drop_last=True)
+        get_probs_map(model, dataloader)
+        return len(dataloader) * args.batch_size
+    return run, 'patches'
+
+
+def bench_nms(args, ctx):
+    from inference import nms
+    nms_args = Namespace(probs_map_path=ctx.heatmap_path,
+                         coord_path=os.path.join(args.work_dir, 'nms_coords.csv'),
+                         xml_path=os.path.join(args.work_dir, 'nms_coords.xml'),
+                         level=ctx.level, radius=12, prob_thred=0.5, sigma=0, store_level=0, block_size=64)
+
+    def run():
+        nms.run(nms_args)
+        return ctx.heatmap.size / 1e6
+    return run, 'Mpx'
+
+
+def bench_extract_features(args, ctx):
+    from pn_stage_classification.feature_extraction import extract_features, image_open
+    tissue_open = image_open(ctx.tissue)
+
+    def run():
+        extract_features(ctx.heatmap, tissue_open)
+        return ctx.heatmap.size / 1e6
+    return run, 'Mpx'
+
+
+def write_coords(path, slide_path, mask_path, points):
+    with open(path, 'w') as f:
+        for x, y in points:
+            f.write('{},{},{},{}\n'.format(slide_path, mask_path, x, y))
+
+
+def sample_points(mask, n, downsample, rng):
+    """
+    Up to n level-0 coordinates of the non-zero pixels of a low level mask
+    """
+    points = np.transpose(np.nonzero(mask))
+    points = points[rng.choice(len(points), min(n, len(points)), replace=False)]
+    return (points * downsample).astype(np.int64)
+
+
+def bench_data_generator(args, ctx):
+    from dataloader.training_data_loader import DataGeneratorCoordFly
+    rng = np.random.RandomState(args.seed)
+    n = args.n_batches * args.batch_size
+    tumor_path = os.path.join(args.work_dir, 'tumor_coords.txt')
+    normal_path = os.path.join(args.work_dir, 'normal_coords.txt')
+    write_coords(tumor_path, ctx.slide_path, ctx.mask_path,
+                 sample_points(ctx.label_low, n, ctx.downsample, rng))
+    write_coords(normal_path, ctx.slide_path, ctx.mask_path,
+                 sample_points(ctx.tissue & (ctx.label_low == 0), n, ctx.downsample, rng))
+    generator = DataGeneratorCoordFly(tumor_path, normal_path, image_size=(args.image_size, args.image_size),
+                                      batch_size=args.batch_size, shuffle=False,
+                                      samples_per_epoch=args.n_batches * args.batch_size)
+
+    def run():
+        for index in range(len(generator)):
+            generator[index]
+        return len(generator) * args.batch_size
+    return run, 'patches'
+
+
+def bench_points_extraction(args, ctx):
+    """
+    The sampling loop of patch_extraction/points_extractor.py (that script
+    parses its arguments on import): tumor points from the label mask, normal
+    points from the tissue mask verified tumor-free on the level-0 label patch
+    """
+    label_slide = openslide.OpenSlide(ctx.mask_path)
+    patch_size = args.image_size
+
+    def run():
+        rng = np.random.RandomState(args.seed)
+        tumor_points = sample_points(ctx.label_low, args.n_points, ctx.downsample, rng)
+        normal_points = sample_points(ctx.tissue, 2 * args.n_points, ctx.downsample, rng)
+        verified = []
+        for x, y in normal_points:
+            mask_patch = np.array(label_slide.read_region((int(x - patch_size//2), int(y - patch_size//2)), 0,
+                                                          (patch_size, patch_size)).convert('L'))
+            if np.count_nonzero(mask_patch) == 0:
+                verified.append((x, y))
+        return len(tumor_points) + len(verified)
+    return run, 'points'
+
+
+def synthetic_annotation(args, ctx):
+    """
+    Path of a json annotation of the tumors of the label mask, their contours at the
+    benchmark level scaled to level 0
+    """
+    from skimage import measure
+    contours = measure.find_contours((ctx.label_low > 0).astype(np.float32), 0.5)
+    annotation_path = os.path.join(args.work_dir, 'annotation.json')
+    with open(annotation_path, 'w') as f:
+        json.dump({'positive': [{'name': 'Annotation {}'.format(i), 'vertices': (contour * ctx.downsample).tolist()}
+                                for i, contour in enumerate(contours) if len(contour) >= 3]}, f)
+    return annotation_path
+
+
+def bench_annotation_queries(args, ctx):
+    """
+    Annotation.inside_polygons of the tumor and tissue points, the test of
+    patch_extraction/points_extractor.py (json/xml annotations), with the
+    loading of the annotation and the build of its grid index
+    """
+    from patch_extraction.annotation import Annotation
+    annotation_path = synthetic_annotation(args, ctx)
+    rng = np.random.RandomState(args.seed)
+    points = np.concatenate([sample_points(ctx.label_low, 10 * args.n_points, ctx.downsample, rng),
+                             sample_points(ctx.tissue, 10 * args.n_points, ctx.downsample, rng)])
+
+    def run():
+        annotation = Annotation()
+        annotation.from_json(annotation_path)
+        return len(annotation.inside_polygons(points))
+    return run, 'points'
+
+
+def bench_annotation_rasterize(args, ctx):
+    """
+    Annotation.rasterize at the benchmark level, the label mask of the json/xml annotations
+    """
+    from patch_extraction.annotation import Annotation
+    annotation = Annotation()
+    annotation.from_json(synthetic_annotation(args, ctx))
+    dimensions = ctx.label_low.shape
+
+    def run():
+        mask = annotation.rasterize(dimensions, ctx.downsample)
+        return mask.size / 1e6
+    return run, 'Mpx'
+
+
+BENCHMARKS = OrderedDict([('tissue_mask', bench_tissue_mask),
+                          ('dataset_iteration', bench_dataset_iteration),
+                          ('get_probs_map', bench_get_probs_map),
+                          ('nms', bench_nms),
+                          ('extract_features', bench_extract_features),
+                          ('data_generator', bench_data_generator),
+                          ('points_extraction', bench_points_extraction),
+                          ('annotation_queries', bench_annotation_queries),
+                          ('annotation_rasterize', bench_annotation_rasterize)])
+
+
+def measure(run, repeat):
+    """
+    One traced warm-up run for the memory, then the best of `repeat` timed runs
+    """
+    tracemalloc.start()
+    run()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best, items = None, 0
+    for _ in range(repeat):
+        start = time.time()
+        items = run()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return {'seconds': best, 'items': items, 'throughput': items / best if best else float('inf'),
+            'peak_traced_mb': traced_peak / 1024.0 / 1024.0, 'peak_rss_mb': peak_rss_mb()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Names of the benchmarks slower or hungrier than the baseline beyond tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = result['throughput'] < base['throughput'] * (1 - tolerance)
+        hungrier = result['peak_traced_mb'] > base['peak_traced_mb'] * (1 + tolerance) + MEMORY_SLACK_MB
+        result['baseline_throughput'] = base['throughput']
+        result['baseline_peak_traced_mb'] = base['peak_traced_mb']
+        result['regression'] = slower or hungrier
+        if result['regression']:
+            regressions.append(name)
+    return regressions
+
+
+def print_table(results):
+    print ('{:<20}{:>12}{:>16}{:>14}{:>12}{:>12}  {}'.format('benchmark', 'seconds', 'throughput', 'baseline',
+                                                          'traced_MB', 'rss_MB', 'status'))
+    for name, result in results.items():
+        baseline = result.get('baseline_throughput')
+        status = '' if baseline is None else ('REGRESSION' if result['regression'] else 'ok')
+        print ('{:<20}{:>12.3f}{:>11.2f} {:<4}{:>14}{:>12.1f}{:>12.1f}  {}'.format(
+            name, result['seconds'], result['throughput'], result['unit'] + '/s',
+            '' if baseline is None else '{:.2f}'.format(baseline),
+            result['peak_traced_mb'], result['peak_rss_mb'], status))
+
+
+def run(args):
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.GPU
+    logging.basicConfig(level=logging.WARNING)
+    if not os.path.exists(args.work_dir):
+        os.makedirs(args.work_dir)
+    names = list(BENCHMARKS) if args.only is None else args.only.split(',')
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError('Unknown benchmarks {}, expected some of {}'.format(unknown, list(BENCHMARKS)))
+
+    np.random.seed(args.seed)
+    ctx = prepare(args)
+    config = dict((key, getattr(args, key)) for key in CONFIG_KEYS)
+    config['level'] = ctx.level
+    results = OrderedDict()
+    for name in names:
+        bench, unit = BENCHMARKS[name](args, ctx)
+        results[name] = measure(bench, args.repeat)
+        results[name]['unit'] = unit
+
+    regressions = []
+    if args.baseline is not None and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            logging.warning('Baseline recorded with {}, not comparable with {}'.format(baseline['config'], config))
+        else:
+            regressions = compare(results, baseline['results'], args.tolerance)
+    print_table(results)
+
+    report = {'config': config, 'results': results}
+    if args.save_baseline:
+        if args.baseline is None:
+            raise ValueError('--save_baseline needs --baseline')
+        if os.path.exists(args.baseline):
+            # keep the baseline of the benchmarks not run this time
+            with open(args.baseline) as f:
+                previous = json.load(f)
+            if previous['config'] == config:
+                report['results'] = OrderedDict(list(previous['results'].items()) + list(results.items()))
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.out_json is not None:
+        with open(args.out_json, 'w') as f:
+            json.dump(report, f, indent=1)
+    if regressions:
+        print ('Regressions: {}'.format(', '.join(regressions)))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    sys.exit(1 if run(args) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, UpSampling2D
+from tensorflow.keras.initializers import he_normal
+
+
+def tiny_fcn(input_shape=(None, None), filters=8, seed=0):
+    """
+    Small fully convolutional stand-in for the segmentation models: same
+    input (H x W x 3, normalized) and output (H x W x 2 softmax) as
+    unet_densenet121, a fraction of the compute, so the benchmarks time
+    the data path and the stitching rather than the GPU.
+    """
+    img_input = Input(input_shape + (3,))
+    x = Conv2D(filters, 3, padding='same', activation='relu', kernel_initializer=he_normal(seed))(img_input)
+    x = MaxPooling2D(2)(x)
+    x = Conv2D(filters, 3, padding='same', activation='relu', kernel_initializer=he_normal(seed + 1))(x)
+    x = UpSampling2D(2)(x)
+    x = Conv2D(2, 1, padding='same', activation='softmax', kernel_initializer=he_normal(seed + 2))(x)
+    return Model(img_input, x, name='tiny_fcn')
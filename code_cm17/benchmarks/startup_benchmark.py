@@ -0,0 +1,100 @@
+import sys
+import os
+import argparse
+import json
+import subprocess
+import time
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + '/../'
+
+
+# python3 startup_benchmark.py --threshold=1.0
+# python3 startup_benchmark.py --modules=inference.nms --repeat=10
+
+parser = argparse.ArgumentParser(description='Time the start-up (import) of the light command line'
+                                 ' tools in fresh interpreters and check they do not load the'
+                                 ' deep learning frameworks')
+parser.add_argument('--modules', default=None, type=str, help='comma separated modules to import,'
+                    ' default the light tools')
+parser.add_argument('--repeat', default=5, type=int, help='fresh interpreters per module, the best'
+                    ' is reported, default 5')
+parser.add_argument('--threshold', default=1.0, type=float, help='start-up seconds above which a'
+                    ' module fails, on top of the bare interpreter, default 1.0')
+parser.add_argument('--forbidden', default='tensorflow,keras,torch', type=str, help='comma'
+                    ' separated packages a light module must not import')
+parser.add_argument('--out_json', default=None, type=str, help='Path to save the results')
+
+# Entry points and helpers that should start without tensorflow
+LIGHT_MODULES = ('helpers.mask_utils', 'helpers.io_utils', 'helpers.metrics',
+                 'inference.nms', 'inference.tissue_mask_cm17',
+                 'pn_stage_classification.feature_extraction', 'trainer.hardmine_from_heatmap',
+                 'dataloader.inference_data_loader')
+
+# Run in the child: import the module, report the top level packages loaded
+PROBE = '''
+import sys, json
+sys.path.insert(0, {root!r})
+import {module}
+print(json.dumps(sorted(set(name.split('.')[0] for name in sys.modules))))
+'''
+
+
+def time_import(module, repeat):
+    """
+    Best wall time of `python -c "import module"` over repeat fresh
+    interpreters, and the top level packages the import loaded
+    """
+    best, loaded = None, []
+    code = PROBE.format(root=ROOT, module=module) if module else 'print("[]")'
+    for _ in range(repeat):
+        start = time.time()
+        proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = time.time() - start
+        if proc.returncode != 0:
+            raise RuntimeError('import {} failed:\n{}'.format(module, proc.stderr))
+        loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    return best, loaded
+
+
+def run(args):
+    modules = LIGHT_MODULES if args.modules is None else args.modules.split(',')
+    forbidden = set(args.forbidden.split(','))
+    interpreter, _ = time_import(None, args.repeat)
+    results = OrderedDict()
+    failures = []
+    print ('{:<45}{:>10}{:>10}  {}'.format('module', 'seconds', 'import', 'status'))
+    for module in modules:
+        seconds, loaded = time_import(module, args.repeat)
+        heavy = sorted(forbidden.intersection(loaded))
+        import_seconds = seconds - interpreter
+        status = []
+        if heavy:
+            status.append('loads {}'.format(','.join(heavy)))
+        if import_seconds > args.threshold:
+            status.append('slower than {}s'.format(args.threshold))
+        if status:
+            failures.append(module)
+        results[module] = {'seconds': seconds, 'import_seconds': import_seconds, 'forbidden': heavy}
+        print ('{:<45}{:>10.3f}{:>10.3f}  {}'.format(module, seconds, import_seconds,
+                                                    ', '.join(status) or 'ok'))
+    print ('bare interpreter: {:.3f}s'.format(interpreter))
+
+    if args.out_json is not None:
+        with open(args.out_json, 'w') as f:
+            json.dump({'interpreter_seconds': interpreter, 'threshold': args.threshold,
+                       'results': results}, f, indent=1)
+    if failures:
+        print ('Failed: {}'.format(', '.join(failures)))
+    return failures
+
+
+def main():
+    args = parser.parse_args()
+    sys.exit(1 if run(args) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import os
+import argparse
+import json
+import numpy as np
+import tifffile
+
+
+# python3 synthetic_slides.py ../../data/synthetic --size=8192 --n_slides=2 --seed=0
+
+TILE_SIZE = 256
+GLASS_RGB = (235, 235, 235)
+TISSUE_RGB = (220, 150, 195)
+TUMOR_RGB = (150, 70, 150)
+TUMOR_LABEL = 255
+
+
+def pyramid_levels(size, min_size=TILE_SIZE):
+    """
+    Number of 2x down-sampled levels down to min_size
+    """
+    return int(np.log2(size // min_size)) + 1
+
+
+def draw_ellipse(canvas, center, axes, angle, value):
+    """
+    Fill a rotated ellipse of `canvas` (H x W or H x W x C) with `value`,
+    only the bounding box of the ellipse is evaluated
+    """
+    cy, cx = center
+    ay, ax = axes
+    radius = int(np.ceil(max(ay, ax)))
+    y0, y1 = max(int(cy) - radius, 0), min(int(cy) + radius + 1, canvas.shape[0])
+    x0, x1 = max(int(cx) - radius, 0), min(int(cx) + radius + 1, canvas.shape[1])
+    if y0 >= y1 or x0 >= x1:
+        return
+    ys, xs = np.ogrid[y0:y1, x0:x1]
+    cos, sin = np.cos(angle), np.sin(angle)
+    u = (ys - cy) * cos + (xs - cx) * sin
+    v = (xs - cx) * cos - (ys - cy) * sin
+    inside = (u / ay) ** 2 + (v / ax) ** 2 <= 1
+    canvas[y0:y1, x0:x1][inside] = value
+
+
+def make_slide(size, seed=0, n_blobs=6, n_tumors=4, tumor=True):
+    """
+    Level-0 RGB image and tumor label mask (H x W, 0/255) of a synthetic
+    slide: noisy glass with dust specks, pink tissue blobs and darker
+    tumor regions inside the blobs.
+
+    Returns:
+        (rgb uint8 [size, size, 3], label uint8 [size, size])
+    """
+    rng = np.random.RandomState(seed)
+    rgb = np.empty((size, size, 3), dtype=np.uint8)
+    rgb[:] = GLASS_RGB
+    label = np.zeros((size, size), dtype=np.uint8)
+
+    blobs = []
+    for _ in range(n_blobs):
+        center = rng.uniform(0.2, 0.8, 2) * size
+        axes = rng.uniform(0.05, 0.15, 2) * size
+        angle = rng.uniform(0, np.pi)
+        draw_ellipse(rgb, center, axes, angle, TISSUE_RGB)
+        blobs.append((center, axes))
+    if tumor:
+        for i in range(n_tumors):
+            center, axes = blobs[i % len(blobs)]
+            offset = rng.uniform(-0.4, 0.4, 2) * axes
+            tumor_axes = rng.uniform(0.15, 0.4, 2) * axes.min()
+            angle = rng.uniform(0, np.pi)
+            draw_ellipse(rgb, center + offset, tumor_axes, angle, TUMOR_RGB)
+            draw_ellipse(label, center + offset, tumor_axes, angle, TUMOR_LABEL)
+    for _ in range(n_blobs * 20):
+        draw_ellipse(rgb, rng.uniform(0, size, 2), rng.uniform(1, 6, 2), 0, (90, 90, 90))
+
+    # texture, added in row bands to keep the int16 buffer small
+    band = max(1, (1 << 24) // (size * 3))
+    for y in range(0, size, band):
+        noise = rng.randint(-12, 13, size=(min(band, size - y), size, 3)).astype(np.int16)
+        rgb[y:y + band] = np.clip(rgb[y:y + band] + noise, 0, 255).astype(np.uint8)
+    return rgb, label
+
+
+def downsample(image, label=False):
+    """
+    2x down-sampling, mean of 2x2 blocks (max for label masks)
+    """
+    h, w = image.shape[0] // 2 * 2, image.shape[1] // 2 * 2
+    blocks = image[:h, :w].reshape((h // 2, 2, w // 2, 2) + image.shape[2:])
+    if label:
+        return blocks.max(axis=(1, 3))
+    return blocks.mean(axis=(1, 3), dtype=np.float32).round().astype(np.uint8)
+
+
+def write_pyramid(path, image, n_levels, label=False):
+    """
+    Tiled pyramidal TIFF (one page per level, TILE_SIZE tiles, deflate),
+    readable by openslide as a generic tiff
+    """
+    photometric = 'minisblack' if label else 'rgb'
+    bigtiff = image.nbytes > (1 << 31)
+    with tifffile.TiffWriter(path, bigtiff=bigtiff) as tif:
+        for level in range(n_levels):
+            try:
+                tif.write(image, tile=(TILE_SIZE, TILE_SIZE), photometric=photometric,
+                          compression='zlib', subfiletype=1 if level else 0)
+            except (TypeError, AttributeError):
+                # tifffile < 2020.9
+                tif.save(image, tile=(TILE_SIZE, TILE_SIZE), photometric=photometric, compress=6)
+            if level + 1 < n_levels:
+                image = downsample(image, label)
+
+
+def generate_slides(out_dir, size=8192, n_slides=1, seed=0, n_blobs=6, n_tumors=4):
+    """
+    Write synthetic_<i>.tif slides and synthetic_<i>_mask.tif label masks
+    (the CAMELYON layout) into out_dir. Slides are regenerated only when
+    their size or seed changed.
+
+    Returns:
+        list of (slide_path, mask_path)
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    n_levels = pyramid_levels(size)
+    slides = []
+    for i in range(n_slides):
+        slide_path = os.path.join(out_dir, 'synthetic_{}.tif'.format(i))
+        mask_path = os.path.join(out_dir, 'synthetic_{}_mask.tif'.format(i))
+        params = {'size': size, 'seed': seed + i, 'n_blobs': n_blobs, 'n_tumors': n_tumors,
+                  'n_levels': n_levels}
+        params_path = os.path.join(out_dir, 'synthetic_{}.json'.format(i))
+        if os.path.exists(params_path) and os.path.exists(slide_path) and os.path.exists(mask_path):
+            with open(params_path) as f:
+                if json.load(f) == params:
+                    slides.append((slide_path, mask_path))
+                    continue
+        rgb, label = make_slide(size, seed + i, n_blobs, n_tumors)
+        write_pyramid(slide_path, rgb, n_levels)
+        del rgb
+        write_pyramid(mask_path, label, n_levels, label=True)
+        with open(params_path, 'w') as f:
+            json.dump(params, f)
+        slides.append((slide_path, mask_path))
+    return slides
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic pyramidal slides and'
+                                     ' tumor label masks for the benchmarks')
+    parser.add_argument('out_dir', default=None, metavar='OUT_DIR', type=str,
+                        help='Directory of the generated slides')
+    parser.add_argument('--size', default=8192, type=int, help='Level-0 width and height,'
+                        ' a power of 2, default 8192')
+    parser.add_argument('--n_slides', default=1, type=int, help='number of slides, default 1')
+    parser.add_argument('--seed', default=0, type=int, help='random seed, default 0')
+    parser.add_argument('--n_blobs', default=6, type=int, help='tissue blobs per slide, default 6')
+    parser.add_argument('--n_tumors', default=4, type=int, help='tumor regions per slide, default 4')
+    args = parser.parse_args()
+    for slide_path, mask_path in generate_slides(args.out_dir, args.size, args.n_slides, args.seed,
+                                                 args.n_blobs, args.n_tumors):
+        print (slide_path, mask_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,23 +6,20 @@ import os, sys
 import glob
 import random
 import time
-import imgaug
-from imgaug import augmenters as iaa
 from PIL import Image
-from tqdm import tqdm
 import numpy as np 
 from six.moves import range
 import openslide
-import tensorflow as tf
-from torchvision import transforms  # noqa
-from torch.utils.data import DataLoader, Dataset
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
-from helpers.utils import *
+from helpers.mask_utils import TissueMaskGeneration
+from helpers.profiling import get_profiler
+from helpers.dihedral import dihedral, from_pil
+from dataloader.shared_batches import SharedBatchLoader
 
 
 
-class WSIStridedPatchDataset(Dataset):
+class WSIStridedPatchDataset(object):
     """
     Data producer that generate all the square grids, e.g. 3x3, of patches,
     from a WSI and its tissue mask, and their corresponding indices with
@@ -66,6 +63,7 @@ class WSIStridedPatchDataset(Dataset):
         self._level = level
         self._sampling_stride = sampling_stride
         self._roi_masking = roi_masking
+        self._transform = from_pil(flip, rotate)
         self._preprocess()
 
     def _preprocess(self):
@@ -87,7 +85,8 @@ class WSIStridedPatchDataset(Dataset):
                        mask_obj.level_dimensions[self._level]).convert('L')).T
         else:
             # Generate tissue mask on the fly    
-            self._mask = TissueMaskGeneration(self._slide, self._level)
+            with get_profiler().stage('mask_generation'):
+                self._mask = TissueMaskGeneration(self._slide, self._level)
            
         # morphological operations ensure the holes are filled in tissue mask
         # and minor points are aggregated to form a larger chunk         
@@ -142,7 +141,11 @@ class WSIStridedPatchDataset(Dataset):
     def get_strided_mask(self):
         return self._strided_mask
     
-    def __getitem__(self, idx):
+    def read_patch(self, idx):
+        """
+        uint8 patch (H x W x 3), mask coordinates and label (H x W, None
+        without label_path) of index idx, flipped/rotated as strided views
+        """
         x_coord, y_coord = self._X_idcs[idx], self._Y_idcs[idx]
 
         # x = int(x_coord * self._resolution)
@@ -151,37 +154,36 @@ class WSIStridedPatchDataset(Dataset):
         x = int(x_coord * self._resolution - self._image_size//2)
         y = int(y_coord * self._resolution - self._image_size//2)    
 
-        img = self._slide.read_region(
-            (x, y), 0, (self._image_size, self._image_size)).convert('RGB')
-        
+        profiler = get_profiler()
+        with profiler.stage('region_read', bytes_read=self._image_size * self._image_size * 4):
+            img = self._slide.read_region(
+                (x, y), 0, (self._image_size, self._image_size))
+        with profiler.stage('decode'):
+            img = img.convert('RGB')
+
+        # PIL image:   H x W x C
+        k, flip = self._transform
+        img = dihedral(np.asarray(img), k, flip, axes=(0, 1))
+        label_img = None
         if self._label_path is not None:
             label_img = self._label_slide.read_region(
                 (x, y), 0, (self._image_size, self._image_size)).convert('L')
-        else:
-            label_img = Image.fromarray(np.zeros((self._image_size, self._image_size), dtype=np.uint8))
-        
-        if self._flip == 'FLIP_LEFT_RIGHT':
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-            label_img = label_img.transpose(Image.FLIP_LEFT_RIGHT)
-            
-        if self._rotate == 'ROTATE_90':
-            img = img.transpose(Image.ROTATE_90)
-            label_img = label_img.transpose(Image.ROTATE_90)
-            
-        if self._rotate == 'ROTATE_180':
-            img = img.transpose(Image.ROTATE_180)
-            label_img = label_img.transpose(Image.ROTATE_180)
-
-        if self._rotate == 'ROTATE_270':
-            img = img.transpose(Image.ROTATE_270)
-            label_img = label_img.transpose(Image.ROTATE_270)
-
-        # PIL image:   H x W x C
-        img = np.array(img, dtype=np.float32)
-        label_img = np.array(label_img, dtype=np.uint8)
+            label_img = dihedral(np.asarray(label_img), k, flip, axes=(0, 1))
+        return img, x_coord, y_coord, label_img
 
-        if self._normalize:
-            img = (img - 128.0)/128.0
+    def __getitem__(self, idx):
+        img, x_coord, y_coord, label_img = self.read_patch(idx)
+        
+        with get_profiler().stage('normalize'):
+            # flip/rotate are strided views, the float32 conversion is the only copy
+            img = np.array(img, dtype=np.float32)
+            if label_img is None:
+                label_img = np.zeros((self._image_size, self._image_size), dtype=np.uint8)
+            else:
+                label_img = np.array(label_img, dtype=np.uint8)
+
+            if self._normalize:
+                img = (img - 128.0)/128.0
    
         return (img, x_coord, y_coord, label_img)
 
@@ -209,19 +211,20 @@ if __name__ == '__main__':
     #     imshow(img, label_img)
     #     # break
 
-    dataloader = DataLoader(dataset_obj, batch_size=1, num_workers=0, drop_last=True)
+    from helpers.vis import imshow, normalize_minmax
+    dataloader = SharedBatchLoader(dataset_obj, batch_size=1, num_workers=0, drop_last=True)
 
 
     print (dataloader.dataset.__len__(), dataloader.__len__())
     i = 0
     start_time = time.time()
     # # imshow(dataset_obj.get_mask(), dataset_obj.get_strided_mask())
-    for (data, x_mask, y_mask, label) in dataloader:
-        image_patches = data.cpu().data.numpy()
-        label_patches = label.cpu().data.numpy()
-        x_coords = x_mask.cpu().data.numpy()
-        y_coords = y_mask.cpu().data.numpy()
-        print (image_patches.shape, image_patches.dtype, label_patches.shape, label_patches.dtype)
+    for (image_patches, x_coords, y_coords, label_patches) in dataloader:
+        print (image_patches.shape, image_patches.dtype)
+        # the batches carry no label (None) without label_path
+        if label_patches is None:
+            continue
+        print (label_patches.shape, label_patches.dtype)
         # print (x_coords, y_coords)
         # For display 
         input_map = normalize_minmax(image_patches[0])
@@ -0,0 +1,261 @@
+import os
+import re
+import ctypes
+import multiprocessing as mp
+import numpy as np
+
+# weights of the groups of a hierarchy level among their siblings
+BALANCED = 'balanced'
+PROPORTIONAL = 'proportional'
+# Camelyon17 training slides: patients 0-19 come from centre 0, 20-39 from centre 1, ...
+CM17_PATIENTS_PER_CENTRE = 20
+
+
+def new_seed():
+    """
+    Base seed of a sampler user, drawn from the global numpy state so
+    np.random.seed (trainer.py) reproduces the run
+    """
+    return int(np.random.randint(2**31 - 1))
+
+
+def batch_rng(seed, *keys):
+    """
+    RandomState of one batch, seeded with the base seed and keys such as
+    (epoch, batch index): the draws of a batch do not depend on which
+    forked worker builds it, and do not repeat across workers or epochs
+    """
+    return np.random.RandomState([seed] + [int(key) for key in keys])
+
+
+class SumTree(object):
+    """
+    Binary tree of partial sums over `capacity` non-negative priorities,
+    stored as one flat array (node i has children 2i and 2i + 1, the root is
+    node 1, the leaves start at node `leaves`). Drawing an index with
+    probability proportional to its priority and updating priorities are
+    O(log n), both vectorized over whole batches of indices.
+
+    With shared=True the tree lives in shared memory: processes forked after
+    its creation (e.g. the keras workers of fit_generator) draw from the
+    priorities the parent keeps updating.
+    """
+    def __init__(self, capacity, shared=False):
+        if capacity < 1:
+            raise ValueError('SumTree needs a positive capacity, got {}'.format(capacity))
+        self.capacity = capacity
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self._buffer = mp.RawArray(ctypes.c_double, 2 * self.leaves) if shared else None
+        self._tree = self._view()
+
+    def _view(self):
+        if self._buffer is None:
+            return np.zeros(2 * self.leaves, dtype=np.float64)
+        return np.frombuffer(self._buffer, dtype=np.float64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._buffer is not None:
+            # the view is rebuilt on the shared buffer (only picklable while spawning)
+            del state['_tree']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_tree' not in state:
+            self._tree = self._view()
+
+    def __len__(self):
+        return self.capacity
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def get(self, indices):
+        return self._tree[self.leaves + np.asarray(indices, dtype=np.int64)]
+
+    def fill(self, priorities):
+        """
+        Set all the priorities, [capacity] array, the sums are rebuilt level by level
+        """
+        tree = self._tree
+        tree[self.leaves:] = 0
+        tree[self.leaves:self.leaves + self.capacity] = priorities
+        size = self.leaves
+        while size > 1:
+            tree[size // 2:size] = tree[size:2 * size:2] + tree[size + 1:2 * size:2]
+            size //= 2
+
+    def update(self, indices, priorities):
+        """
+        Set the priorities of indices (arrays), the sums above them are
+        recomputed one level at a time for all the indices together
+        """
+        tree = self._tree
+        nodes = np.asarray(indices, dtype=np.int64).ravel() + self.leaves
+        tree[nodes] = np.broadcast_to(priorities, nodes.shape)
+        while True:
+            nodes = np.unique(nodes[nodes > 1] // 2)
+            if len(nodes) == 0:
+                break
+            tree[nodes] = tree[2 * nodes] + tree[2 * nodes + 1]
+
+    def sample(self, n, rng=np.random):
+        """
+        n indices drawn with probability proportional to their priority,
+        stratified: one draw in each of n equal slices of the total
+        """
+        tree = self._tree
+        u = (np.arange(n) + rng.uniform(size=n)) * (tree[1] / n)
+        nodes = np.ones(n, dtype=np.int64)
+        while self.leaves > 1 and nodes[0] < self.leaves:
+            left = 2 * nodes
+            go_right = u >= tree[left]
+            u = np.where(go_right, u - tree[left], u)
+            nodes = left + go_right
+        # rounding (or a concurrent update) can step past the last priority
+        return np.minimum(nodes - self.leaves, self.capacity - 1)
+
+
+class LossPrioritizedSampler(object):
+    """
+    Sampler of n coordinates in proportion to their last known loss,
+    priority (loss + epsilon) ** alpha (alpha 0 is uniform, epsilon keeps
+    easy coordinates drawable). All coordinates start at initial_loss so
+    each is drawn until its loss is known.
+    """
+    def __init__(self, n, alpha=1.0, epsilon=0.01, initial_loss=1.0, shared=True):
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.tree = SumTree(n, shared=shared)
+        self.tree.fill(np.full(n, self.priority(initial_loss)))
+
+    def __len__(self):
+        return len(self.tree)
+
+    def priority(self, losses):
+        return (np.asarray(losses, dtype=np.float64) + self.epsilon) ** self.alpha
+
+    def sample(self, n, rng=np.random):
+        return self.tree.sample(n, rng)
+
+    def update(self, indices, losses):
+        self.tree.update(indices, self.priority(losses))
+
+
+class AliasTable(object):
+    """
+    Walker/Vose alias table of a discrete distribution: O(n) to build, then
+    every draw is one uniform column and one biased coin, O(1) whatever the
+    weights, vectorized over the draws of a batch.
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        if len(weights) == 0 or not np.all(np.isfinite(weights)) or np.any(weights < 0) \
+                or weights.sum() <= 0:
+            raise ValueError('AliasTable needs finite non-negative weights with a positive sum')
+        n = len(weights)
+        scaled = (weights * (n / weights.sum())).tolist()
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # what is left over is 1 up to rounding, kept at probability 1
+        self.prob = np.array(prob)
+        self.alias = np.array(alias, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, n, rng=np.random):
+        columns = rng.randint(len(self.prob), size=n)
+        return np.where(rng.uniform(size=n) < self.prob[columns], columns, self.alias[columns])
+
+
+def hierarchy_probabilities(keys, level_weights=None, weights=None):
+    """
+    Probability of every item of a hierarchy, e.g. class -> centre -> slide
+    -> coordinate: a group is chosen among its siblings at every level, then
+    an item of the last group in proportion to its weight.
+
+    Arguments:
+        keys: [N, L] group labels of the N items, one column per level
+        level_weights: L specs of the weights of the groups among their siblings,
+            BALANCED (or None) for equal weights, PROPORTIONAL for the total weight
+            of their items, or a dict of weights by label (missing labels weigh 1).
+            Default all BALANCED.
+        weights: [N] item weights within their group (e.g. tumor fractions), default 1
+
+    Returns:
+        [N] probabilities summing to 1
+    """
+    keys = np.asarray(keys, dtype=str)
+    if keys.ndim == 1:
+        keys = keys[:, None]
+    n, n_levels = keys.shape
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+    level_weights = [BALANCED] * n_levels if level_weights is None else list(level_weights)
+    if len(level_weights) != n_levels:
+        raise ValueError('{} level weights for {} levels'.format(len(level_weights), n_levels))
+    probabilities = np.ones(n)
+    group = np.zeros(n, dtype=np.int64)
+    for level, spec in enumerate(level_weights):
+        labels, label_ids = np.unique(keys[:, level], return_inverse=True)
+        children, child = np.unique(group * len(labels) + label_ids, return_inverse=True)
+        parent = children // len(labels)
+        if spec is None or spec == BALANCED:
+            child_weights = np.ones(len(children))
+        elif spec == PROPORTIONAL:
+            child_weights = np.bincount(child, weights=weights, minlength=len(children))
+        elif isinstance(spec, dict):
+            child_weights = np.array([float(spec.get(label, 1.0)) for label in labels[children % len(labels)]])
+        else:
+            raise ValueError('Unknown level weights {!r}'.format(spec))
+        parent_totals = np.bincount(parent, weights=child_weights)
+        probabilities *= (child_weights / parent_totals[parent])[child]
+        group = child
+    probabilities *= weights / np.bincount(group, weights=weights)[group]
+    return probabilities
+
+
+def cm17_centre(slide_path):
+    """
+    Centre of a Camelyon17 slide (patient_XXX_node_Y), '' for other slides
+    """
+    match = re.search(r'patient_(\d+)', os.path.basename(slide_path))
+    if match is None:
+        return ''
+    return 'centre_{}'.format(int(match.group(1)) // CM17_PATIENTS_PER_CENTRE)
+
+
+def slide_keys(slide_paths):
+    """
+    [N, 2] (centre, slide) hierarchy keys of the slides of N coordinates
+    """
+    return [(cm17_centre(path), os.path.basename(path)) for path in slide_paths]
+
+
+class HierarchicalSampler(object):
+    """
+    Sampler of the items of a hierarchy (hierarchy_probabilities), flattened
+    into one alias table: a batch of n indices is drawn at once, with
+    replacement, in O(n)
+    """
+    def __init__(self, keys, level_weights=None, weights=None):
+        self.probabilities = hierarchy_probabilities(keys, level_weights, weights)
+        self.table = AliasTable(self.probabilities)
+
+    def __len__(self):
+        return len(self.table)
+
+    def sample(self, n, rng=np.random):
+        return self.table.sample(n, rng)
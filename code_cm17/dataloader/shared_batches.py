@@ -0,0 +1,235 @@
+import ctypes
+import signal
+import traceback
+import queue
+import multiprocessing as mp
+import numpy as np
+
+from helpers.profiling import get_profiler
+
+SHARDS = ('interleave', 'contiguous')
+# seconds between checks of the workers while waiting for a batch or a slot
+POLL_INTERVAL = 1.0
+
+
+def normalize_batch(image_patches):
+    """
+    [0, 255] uint8 NHWC batch -> [-1, 1] float32, the normalization of the
+    dataset done once per batch on the consumer side
+    """
+    batch = np.subtract(image_patches, np.float32(128.0), dtype=np.float32)
+    batch /= np.float32(128.0)
+    return batch
+
+
+def sample_fields(sample):
+    """
+    (shape, dtype) of every element of a sample, None for the None elements
+    """
+    return [None if value is None else (np.shape(value), np.asarray(value).dtype) for value in sample]
+
+
+class SharedBatchRing(object):
+    """
+    Preallocated ring of n_slots batch buffers in shared memory, one buffer
+    per sample element (e.g. uint8 patches, uint8 labels, int64 coordinates),
+    described by sample_fields. Forked worker processes fill the slots in
+    place, the consumer reads them as numpy views, nothing is pickled.
+    """
+    def __init__(self, n_slots, batch_size, fields):
+        self.n_slots = n_slots
+        self.batch_size = batch_size
+        self.fields = fields
+        self._buffers = []
+        for field in fields:
+            if field is None:
+                self._buffers.append(None)
+                continue
+            shape, dtype = field
+            n_bytes = n_slots * batch_size * int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            self._buffers.append(mp.RawArray(ctypes.c_uint8, max(n_bytes, 1)))
+
+    @property
+    def nbytes(self):
+        return sum(len(buffer) for buffer in self._buffers if buffer is not None)
+
+    def slot(self, index):
+        """
+        Views of slot `index`, one (batch_size,) + shape array per field (None for None fields)
+        """
+        views = []
+        for field, buffer in zip(self.fields, self._buffers):
+            if field is None:
+                views.append(None)
+                continue
+            shape, dtype = field
+            array = np.frombuffer(buffer, dtype=dtype, count=self.n_slots * self.batch_size *
+                                  int(np.prod(shape, dtype=np.int64)))
+            views.append(array.reshape((self.n_slots, self.batch_size) + tuple(shape))[index])
+        return views
+
+
+def fill_slot(read_sample, ring, slot, indices):
+    views = ring.slot(slot)
+    for i, idx in enumerate(indices):
+        for view, value in zip(views, read_sample(idx)):
+            if view is not None and value is not None:
+                view[i] = value
+
+
+def batch_worker(worker_id, read_sample, ring, batches, free_slots, ready, stop):
+    """
+    Fill the batches (list of (batch index, patch indices)) in order, each
+    into a slot taken from free_slots, and announce it on ready, until done
+    or stop is set
+    """
+    # Ctrl-C is handled by the consumer, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        for batch_index, indices in batches:
+            slot = None
+            while slot is None:
+                if stop.is_set():
+                    return
+                try:
+                    slot = free_slots.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            fill_slot(read_sample, ring, slot, indices)
+            ready.put((worker_id, batch_index, slot, len(indices)))
+    except Exception:
+        ready.put((worker_id, None, None, traceback.format_exc()))
+    finally:
+        get_profiler().flush()
+
+
+class SharedBatchLoader(object):
+    """
+    Native multi-process batcher, iterating over numpy batches of a dataset.
+
+    Samples are read with dataset.read_patch when the dataset has it
+    (WSIStridedPatchDataset: uint8 patches, normalize with normalize_batch)
+    or dataset[idx], and written by the workers straight into a
+    SharedBatchRing. The batches are views of the ring: they are valid until
+    the next batch is requested.
+
+    Arguments:
+        shard: 'interleave', worker w makes batches w, w + n, ... or
+            'contiguous', worker w makes the w-th contiguous run of batches
+            (neighbouring slide regions, better for the tile caches; meant
+            for unordered delivery, ordered it only overlaps `prefetch` batches)
+        ordered: deliver the batches in index order, else as soon as ready
+        prefetch: slots per worker, i.e. batches a worker can be ahead
+    """
+    def __init__(self, dataset, batch_size, num_workers=4, prefetch=2, drop_last=False,
+                 ordered=True, shard='interleave'):
+        if shard not in SHARDS:
+            raise ValueError('shard should be one of {}, got {}'.format(SHARDS, shard))
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.drop_last = drop_last
+        self.ordered = ordered
+        self.shard = shard
+        n_samples = len(dataset)
+        self._num_batch = n_samples // batch_size if drop_last else -(-n_samples // batch_size)
+        self._prefetch = prefetch
+        self._read_sample = getattr(dataset, 'read_patch', dataset.__getitem__)
+        fields = sample_fields(self._read_sample(0)) if n_samples else []
+        self._ring = SharedBatchRing(max(num_workers, 1) * prefetch, batch_size, fields)
+        self._workers = []
+        self._stop = None
+
+    def __len__(self):
+        return self._num_batch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _batches(self):
+        n_samples = len(self.dataset)
+        return [(b, range(b * self.batch_size, min((b + 1) * self.batch_size, n_samples)))
+                for b in range(self._num_batch)]
+
+    def _shards(self, batches, n_workers):
+        if self.shard == 'interleave':
+            return [batches[w::n_workers] for w in range(n_workers)]
+        bounds = np.linspace(0, len(batches), n_workers + 1).astype(int)
+        return [batches[bounds[w]:bounds[w + 1]] for w in range(n_workers)]
+
+    def _views(self, slot, count):
+        views = [None if view is None else view[:count] for view in self._ring.slot(slot)]
+        return tuple(views)
+
+    def _get(self, ready):
+        """
+        Next message of a ready queue, failing if a worker died without one
+        """
+        while True:
+            try:
+                worker_id, batch_index, slot, count = ready.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                dead = [w for w, worker in enumerate(self._workers) if worker.exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError('Batch workers {} died (exit codes {})'.format(
+                        dead, [self._workers[w].exitcode for w in dead]))
+                continue
+            if slot is None:
+                raise RuntimeError('Batch worker {} failed:\n{}'.format(worker_id, count))
+            return worker_id, batch_index, slot, count
+
+    def __iter__(self):
+        batches = self._batches()
+        if self.num_workers == 0:
+            for _, indices in batches:
+                fill_slot(self._read_sample, self._ring, 0, indices)
+                yield self._views(0, len(indices))
+            return
+
+        # every worker owns `prefetch` slots, a slow worker can never be
+        # starved of slots by the others
+        n_workers = max(min(self.num_workers, len(batches)), 1)
+        shards = self._shards(batches, n_workers)
+        self._stop = mp.Event()
+        free_slots = [mp.Queue() for _ in range(n_workers)]
+        shared_ready = mp.Queue()
+        ready = [mp.Queue() for _ in range(n_workers)] if self.ordered else [shared_ready] * n_workers
+        owner = {}
+        for w in range(n_workers):
+            for slot in range(w * self._prefetch, (w + 1) * self._prefetch):
+                free_slots[w].put(slot)
+            for batch_index, _ in shards[w]:
+                owner[batch_index] = w
+            worker = mp.Process(target=batch_worker, args=(w, self._read_sample, self._ring, shards[w],
+                                                           free_slots[w], ready[w], self._stop))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        try:
+            for batch_index in range(len(batches)):
+                queue_ready = ready[owner[batch_index]] if self.ordered else shared_ready
+                worker_id, _, slot, count = self._get(queue_ready)
+                yield self._views(slot, count)
+                free_slots[worker_id].put(slot)
+        finally:
+            self.close()
+            for q in free_slots + ready + [shared_ready]:
+                q.cancel_join_thread()
+                q.close()
+
+    def close(self, timeout=5.0):
+        """
+        Stop the workers: they finish the batch at hand and exit, the ones
+        still alive after timeout seconds are terminated
+        """
+        if self._stop is not None:
+            self._stop.set()
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._workers = []
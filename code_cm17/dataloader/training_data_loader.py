@@ -15,18 +15,14 @@ import openslide
 import tensorflow as tf
 from torchvision import transforms  # noqa
 from torch.utils.data import DataLoader, Dataset
-from collections import deque
 from math import sin, cos, radians, pi, sqrt
 
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 from helpers.utils import *
-
-def rotate_list(input_list, N):
-    input_list = deque(input_list) 
-    input_list.rotate(N) 
-    input_list = list(input_list)
-    return input_list 
+from helpers.metrics import batch_softmax_dice_loss
+from dataloader.samplers import LossPrioritizedSampler, HierarchicalSampler, slide_keys, new_seed, batch_rng,\
+    BALANCED, PROPORTIONAL
 
 def perturb_coord(x, y, radius=128):
     """
@@ -40,8 +36,24 @@ def perturb_coord(x, y, radius=128):
 class DataGeneratorCoordFly(tf.keras.utils.Sequence):
     'Generates data for Keras'
     def __init__(self, tumor_coord_path, normal_coord_path, image_size=(768, 768), batch_size=32, n_classes=2, n_channels=3,
-                  shuffle=True, level=0, samples_per_epoch=None, transform=None):
-        'Initialization'
+                  shuffle=True, level=0, samples_per_epoch=None, transform=None, hard_mining=False,
+                  mining_alpha=1.0, balance_slides=False, seed=None):
+        '''
+        Initialization
+
+        shuffle: draw the tumor and normal halves of every batch at random
+            (alias tables over centre -> slide -> coordinate, with replacement),
+            otherwise walk the lists in order, the same batches every epoch
+            (e.g. validation)
+        balance_slides: draw the centres and the slides of each class equally
+            often, instead of in proportion to their number of coordinates
+        hard_mining: online hard example mining, the tumor and normal halves of
+            every batch are drawn in proportion to the loss of the coordinates
+            (priorities kept up to date by a HardMiningCallback) instead of
+            walking the shuffled lists
+        mining_alpha: priority exponent, (loss + epsilon) ** mining_alpha
+        seed: base seed of the draws, default from the global numpy state
+        '''
         self.batch_size = batch_size
         self.n_classes = n_classes
         self.tumor_coord_path = tumor_coord_path
@@ -74,8 +86,19 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
         else:
             self.samples_per_epoch = samples_per_epoch
 
-        self._shuffle_counter = 0        
-        self._shuffle_reset_idx = int(np.floor(self._num_image / self.samples_per_epoch))          
+        self.hard_mining = hard_mining
+        self._seed = new_seed() if seed is None else seed
+        self._epoch = 0
+        self.tumor_sampler = self.normal_sampler = None
+        if self.hard_mining:
+            # priorities in shared memory, updated by the callback in the main
+            # process, read by the forked keras workers
+            self.tumor_sampler = LossPrioritizedSampler(len(self.tumor_coords), alpha=mining_alpha)
+            self.normal_sampler = LossPrioritizedSampler(len(self.normal_coords), alpha=mining_alpha)
+        elif self.shuffle:
+            level_weights = [BALANCED, BALANCED] if balance_slides else [PROPORTIONAL, PROPORTIONAL]
+            self.tumor_sampler = HierarchicalSampler(slide_keys([c[0] for c in self.tumor_coords]), level_weights)
+            self.normal_sampler = HierarchicalSampler(slide_keys([c[0] for c in self.normal_coords]), level_weights)
         self.on_epoch_end()
 
     def __len__(self):
@@ -90,17 +113,9 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
 
     def on_epoch_end(self):
         'Updates indexes after each epoch'                        
-        try:
-            if self.shuffle == True:
-                if self._shuffle_counter % self._shuffle_reset_idx == 0:
-                    random.shuffle(self.tumor_coords)
-                    random.shuffle(self.normal_coords)
-            self.tumor_coords = rotate_list(self.tumor_coords, self.samples_per_epoch//2)
-            self.normal_coords = rotate_list(self.normal_coords, self.samples_per_epoch//2)
-            self._shuffle_counter += 1
-        except Exception as error:
-            print(error)
-            import ipdb; ipdb.set_trace()
+        # the draws of the samplers are seeded by (seed, epoch, batch index),
+        # the lists themselves (and the indices of the samplers) never move
+        self._epoch += 1
 
 
     def _get_one_hot(self, targets):
@@ -141,69 +156,106 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
         # label = label.astype(np.bool)
         return image, mask
   
-    def __data_generation(self, index):
-        'Generates data containing batch_size samples' # X : (n_samples, *dim, n_channels)
-        # Initialization
-        X = np.empty((self.batch_size, *self.image_size, self.n_channels))
-        y = np.empty((self.batch_size, *self.image_size, self.n_classes))
+    def sample_ids(self, rng, batch_size=None):
+        """
+        (normal, tumor) list indices of a batch drawn by the samplers (loss
+        priorities when hard mining), half normal and half tumor
+        """
+        batch_size = self.batch_size if batch_size is None else batch_size
+        return (self.normal_sampler.sample(batch_size//2, rng),
+                self.tumor_sampler.sample(batch_size - batch_size//2, rng))
+
+    def update_priorities(self, normal_ids, tumor_ids, losses):
+        """
+        New losses of the coordinates of sample_ids, losses in the same order
+        (normal first)
+        """
+        losses = np.asarray(losses)
+        self.normal_sampler.update(normal_ids, losses[:len(normal_ids)])
+        self.tumor_sampler.update(tumor_ids, losses[len(normal_ids):])
+
+    def _batch_coords(self, index):
+        if self.normal_sampler is not None:
+            normal_ids, tumor_ids = self.sample_ids(batch_rng(self._seed, self._epoch, index))
+            return [self.normal_coords[i] for i in normal_ids] + [self.tumor_coords[i] for i in tumor_ids]
         norm_batch_size = self.batch_size//2
         tumor_batch_size = self.batch_size - self.batch_size//2
-
+        coords = []
         for i in range(self.batch_size):
-
-            #print((index//2)*norm_batch_size+i,index*tumor_batch_size//2+i,len(self.normal_coords),len(self.tumor_coords))
             if i < self.batch_size//2:
-                pid_path, mask_path, x_center, y_center = self.normal_coords[int(index*norm_batch_size+i)%len(self.normal_coords)]
+                coords.append(self.normal_coords[int(index*norm_batch_size+i)%len(self.normal_coords)])
             else:        
-                pid_path, mask_path, x_center, y_center = self.tumor_coords[int(index*tumor_batch_size+i)%len(self.tumor_coords)]        
+                coords.append(self.tumor_coords[int(index*tumor_batch_size+i)%len(self.tumor_coords)])
+        return coords
 
-            # Generate data
-            x_center, y_center = perturb_coord(x_center, y_center)
-            norm_batch_size = self.batch_size//2
-            tumor_batch_size = self.batch_size - self.batch_size//2
-            x_top_left = int(int(x_center) - self.image_size[0] / 2)
-            y_top_left = int(int(y_center) - self.image_size[1] / 2)
+    def _read_patch(self, pid_path, mask_path, x_center, y_center):
+        'RGB patch (uint8) and one-hot mask centred on the level 0 point, clipped to the slide'
+        x_top_left = int(int(x_center) - self.image_size[0] / 2)
+        y_top_left = int(int(y_center) - self.image_size[1] / 2)
+        try:
+            image_opslide = openslide.OpenSlide(pid_path)
+        except Exception as e: 
+            print(100*('-'))
+            print(pid_path)
+            print(e)
+            raise ValueError
+
+
+        x_max_dim,y_max_dim = image_opslide.level_dimensions[self.level]
+
+        if x_top_left < 0:
+            x_top_left = 0
+        elif x_top_left>x_max_dim - self.image_size[0]:
+            x_top_left = x_max_dim - self.image_size[0]
+        
+        if y_top_left < 0:
+            y_top_left = 0
+        elif y_top_left>y_max_dim - self.image_size[1]:
+            y_top_left = y_max_dim - self.image_size[1]
+
+        image = image_opslide.read_region(
+            (x_top_left, y_top_left), self.level,
+            (self.image_size[0], self.image_size[1])).convert('RGB')
+        if mask_path !='0':
             try:
-                image_opslide = openslide.OpenSlide(pid_path)
+                mask_opslide = openslide.OpenSlide(mask_path)
             except Exception as e: 
                 print(100*('-'))
                 print(pid_path)
                 print(e)
                 raise ValueError
+            mask = mask_opslide.read_region(
+                (x_top_left, y_top_left), self.level,
+                (self.image_size[0], self.image_size[1])).convert('L')
+        else:
+            mask = np.zeros((self.image_size[0], self.image_size[1]))
+        image = np.asarray(image)
+        mask =  np.asarray(mask,dtype=np.bool)
+        mask =  np.uint8(mask)
+        return image, self._get_one_hot(mask)
+
+    def load_coords(self, coords):
+        """
+        Unperturbed, unaugmented batch (X, y) of (pid_path, mask_path, x, y) coordinates
+        """
+        X = np.empty((len(coords), *self.image_size, self.n_channels))
+        y = np.empty((len(coords), *self.image_size, self.n_classes))
+        for i, (pid_path, mask_path, x_center, y_center) in enumerate(coords):
+            image, mask = self._read_patch(pid_path, mask_path, x_center, y_center)
+            X[i,] = self._normalize_image(image)
+            y[i,] = mask
+        return X, y
 
+    def __data_generation(self, index):
+        'Generates data containing batch_size samples' # X : (n_samples, *dim, n_channels)
+        # Initialization
+        X = np.empty((self.batch_size, *self.image_size, self.n_channels))
+        y = np.empty((self.batch_size, *self.image_size, self.n_classes))
 
-            x_max_dim,y_max_dim = image_opslide.level_dimensions[self.level]
-
-            if x_top_left < 0:
-                x_top_left = 0
-            elif x_top_left>x_max_dim - self.image_size[0]:
-                x_top_left = x_max_dim - self.image_size[0]
-            
-            if y_top_left < 0:
-                y_top_left = 0
-            elif y_top_left>y_max_dim - self.image_size[1]:
-                y_top_left = y_max_dim - self.image_size[1]
-
-            image = image_opslide.read_region(
-                (x_top_left, y_top_left), self.level,
-                (self.image_size[0], self.image_size[1])).convert('RGB')
-            if mask_path !='0':
-                try:
-                    mask_opslide = openslide.OpenSlide(mask_path)
-                except Exception as e: 
-                    print(100*('-'))
-                    print(pid_path)
-                    print(e)
-                    raise ValueError
-                mask = mask_opslide.read_region(
-                    (x_top_left, y_top_left), self.level,
-                    (self.image_size[0], self.image_size[1])).convert('L')
-            else:
-                mask = np.zeros((self.image_size[0], self.image_size[1]))
-            image = np.asarray(image)
-            mask =  np.asarray(mask,dtype=np.bool)
-            mask =  np.uint8(mask)
-            mask = self._get_one_hot(mask)
+        for i, (pid_path, mask_path, x_center, y_center) in enumerate(self._batch_coords(index)):
+            # Generate data
+            x_center, y_center = perturb_coord(x_center, y_center)
+            image, mask = self._read_patch(pid_path, mask_path, x_center, y_center)
             if self.transform:
                 image, mask = self._augmentation(image, mask)
             image = self._normalize_image(image)
@@ -211,6 +263,37 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
             y[i,] = mask
         return X, y
 
+
+class HardMiningCallback(Callback):
+    """
+    Keeps the loss priorities of a hard mining DataGeneratorCoordFly up to
+    date during training: every `every` batches, batch_size coordinates are
+    drawn from the priorities, scored by the model being trained (patches
+    read without perturbation or augmentation) and their per patch
+    softmax_dice_loss becomes their new priority. A scoring batch costs
+    about as much slide I/O as a training batch, every=1 doubles the I/O of
+    an epoch, every=20 adds 5%. Replaces the full slide mining passes
+    (auto_hardmine.py, hardminer.py) between training rounds.
+    """
+    def __init__(self, generator, every=20, batch_size=None):
+        super(HardMiningCallback, self).__init__()
+        if not generator.hard_mining:
+            raise ValueError('HardMiningCallback needs a generator created with hard_mining=True')
+        self.generator = generator
+        self.every = every
+        self.batch_size = generator.batch_size if batch_size is None else batch_size
+        self.rng = np.random.RandomState(generator._seed)
+
+    def on_batch_end(self, batch, logs=None):
+        if batch % self.every:
+            return
+        normal_ids, tumor_ids = self.generator.sample_ids(self.rng, self.batch_size)
+        coords = [self.generator.normal_coords[i] for i in normal_ids] + \
+                 [self.generator.tumor_coords[i] for i in tumor_ids]
+        X, y = self.generator.load_coords(coords)
+        y_pred = self.model.predict_on_batch(X)
+        self.generator.update_priorities(normal_ids, tumor_ids, batch_softmax_dice_loss(y, y_pred))
+
 if __name__ == '__main__':
 
 
@@ -242,7 +325,7 @@ if __name__ == '__main__':
                           'batch_size': 8,
                           'n_classes': 2,
                           'n_channels': 3,
-                          'shuffle': True,
+                          'shuffle': False,
                           'level': 0,
                           'samples_per_epoch': 30000,                        
                           'transform': None
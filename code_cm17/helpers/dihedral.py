@@ -0,0 +1,49 @@
+import numpy as np
+
+# The 8 elements of the dihedral group of the square as (k, flip): the
+# image is flipped left-right first (if flip) then rotated k times by
+# 90 degrees counter-clockwise, as PIL FLIP_LEFT_RIGHT then ROTATE_<90k>
+DIHEDRAL_GROUP = tuple((k, flip) for flip in (False, True) for k in range(4))
+IDENTITY = (0, False)
+
+ROTATIONS = {'NONE': 0, 'ROTATE_90': 1, 'ROTATE_180': 2, 'ROTATE_270': 3}
+
+
+def from_pil(flip='NONE', rotate='NONE'):
+    """
+    (k, flip) element of the dataset flip/rotate strings
+    """
+    return ROTATIONS[rotate], flip == 'FLIP_LEFT_RIGHT'
+
+
+def dihedral(data, k=0, flip=False, axes=(1, 2)):
+    """
+    Apply the (k, flip) transform to the spatial axes of `data`, NHWC batches
+    by default, axes=(0, 1) for a single HWC patch. Returns a strided view.
+    """
+    if flip:
+        data = np.flip(data, axes[1])
+    return np.rot90(data, k, axes=axes)
+
+
+def inverse_dihedral(data, k=0, flip=False, axes=(1, 2)):
+    """
+    Undo dihedral(data, k, flip, axes): rotate back first, then flip.
+    Returns a strided view.
+    """
+    data = np.rot90(data, -k, axes=axes)
+    if flip:
+        data = np.flip(data, axes[1])
+    return data
+
+
+def tta_predict(predict, batch, elements=DIHEDRAL_GROUP):
+    """
+    Mean of predict() over the transformed copies of an NHWC batch, each
+    prediction mapped back to the orientation of the batch
+    """
+    total = None
+    for k, flip in elements:
+        preds = inverse_dihedral(predict(np.ascontiguousarray(dihedral(batch, k, flip))), k, flip)
+        total = preds.astype(np.float32) if total is None else total + preds
+    return total / len(elements)
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pandas as pd
+
+FEATURE_FORMATS = ('.csv', '.npz', '.parquet', '.feather')
+
+
+def features_to_dataframe(patient_names, features, stages, feature_names):
+    """
+    DataFrame in the layout of the feature csv files:
+    patient_name, <feature columns>, stage
+    """
+    df = pd.DataFrame(np.asarray(features, dtype=np.float64).reshape(len(patient_names), len(feature_names)),
+                      columns=feature_names)
+    df.insert(0, 'patient_name', list(patient_names))
+    df['stage'] = list(stages)
+    return df
+
+
+def save_features(path, patient_names, features, stages, feature_names):
+    """
+    Save slide features as csv, .npz (typed arrays), Parquet or Feather,
+    depending on the extension of path
+    """
+    ext = os.path.splitext(path)[1]
+    if ext not in FEATURE_FORMATS:
+        raise ValueError('Unsupported feature file format: {}'.format(path))
+    if ext == '.npz':
+        np.savez(path, patient_name=np.array(patient_names, dtype=str),
+                 features=np.asarray(features, dtype=np.float64),
+                 stage=np.array(stages, dtype=str),
+                 feature_names=np.array(feature_names, dtype=str))
+        return
+    df = features_to_dataframe(patient_names, features, stages, feature_names)
+    if ext == '.parquet':
+        df.to_parquet(path, index=False)
+    elif ext == '.feather':
+        df.to_feather(path)
+    else:
+        df.to_csv(path, index=False)
+
+
+def load_features(path):
+    """
+    Load a feature file written by save_features (or the legacy csv) as a DataFrame
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == '.npz':
+        data = np.load(path)
+        return features_to_dataframe(data['patient_name'], data['features'], data['stage'],
+                                     list(data['feature_names']))
+    if ext == '.parquet':
+        return pd.read_parquet(path)
+    if ext == '.feather':
+        return pd.read_feather(path)
+    return pd.read_csv(path)
@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+
+from helpers.feature_io import save_features, features_to_dataframe
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    sha1 of a file, or of all the files of a directory (e.g. a chunked store)
+    """
+    sha1 = hashlib.sha1()
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        paths = [path]
+    for file_path in paths:
+        sha1.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_stat(path):
+    """
+    (mtime, size) of a file, the latest mtime and total size for a directory
+    """
+    if not os.path.isdir(path):
+        return os.path.getmtime(path), os.path.getsize(path)
+    mtime, size = os.path.getmtime(path), 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            file_path = os.path.join(root, name)
+            mtime = max(mtime, os.path.getmtime(file_path))
+            size += os.path.getsize(file_path)
+    return mtime, size
+
+
+class FeatureStore(object):
+    """
+    Incremental per-slide feature store kept in a json file:
+
+        {"slides": {<patient_node_name>: {"inputs": {<role>: {"path", "mtime", "size", "sha1"}},
+                                          "params": {...}, "features": [...], "stage": ...}}}
+
+    A slide is recomputed only when one of its input files changed (same
+    mtime and size are trusted, otherwise the content hash decides) or when
+    the extraction parameters differ.
+    """
+    def __init__(self, path, params=None):
+        """
+        Arguments:
+            path: string, json file of the store, created on save
+            params: dict of the extraction parameters, part of every record
+        """
+        self._path = path
+        self._params = params or {}
+        self._slides = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._slides = json.load(f)['slides']
+
+    def __len__(self):
+        return len(self._slides)
+
+    def __contains__(self, name):
+        return name in self._slides
+
+    def _input_unchanged(self, record, path):
+        mtime, size = file_stat(path)
+        if record['path'] == path and record['mtime'] == mtime and record['size'] == size:
+            return True
+        if record['size'] != size or record['sha1'] != file_digest(path):
+            return False
+        # touched but identical: refresh the stat so it is not hashed again
+        record['path'], record['mtime'] = path, mtime
+        return True
+
+    def is_current(self, name, inputs):
+        """
+        Arguments:
+            name: string, patient_node_name of the slide
+            inputs: dict role -> path of the files the features depend on,
+                e.g. {'heatmap': ..., 'tissue_map': ...}
+        """
+        record = self._slides.get(name)
+        if record is None or record['params'] != self._params or set(record['inputs']) != set(inputs):
+            return False
+        return all(self._input_unchanged(record['inputs'][role], path) for role, path in inputs.items())
+
+    def stale(self, names_inputs):
+        """
+        Names among (name, inputs) pairs whose features have to be (re)computed
+        """
+        return [name for name, inputs in names_inputs if not self.is_current(name, inputs)]
+
+    def update(self, name, inputs, features, stage=None):
+        record_inputs = {}
+        for role, path in inputs.items():
+            mtime, size = file_stat(path)
+            record_inputs[role] = {'path': path, 'mtime': mtime, 'size': size, 'sha1': file_digest(path)}
+        self._slides[name] = {'inputs': record_inputs,
+                              'params': self._params,
+                              'features': [float(value) for value in features],
+                              'stage': stage}
+
+    def set_stage(self, name, stage):
+        self._slides[name]['stage'] = stage
+
+    def features(self, name):
+        return self._slides[name]['features']
+
+    def save(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'slides': self._slides}, f)
+        os.rename(tmp_path, self._path)
+
+    def _rows(self, names):
+        names = sorted(self._slides) if names is None else [name for name in names if name in self._slides]
+        return names, [self._slides[name]['features'] for name in names],\
+            [self._slides[name]['stage'] for name in names]
+
+    def to_dataframe(self, feature_names, names=None):
+        """
+        DataFrame in the layout load_dataframe expects: patient_name, features, stage
+        """
+        names, features, stages = self._rows(names)
+        return features_to_dataframe(names, features, stages, feature_names)
+
+    def export(self, out_path, feature_names, names=None):
+        """
+        Write the features of the store (optionally only `names`) as csv, npz, parquet or feather
+        """
+        names, features, stages = self._rows(names)
+        save_features(out_path, names, features, stages, feature_names)
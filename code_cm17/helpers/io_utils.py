@@ -0,0 +1,69 @@
+import os
+import xml.etree.cElementTree as ET
+
+def GenerateXMLfromCSV(csvpath, outxmlpath):
+    """Reads the data inside CSV file and generates xml file for visualizing via ASAP
+    
+    Args:
+        csvpath: 
+        outxmlpath: 
+        
+    Returns:
+        None
+    """
+    Annotations_root = ET.Element("ASAP_Annotations")
+    Annotations = ET.SubElement(Annotations_root, "Annotations")
+
+    csv_lines = open(csvpath,"r").readlines()
+    for i in range(len(csv_lines)):
+        line = csv_lines[i]
+        elems = line.rstrip().split(',')
+        Name_value = "Annotation {}".format(i)
+        X_value = elems[1]
+        Y_value = elems[2]
+
+        Annotation =  ET.SubElement(Annotations, "Annotation", Name=Name_value, Type="Dot", PartOfGroup="None", Color="#F4FA58")
+        Coordinates =  ET.SubElement(Annotation, "Coordinates")
+        Coordinate =  ET.SubElement(Coordinates, "Coordinate", Order="0", X=X_value, Y=Y_value)
+
+    AnnotationGroups = ET.SubElement(Annotations_root, "AnnotationGroups")
+    tree = ET.ElementTree(Annotations_root)
+    tree.write(outxmlpath)
+
+
+class MinedPointsWriter(object):
+    """
+    Buffers the lines of the mined points files (e.g. tumor.txt and
+    normal.txt of a mining directory) and appends them in bulk, every
+    buffer_size lines and on flush/close
+    """
+    def __init__(self, out_dir, buffer_size=10000):
+        self.out_dir = out_dir
+        self.buffer_size = buffer_size
+        self._lines = {}
+        self._n_lines = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, name, line):
+        """
+        Queue a line (with its newline) for out_dir/<name>.txt
+        """
+        self._lines.setdefault(name, []).append(line)
+        self._n_lines += 1
+        if self._n_lines >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for name, lines in self._lines.items():
+            with open(os.path.join(self.out_dir, '%s.txt' % name), 'a') as f:
+                f.writelines(lines)
+        self._lines = {}
+        self._n_lines = 0
+
+    def close(self):
+        self.flush()
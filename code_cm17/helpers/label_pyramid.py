@@ -0,0 +1,68 @@
+import numpy as np
+
+
+class LabelPyramid(object):
+    """
+    Summed-area table of the binary label mask of a slide at one pyramid
+    level, built once per slide: the tumor pixel count (and fraction) of any
+    axis aligned window is 4 lookups, vectorized over all the windows.
+
+    Windows are given in level 0 coordinates and mapped to the level, the
+    fractions are exact at the level resolution (a level pixel is tumor if
+    its label is non-zero). Parts of a window outside the slide count as
+    non-tumor, as in openslide read_region.
+    """
+    def __init__(self, mask, downsample=1):
+        """
+        Arguments:
+            mask: [X, Y] label mask of the level (non-zero is tumor), indexed [x, y]
+            downsample: level 0 pixels per level pixel
+        """
+        mask = np.asarray(mask) > 0
+        self.shape = mask.shape
+        self.downsample = float(downsample)
+        dtype = np.int32 if mask.size < np.iinfo(np.int32).max else np.int64
+        self._table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=dtype)
+        np.cumsum(mask, axis=0, dtype=dtype, out=self._table[1:, 1:])
+        np.cumsum(self._table[1:, 1:], axis=1, dtype=dtype, out=self._table[1:, 1:])
+
+    @classmethod
+    def from_slide(cls, label_path, level=5):
+        """
+        Pyramid of a label tif (openslide), at level (capped to its last level)
+        """
+        import openslide
+        slide = openslide.OpenSlide(label_path)
+        level = min(level, slide.level_count - 1)
+        mask = np.array(slide.read_region((0, 0), level, slide.level_dimensions[level]).convert('L')).T
+        downsample = slide.level_downsamples[level]
+        slide.close()
+        return cls(mask, downsample)
+
+    @property
+    def nbytes(self):
+        return self._table.nbytes
+
+    def count(self, x0, y0, x1, y1):
+        """
+        Tumor pixels of the level windows [x0, x1) x [y0, y1), clipped to the
+        mask, arrays (or scalars) of level coordinates
+        """
+        x0 = np.clip(x0, 0, self.shape[0])
+        x1 = np.clip(x1, 0, self.shape[0])
+        y0 = np.clip(y0, 0, self.shape[1])
+        y1 = np.clip(y1, 0, self.shape[1])
+        table = self._table
+        return table[x1, y1] - table[x0, y1] - table[x1, y0] + table[x0, y0]
+
+    def tumor_fraction(self, x, y, size):
+        """
+        Tumor fraction of the size x size level 0 windows centred on the level 0
+        points (x, y), arrays of any shape
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        side = max(int(round(size / self.downsample)), 1)
+        x0 = np.round((x - size // 2) / self.downsample).astype(np.int64)
+        y0 = np.round((y - size // 2) / self.downsample).astype(np.int64)
+        return self.count(x0, y0, x0 + side, y0 + side) / float(side * side)
@@ -0,0 +1,105 @@
+import tensorflow as tf
+from tensorflow.keras import backend as K
+from tensorflow.keras.losses import categorical_crossentropy
+
+def dice_coef(y_true, y_pred):
+    y_true_f = K.flatten(y_true)
+    y_pred_f = K.flatten(y_pred)
+    intersection = K.sum(y_true_f * y_pred_f)
+    return (2. * intersection + 1) / (K.sum(y_true_f) + K.sum(y_pred_f) + 1)
+
+def dice_coef_loss(y_true, y_pred):
+    return 1 - (dice_coef(y_true, y_pred))
+
+def dice_coef_rounded_ch0(y_true, y_pred):
+    y_true_f = K.flatten(K.round(y_true[..., 0]))
+    y_pred_f = K.flatten(K.round(y_pred[..., 0]))
+    intersection = K.sum(y_true_f * y_pred_f)
+    return (2. * intersection + 1) / (K.sum(y_true_f) + K.sum(y_pred_f) + 1)
+
+def dice_coef_rounded_ch1(y_true, y_pred):
+    y_true_f = K.flatten(K.round(y_true[..., 1]))
+    y_pred_f = K.flatten(K.round(y_pred[..., 1]))
+    intersection = K.sum(y_true_f * y_pred_f)
+    return (2. * intersection + 1) / (K.sum(y_true_f) + K.sum(y_pred_f) + 1)
+
+def softmax_dice_loss(y_true, y_pred):
+    return (categorical_crossentropy(y_true, y_pred) * 0.5 \
+    + dice_coef_loss(y_true[..., 0], y_pred[..., 0]) * 0.25 \
+    + dice_coef_loss(y_true[..., 1], y_pred[..., 1]) * 0.25)
+
+def softmax_dice_focal_loss(y_true, y_pred):
+    return (binary_focal_loss(y_true, y_pred) * 0.5 \
+    + dice_coef_loss(y_true[..., 0], y_pred[..., 0]) * 0.25 \
+    + dice_coef_loss(y_true[..., 1], y_pred[..., 1]) * 0.25)
+
+def binary_focal_loss(y_true, y_pred, gamma=2., alpha=.25):
+    """
+    Binary form of focal loss.
+      FL(p_t) = -alpha * (1 - p_t)**gamma * log(p_t)
+      where p = sigmoid(x), p_t = p or 1 - p depending on if the label is 1 or 0, respectively.
+    References:
+        https://arxiv.org/pdf/1708.02002.pdf
+    Usage:
+     model.compile(loss=[binary_focal_loss(alpha=.25, gamma=2)], metrics=["accuracy"], optimizer=adam)
+    """
+    """
+    :param y_true: A tensor of the same shape as `y_pred`
+    :param y_pred:  A tensor resulting from a sigmoid
+    :return: Output tensor.
+    """
+    pt_1 = tf.where(tf.equal(y_true, 1), y_pred, tf.ones_like(y_pred))
+    pt_0 = tf.where(tf.equal(y_true, 0), y_pred, tf.zeros_like(y_pred))
+
+    epsilon = K.epsilon()
+    # clip to prevent NaN's and Inf's
+    pt_1 = K.clip(pt_1, epsilon, 1. - epsilon)
+    pt_0 = K.clip(pt_0, epsilon, 1. - epsilon)
+
+    return -K.sum(alpha * K.pow(1. - pt_1, gamma) * K.log(pt_1)) \
+           -K.sum((1 - alpha) * K.pow(pt_0, gamma) * K.log(1. - pt_0))
+
+
+def categorical_focal_loss(gamma=2., alpha=.25):
+    """
+    Softmax version of focal loss.
+           m
+      FL = ∑  -alpha * (1 - p_o,c)^gamma * y_o,c * log(p_o,c)
+          c=1
+      where m = number of classes, c = class and o = observation
+    Parameters:
+      alpha -- the same as weighing factor in balanced cross entropy
+      gamma -- focusing parameter for modulating factor (1-p)
+    Default value:
+      gamma -- 2.0 as mentioned in the paper
+      alpha -- 0.25 as mentioned in the paper
+    References:
+        Official paper: https://arxiv.org/pdf/1708.02002.pdf
+        https://www.tensorflow.org/api_docs/python/tf/keras/backend/categorical_crossentropy
+    Usage:
+     model.compile(loss=[categorical_focal_loss(alpha=.25, gamma=2)], metrics=["accuracy"], optimizer=adam)
+    """
+    def categorical_focal_loss_fixed(y_true, y_pred):
+        """
+        :param y_true: A tensor of the same shape as `y_pred`
+        :param y_pred: A tensor resulting from a softmax
+        :return: Output tensor.
+        """
+
+        # Scale predictions so that the class probas of each sample sum to 1
+        y_pred /= K.sum(y_pred, axis=-1, keepdims=True)
+
+        # Clip the prediction value to prevent NaN's and Inf's
+        epsilon = K.epsilon()
+        y_pred = K.clip(y_pred, epsilon, 1. - epsilon)
+
+        # Calculate Cross Entropy
+        cross_entropy = -y_true * K.log(y_pred)
+
+        # Calculate Focal Loss
+        loss = alpha * K.pow(1 - y_pred, gamma) * cross_entropy
+
+        # Sum the losses in mini_batch
+        return K.sum(loss, axis=1)
+
+    return categorical_focal_loss_fixed
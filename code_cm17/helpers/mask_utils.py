@@ -0,0 +1,133 @@
+import numpy as np
+import cv2
+from skimage.color import rgb2hsv
+from skimage.filters import threshold_otsu
+
+def BinMorphoProcessMask(mask):
+    """
+    Binary operation performed on tissue mask
+    """
+    close_kernel = np.ones((20, 20), dtype=np.uint8)
+    image_close = cv2.morphologyEx(np.array(mask), cv2.MORPH_CLOSE, close_kernel)
+    open_kernel = np.ones((5, 5), dtype=np.uint8)
+    image_open = cv2.morphologyEx(np.array(image_close), cv2.MORPH_OPEN, open_kernel)
+    return image_open
+
+def get_bbox(cont_img, rgb_image=None):
+    contours, _ = cv2.findContours(cont_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rgb_contour = None
+    if rgb_image is not None:
+        rgb_contour = rgb_image.copy()
+        line_color = (0, 0, 255)  # blue color code
+        cv2.drawContours(rgb_contour, contours, -1, line_color, 2)
+    bounding_boxes = [cv2.boundingRect(c) for c in contours]
+    for x, y, h, w in bounding_boxes:
+        rgb_contour = cv2.rectangle(rgb_contour,(x,y),(x+h,y+w),(0,255,0),2)
+    return bounding_boxes, rgb_contour
+
+def get_all_bbox_masks_with_stride(mask, stride_factor):
+    """
+    Find the bbox and corresponding masks
+    """
+    bbox_mask = np.zeros_like(mask)
+    bounding_boxes, _ = get_bbox(mask)
+    y_size, x_size = bbox_mask.shape
+    for x, y, h, w in bounding_boxes:
+        x_min = x - stride_factor
+        x_max = x + h + stride_factor
+        y_min = y - stride_factor
+        y_max = y + w + stride_factor
+        if x_min < 0: 
+         x_min = 0
+        if y_min < 0: 
+         y_min = 0
+        if x_max > x_size: 
+         x_max = x_size - 1
+        if y_max > y_size: 
+         y_max = y_size - 1      
+        bbox_mask[y_min:y_max:stride_factor, x_min:x_max:stride_factor]=1
+        
+    return bbox_mask
+
+
+def get_all_bbox_masks(mask, stride_factor):
+    """
+    Find the bbox and corresponding masks
+    """
+    bbox_mask = np.zeros_like(mask)
+    bounding_boxes, _ = get_bbox(mask)
+    y_size, x_size = bbox_mask.shape
+    for x, y, h, w in bounding_boxes:
+        x_min = x - stride_factor
+        x_max = x + h + stride_factor
+        y_min = y - stride_factor
+        y_max = y + w + stride_factor
+        if x_min < 0: 
+         x_min = 0
+        if y_min < 0: 
+         y_min = 0
+        if x_max > x_size: 
+         x_max = x_size - 1
+        if y_max > y_size: 
+         y_max = y_size - 1      
+        bbox_mask[y_min:y_max, x_min:x_max]=1
+    return bbox_mask
+
+def find_largest_bbox(mask, stride_factor):
+    """
+    Find the largest bounding box encompassing all the blobs
+    """
+    y_size, x_size = mask.shape
+    x, y = np.where(mask==1)
+    bbox_mask = np.zeros_like(mask)
+    x_min = np.min(x) - stride_factor
+    x_max = np.max(x) + stride_factor
+    y_min = np.min(y) - stride_factor
+    y_max = np.max(y) + stride_factor
+    
+    if x_min < 0: 
+     x_min = 0
+    
+    if y_min < 0: 
+     y_min = 0
+
+    if x_max > x_size: 
+     x_max = x_size - 1
+    
+    if y_max > y_size: 
+     y_max = y_size - 1    
+    
+    # print(x_min, x_max, y_min, y_max)
+    bbox_mask[x_min:x_max, y_min:y_max]=1
+    return bbox_mask
+
+def TissueMaskGeneration(slide_obj, level, RGB_min=50):
+    img_RGB = np.transpose(np.array(slide_obj.read_region((0, 0),
+                       level,
+                       slide_obj.level_dimensions[level]).convert('RGB')),
+                       axes=[1, 0, 2])
+    img_HSV = rgb2hsv(img_RGB)
+    background_R = img_RGB[:, :, 0] > threshold_otsu(img_RGB[:, :, 0])
+    background_G = img_RGB[:, :, 1] > threshold_otsu(img_RGB[:, :, 1])
+    background_B = img_RGB[:, :, 2] > threshold_otsu(img_RGB[:, :, 2])
+    tissue_RGB = np.logical_not(background_R & background_G & background_B)
+    tissue_S = img_HSV[:, :, 1] > threshold_otsu(img_HSV[:, :, 1])
+    min_R = img_RGB[:, :, 0] > RGB_min
+    min_G = img_RGB[:, :, 1] > RGB_min
+    min_B = img_RGB[:, :, 2] > RGB_min
+
+    tissue_mask = tissue_S & tissue_RGB & min_R & min_G & min_B
+    return tissue_mask
+
+def labelthreshold(image, threshold=0.5):
+    label = np.zeros_like(image)
+    label[image >= threshold] = 1
+    return label
+
+
+def patch_tissue_mask(rgb, thresholds=(235, 210, 235)):
+    """
+    Tissue of [0, 255] RGB patches (..., 3), single or batched: pixels
+    darker than the PAIP glass thresholds in any channel
+    """
+    return (rgb[..., 0] < thresholds[0]) | (rgb[..., 1] < thresholds[1]) | (rgb[..., 2] < thresholds[2])
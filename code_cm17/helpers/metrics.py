@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def dice(im1, im2, empty_score=1.0):
+    """
+    Dice coefficient of two binary masks of the same shape (any non-zero
+    value is foreground), empty_score when both are empty
+    """
+    im1 = np.asarray(im1).astype(bool)
+    im2 = np.asarray(im2).astype(bool)
+    if im1.shape != im2.shape:
+        raise ValueError("Shape mismatch: im1 and im2 must have the same shape.")
+    im_sum = im1.sum() + im2.sum()
+    if im_sum == 0:
+        return empty_score
+    return 2. * np.logical_and(im1, im2).sum() / im_sum
+
+
+def jaccard_index(x, y, smoothing=1):
+    """
+    Smoothed Jaccard index (intersection over union) of two masks, any
+    non-zero value is foreground. The inputs are not modified.
+    """
+    x = np.asarray(x) > 0
+    y = np.asarray(y) > 0
+    numerator = np.count_nonzero(x & y)
+    denominator = np.count_nonzero(x | y)
+    return (numerator + smoothing) / (denominator + smoothing)
+
+
+def tumor_fraction(mask_image):
+    """
+    Fraction of non-zero pixels of a label mask
+    """
+    return np.count_nonzero(mask_image) / np.prod(np.shape(mask_image))
+
+
+def batch_counts(pred_masks, label_masks):
+    """
+    Per patch pixel counts of two [N, ...] batches of binary masks (any
+    non-zero value is foreground)
+
+    Returns:
+        (intersection, union, pred_count, label_count), [N] int64 arrays
+    """
+    n = len(pred_masks)
+    pred_masks = np.asarray(pred_masks).reshape(n, -1) != 0
+    label_masks = np.asarray(label_masks).reshape(n, -1) != 0
+    intersection = np.count_nonzero(pred_masks & label_masks, axis=1)
+    pred_count = np.count_nonzero(pred_masks, axis=1)
+    label_count = np.count_nonzero(label_masks, axis=1)
+    return intersection, pred_count + label_count - intersection, pred_count, label_count
+
+
+def batch_dice(intersection, pred_count, label_count, empty_score=1.0):
+    """
+    [N] Dice coefficients of the batch_counts, empty_score where both masks are empty
+    """
+    total = pred_count + label_count
+    return np.where(total == 0, empty_score, 2. * intersection / np.maximum(total, 1))
+
+
+def batch_jaccard(intersection, union, smoothing=1):
+    """
+    [N] smoothed Jaccard indices of the batch_counts (jaccard_index of every patch)
+    """
+    return (intersection + smoothing) / (union + smoothing)
+
+
+def batch_tumor_fraction(label_masks):
+    """
+    [N] fractions of non-zero pixels of an [N, H, W] batch of label masks
+    """
+    n = len(label_masks)
+    label_masks = np.asarray(label_masks).reshape(n, -1)
+    return np.count_nonzero(label_masks, axis=1) / float(label_masks.shape[1])
+
+
+def quadrant_tumor_fractions(label_masks):
+    """
+    [N, 2, 2] tumor fractions of the quadrants of an [N, A, B] batch of label
+    masks, [n, i, j] of the quadrant [i * A/2:(i + 1) * A/2, j * B/2:(j + 1) * B/2]
+    """
+    label_masks = np.asarray(label_masks)
+    n, a, b = label_masks.shape[:3]
+    half_a, half_b = a // 2, b // 2
+    quadrants = label_masks[:, :2 * half_a, :2 * half_b].reshape(n, 2, half_a, 2, half_b)
+    return np.count_nonzero(quadrants, axis=(2, 4)) / float(half_a * half_b)
+
+
+def batch_softmax_dice_loss(y_true, y_pred, epsilon=1e-7, smoothing=1):
+    """
+    [N] per patch values of helpers.losses.softmax_dice_loss on [N, H, W, 2]
+    one-hot labels and softmax predictions: 0.5 mean crossentropy + 0.25
+    dice loss of each channel, the dice computed per patch
+    """
+    n = len(y_true)
+    y_true = np.asarray(y_true, dtype=np.float32).reshape(n, -1, 2)
+    y_pred = np.clip(np.asarray(y_pred, dtype=np.float32).reshape(n, -1, 2), epsilon, 1 - epsilon)
+    crossentropy = -np.sum(y_true * np.log(y_pred), axis=2).mean(axis=1)
+    intersection = np.sum(y_true * y_pred, axis=1)
+    dice = (2. * intersection + smoothing) / (y_true.sum(axis=1) + y_pred.sum(axis=1) + smoothing)
+    return crossentropy * 0.5 + (1 - dice).sum(axis=1) * 0.25
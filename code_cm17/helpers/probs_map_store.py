@@ -0,0 +1,278 @@
+import os
+import json
+import numpy as np
+
+STORE_META = 'meta.json'
+QUANTIZATION_DTYPES = ('uint8', 'float16', 'float32')
+
+
+def quantize(data, dtype):
+    """
+    Convert probabilities in [0, 1] to the storage dtype
+    """
+    if dtype == 'uint8':
+        return np.uint8(np.round(np.clip(data, 0, 1) * 255))
+    return np.asarray(data, dtype=dtype)
+
+
+def dequantize(data):
+    """
+    Convert stored chunk values back to float32 probabilities
+    """
+    if data.dtype == np.uint8:
+        return data.astype(np.float32) / 255.0
+    return data.astype(np.float32)
+
+
+def downsample_2x(data):
+    """
+    2x2 mean pooling, odd edges are padded with zeros
+    """
+    X, Y = data.shape
+    padded = np.zeros((X + X % 2, Y + Y % 2), dtype=np.float32)
+    padded[:X, :Y] = data
+    return padded.reshape(padded.shape[0]//2, 2, padded.shape[1]//2, 2).mean(axis=(1, 3))
+
+
+def is_probs_map_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, STORE_META))
+
+
+class ProbsMapStoreWriter(object):
+    """
+    Writes a probability map into a chunked, multi-level directory store:
+
+        <path>/meta.json
+        <path>/level_<k>/<i>_<j>.npy
+
+    Chunks are accumulated (sum and count of the overlapping predictions)
+    while the map is being stitched and are quantized and written to disk as
+    soon as no further patch can touch them. Chunks without any non-zero
+    value are never written, so glass costs nothing on disk.
+    """
+    def __init__(self, path, shape, chunk_size=256, dtype='uint8', n_levels=4, scale=1):
+        """
+        Arguments:
+            path: string, directory of the store
+            shape: (X, Y) of the full resolution map
+            chunk_size: int, size of the square chunks
+            dtype: string, 'uint8', 'float16' or 'float32' storage quantization
+            n_levels: int, number of pyramid levels, each one 2x down-sampled
+            scale: int, level 0 WSI pixels per map pixel, e.g. pow(2, level)
+        """
+        if dtype not in QUANTIZATION_DTYPES:
+            raise ValueError('Unsupported store dtype: {}'.format(dtype))
+        self._path = path
+        self._shape = tuple(int(s) for s in shape)
+        self._chunk_size = chunk_size
+        self._dtype = dtype
+        self._n_levels = n_levels
+        self._scale = scale
+        self._sums = {}
+        self._counts = {}
+        self._chunk_max = {}
+        level_dir = os.path.join(self._path, 'level_0')
+        if not os.path.exists(level_dir):
+            os.makedirs(level_dir)
+
+    def _chunk_slices(self, x_min, x_max, y_min, y_max):
+        cs = self._chunk_size
+        for i in range(x_min // cs, (x_max - 1) // cs + 1):
+            for j in range(y_min // cs, (y_max - 1) // cs + 1):
+                cx_min, cy_min = max(x_min, i*cs), max(y_min, j*cs)
+                cx_max, cy_max = min(x_max, (i+1)*cs), min(y_max, (j+1)*cs)
+                yield (i, j), (cx_min - i*cs, cx_max - i*cs, cy_min - j*cs, cy_max - j*cs),\
+                      (cx_min - x_min, cx_max - x_min, cy_min - y_min, cy_max - y_min)
+
+    def _chunk_shape(self, key, shape=None):
+        X, Y = self._shape if shape is None else shape
+        cs = self._chunk_size
+        return (min(cs, X - key[0]*cs), min(cs, Y - key[1]*cs))
+
+    def add(self, x, y, block):
+        """
+        Accumulate a block of probabilities with its top-left corner at (x, y)
+        """
+        X, Y = self._shape
+        x_max, y_max = min(x + block.shape[0], X), min(y + block.shape[1], Y)
+        x_min, y_min = max(x, 0), max(y, 0)
+        if x_min >= x_max or y_min >= y_max:
+            return
+        block = block[x_min - x:x_max - x, y_min - y:y_max - y]
+        for key, (c0, c1, c2, c3), (b0, b1, b2, b3) in self._chunk_slices(x_min, x_max, y_min, y_max):
+            if key not in self._sums:
+                self._sums[key] = np.zeros(self._chunk_shape(key), dtype=np.float32)
+                self._counts[key] = np.zeros(self._chunk_shape(key), dtype=np.uint16)
+            self._sums[key][c0:c1, c2:c3] += block[b0:b1, b2:b3]
+            self._counts[key][c0:c1, c2:c3] += 1
+
+    def write_array(self, probs_map):
+        """
+        Write a complete in-memory map
+        """
+        self.add(0, 0, probs_map)
+        self.flush()
+
+    def flush_rows(self, x_done):
+        """
+        Finalize all the chunks lying entirely above row x_done, i.e. chunks
+        that no upcoming patch can overlap anymore.
+        """
+        cs = self._chunk_size
+        for key in [k for k in self._sums if (k[0]+1)*cs <= x_done]:
+            self._write_chunk(key)
+
+    def flush(self):
+        for key in list(self._sums.keys()):
+            self._write_chunk(key)
+
+    def _write_chunk(self, key):
+        sums = self._sums.pop(key)
+        counts = self._counts.pop(key)
+        np.place(counts, counts == 0, 1)
+        chunk = quantize(sums / counts, self._dtype)
+        if np.any(chunk):
+            np.save(os.path.join(self._path, 'level_0', '{}_{}.npy'.format(*key)), chunk)
+            self._chunk_max.setdefault(0, {})[key] = float(dequantize(chunk).max())
+
+    def _build_pyramid(self):
+        shapes = [self._shape]
+        for level in range(1, self._n_levels):
+            shape = ((shapes[-1][0] + 1)//2, (shapes[-1][1] + 1)//2)
+            shapes.append(shape)
+            level_dir = os.path.join(self._path, 'level_{}'.format(level))
+            if not os.path.exists(level_dir):
+                os.makedirs(level_dir)
+            parents = sorted(set((i//2, j//2) for (i, j) in self._chunk_max.get(level-1, {})))
+            cs = self._chunk_size
+            for (pi, pj) in parents:
+                children = np.zeros((2*cs, 2*cs), dtype=np.float32)
+                for di in range(2):
+                    for dj in range(2):
+                        child = (2*pi + di, 2*pj + dj)
+                        if child in self._chunk_max[level-1]:
+                            data = dequantize(np.load(os.path.join(self._path, 'level_{}'.format(level-1),
+                                                                   '{}_{}.npy'.format(*child))))
+                            children[di*cs:di*cs + data.shape[0], dj*cs:dj*cs + data.shape[1]] = data
+                cx, cy = self._chunk_shape((pi, pj), shape)
+                chunk = quantize(downsample_2x(children)[:cx, :cy], self._dtype)
+                if np.any(chunk):
+                    np.save(os.path.join(level_dir, '{}_{}.npy'.format(pi, pj)), chunk)
+                    self._chunk_max.setdefault(level, {})[(pi, pj)] = float(dequantize(chunk).max())
+        return shapes
+
+    def close(self):
+        """
+        Flush the remaining chunks, build the down-sampled levels and write the metadata
+        """
+        self.flush()
+        shapes = self._build_pyramid()
+        meta = {'shape': list(self._shape),
+                'chunk_size': self._chunk_size,
+                'dtype': self._dtype,
+                'scale': self._scale,
+                'n_levels': self._n_levels,
+                'level_shapes': [list(s) for s in shapes],
+                'chunks': [{'{}_{}'.format(*key): value for key, value in self._chunk_max.get(level, {}).items()}
+                           for level in range(self._n_levels)]}
+        with open(os.path.join(self._path, STORE_META), 'w') as f:
+            json.dump(meta, f)
+
+
+class ProbsMapStore(object):
+    """
+    Reader of a store written by ProbsMapStoreWriter, only the chunks
+    overlapping the requested window and level are loaded.
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, STORE_META)) as f:
+            self._meta = json.load(f)
+        self._chunk_size = self._meta['chunk_size']
+        self._chunks = [dict((tuple(int(v) for v in key.split('_')), value) for key, value in level.items())
+                        for level in self._meta['chunks']]
+
+    @property
+    def n_levels(self):
+        return self._meta['n_levels']
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    def shape(self, level=0):
+        return tuple(self._meta['level_shapes'][level])
+
+    def scale(self, level=0):
+        """
+        Level 0 WSI pixels per pixel of the given store level
+        """
+        return self._meta['scale'] * pow(2, level)
+
+    def max(self, level=0):
+        return max(self._chunks[level].values()) if self._chunks[level] else 0.0
+
+    def occupied_chunks(self, level=0, min_value=None):
+        """
+        Keys (i, j) of the written chunks, optionally only those whose maximum reaches min_value
+        """
+        return sorted(key for key, value in self._chunks[level].items()
+                      if min_value is None or value >= min_value)
+
+    def read_chunk(self, key, level=0):
+        if key not in self._chunks[level]:
+            cs = self._chunk_size
+            X, Y = self.shape(level)
+            return np.zeros((min(cs, X - key[0]*cs), min(cs, Y - key[1]*cs)), dtype=np.float32)
+        return dequantize(np.load(os.path.join(self._path, 'level_{}'.format(level),
+                                               '{}_{}.npy'.format(*key))))
+
+    def iter_chunks(self, level=0, min_value=None):
+        """
+        Yield (x, y, chunk) for the written chunks, (x, y) being the top-left corner in the level
+        """
+        for key in self.occupied_chunks(level, min_value):
+            yield key[0]*self._chunk_size, key[1]*self._chunk_size, self.read_chunk(key, level)
+
+    def read(self, level=0, x_range=None, y_range=None, min_value=None):
+        """
+        Read a window [x_min, x_max) x [y_min, y_max) of a level as float32,
+        chunks whose maximum is below min_value are skipped (left at zero)
+        """
+        X, Y = self.shape(level)
+        x_min, x_max = (0, X) if x_range is None else x_range
+        y_min, y_max = (0, Y) if y_range is None else y_range
+        out = np.zeros((x_max - x_min, y_max - y_min), dtype=np.float32)
+        cs = self._chunk_size
+        for (i, j) in self.occupied_chunks(level, min_value):
+            cx, cy = i*cs, j*cs
+            if cx >= x_max or cy >= y_max or cx + cs <= x_min or cy + cs <= y_min:
+                continue
+            chunk = self.read_chunk((i, j), level)
+            ox_min, oy_min = max(cx, x_min), max(cy, y_min)
+            ox_max, oy_max = min(cx + chunk.shape[0], x_max), min(cy + chunk.shape[1], y_max)
+            out[ox_min - x_min:ox_max - x_min, oy_min - y_min:oy_max - y_min] =\
+                chunk[ox_min - cx:ox_max - cx, oy_min - cy:oy_max - cy]
+        return out
+
+
+def load_probs_map(path, level=0):
+    """
+    Load a probability map saved either as a numpy file or as a chunked store
+    """
+    if is_probs_map_store(path):
+        return ProbsMapStore(path).read(level)
+    return np.load(path)
+
+
+def save_probs_map(path, probs_map, chunk_size=256, dtype='uint8', n_levels=4, scale=1):
+    """
+    Save a probability map as a numpy file (.npy) or as a chunked store (any other path)
+    """
+    if path.endswith('.npy'):
+        np.save(path, probs_map)
+        return
+    writer = ProbsMapStoreWriter(path, probs_map.shape, chunk_size=chunk_size, dtype=dtype,
+                                 n_levels=n_levels, scale=scale)
+    writer.write_array(probs_map)
+    writer.close()
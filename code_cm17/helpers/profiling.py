@@ -0,0 +1,236 @@
+import os
+import csv
+import json
+import time
+import glob
+import resource
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from multiprocessing import util as mp_util
+
+# Stages of the inference pipeline, in pipeline order
+STAGES = ('mask_generation', 'region_read', 'decode', 'normalize', 'predict', 'rescale',
+          'stitch', 'crf', 'nms', 'save')
+EVENTS_PATTERN = 'events_*.jsonl'
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the calling process in MB (ru_maxrss is in KB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Profiler(object):
+    """
+    Records wall time per slide and stage, counters (bytes read, patches...)
+    and peak RSS. Events are buffered and appended to
+    <run_dir>/events_<pid>.jsonl, so the DataLoader worker processes, which
+    inherit the profiler when they are forked, report into the same run.
+    A Profiler without run_dir is disabled and costs a function call.
+    """
+    def __init__(self, run_dir=None, flush_every=1024):
+        self.enabled = run_dir is not None
+        self._run_dir = run_dir
+        self._flush_every = flush_every
+        self._events = []
+        self._slide = None
+        self._slide_start = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        if self.enabled and not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+
+    @property
+    def run_dir(self):
+        return self._run_dir
+
+    def _check_process(self):
+        if os.getpid() != self._pid:
+            # forked child: drop the events of the parent, they are flushed by the parent
+            self._pid = os.getpid()
+            self._events = []
+            self._lock = threading.Lock()
+            mp_util.Finalize(self, self.flush, exitpriority=10)
+
+    def _record(self, event):
+        self._check_process()
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= self._flush_every
+        if full:
+            self.flush()
+
+    def begin_slide(self, name):
+        """
+        Attribute the following stages and counters to a slide, until end_slide
+        """
+        if self.enabled:
+            self._slide = name
+            self._slide_start = time.time()
+
+    def end_slide(self):
+        if not self.enabled or self._slide is None:
+            return
+        self._record({'slide': self._slide, 'stage': 'slide', 'ts': self._slide_start,
+                      'dur': time.time() - self._slide_start,
+                      'pid': os.getpid(), 'tid': threading.current_thread().ident})
+        self._record({'slide': self._slide, 'rss_mb': peak_rss_mb(), 'pid': os.getpid()})
+        self.flush()
+        self._slide = None
+
+    @contextmanager
+    def slide(self, name):
+        """
+        Attribute the enclosed stages and counters to a slide
+        """
+        self.begin_slide(name)
+        try:
+            yield
+        finally:
+            self.end_slide()
+
+    @contextmanager
+    def stage(self, name, **counters):
+        """
+        Time the enclosed block as stage `name`, counters are added to the slide
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._record({'slide': self._slide, 'stage': name, 'ts': start, 'dur': time.time() - start,
+                          'pid': os.getpid(), 'tid': threading.current_thread().ident})
+            for counter, value in counters.items():
+                self.count(counter, value)
+
+    def add_time(self, name, start, duration):
+        """
+        Record a stage measured elsewhere (start in seconds since the epoch)
+        """
+        if self.enabled:
+            self._record({'slide': self._slide, 'stage': name, 'ts': start, 'dur': duration,
+                          'pid': os.getpid(), 'tid': threading.current_thread().ident})
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self._record({'slide': self._slide, 'counter': name, 'value': value,
+                          'ts': time.time(), 'pid': os.getpid()})
+
+    def flush(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        events.append({'slide': self._slide, 'rss_mb': peak_rss_mb(), 'pid': os.getpid()})
+        path = os.path.join(self._run_dir, 'events_{}.jsonl'.format(os.getpid()))
+        with open(path, 'a') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in events))
+
+    def events(self):
+        """
+        All the events of the run, from every process
+        """
+        self.flush()
+        events = []
+        for path in sorted(glob.glob(os.path.join(self._run_dir, EVENTS_PATTERN))):
+            with open(path) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+        return events
+
+    def summary(self):
+        """
+        Per-slide totals: seconds and calls per stage, counters and peak RSS
+        of the main process and of the worker processes
+        """
+        slides = OrderedDict()
+
+        def slide_entry(name):
+            return slides.setdefault(str(name), {'wall_seconds': 0.0, 'stages': OrderedDict(), 'counters': {},
+                                                 'peak_rss_mb': 0.0, 'workers_peak_rss_mb': 0.0})
+
+        for event in sorted(self.events(), key=lambda e: e.get('ts', 0)):
+            entry = slide_entry(event.get('slide'))
+            if event.get('stage') == 'slide':
+                entry['wall_seconds'] += event['dur']
+            elif 'stage' in event:
+                stage = entry['stages'].setdefault(event['stage'], {'seconds': 0.0, 'calls': 0})
+                stage['seconds'] += event['dur']
+                stage['calls'] += 1
+            elif 'counter' in event:
+                entry['counters'][event['counter']] = entry['counters'].get(event['counter'], 0) + event['value']
+            elif 'rss_mb' in event:
+                key = 'peak_rss_mb' if event['pid'] == self._pid else 'workers_peak_rss_mb'
+                entry[key] = max(entry[key], event['rss_mb'])
+        for entry in slides.values():
+            for stage in entry['stages'].values():
+                stage['share'] = stage['seconds'] / entry['wall_seconds'] if entry['wall_seconds'] else 0.0
+        return slides
+
+    def save_report(self, json_path=None, csv_path=None, trace_path=None):
+        """
+        Write the summary as json and/or csv (one row per slide and stage) and
+        the timeline in the Chrome trace format (chrome://tracing, Perfetto)
+        """
+        summary = self.summary()
+        if json_path is not None:
+            with open(json_path, 'w') as f:
+                json.dump(summary, f, indent=1)
+        if csv_path is not None:
+            with open(csv_path, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['slide', 'stage', 'seconds', 'calls', 'share'])
+                for slide, entry in summary.items():
+                    for stage, values in entry['stages'].items():
+                        writer.writerow([slide, stage, '{:.4f}'.format(values['seconds']), values['calls'],
+                                         '{:.4f}'.format(values['share'])])
+                    for counter, value in entry['counters'].items():
+                        writer.writerow([slide, counter, '', value, ''])
+                    writer.writerow([slide, 'wall', '{:.4f}'.format(entry['wall_seconds']), 1, '1.0000'])
+                    writer.writerow([slide, 'peak_rss_mb', '{:.1f}'.format(entry['peak_rss_mb']), '', ''])
+        if trace_path is not None:
+            trace = []
+            for event in self.events():
+                if 'stage' in event:
+                    trace.append({'name': event['stage'], 'cat': str(event['slide']), 'ph': 'X',
+                                  'ts': event['ts'] * 1e6, 'dur': event['dur'] * 1e6,
+                                  'pid': event['pid'], 'tid': event['tid'] or 0})
+                elif 'counter' in event:
+                    trace.append({'name': event['counter'], 'ph': 'C', 'ts': event['ts'] * 1e6,
+                                  'pid': event['pid'], 'args': {event['counter']: event['value']}})
+            with open(trace_path, 'w') as f:
+                json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return summary
+
+
+_profiler = Profiler()
+
+
+def get_profiler():
+    """
+    Profiler of the run, disabled unless enable_profiling was called
+    """
+    return _profiler
+
+
+def enable_profiling(run_dir):
+    global _profiler
+    _profiler = Profiler(run_dir)
+    return _profiler
+
+
+def save_run_report(profiler, trace=True):
+    """
+    report.json, report.csv and (optionally) trace.json in the run directory
+    """
+    if not profiler.enabled:
+        return None
+    return profiler.save_report(json_path=os.path.join(profiler.run_dir, 'report.json'),
+                                csv_path=os.path.join(profiler.run_dir, 'report.csv'),
+                                trace_path=os.path.join(profiler.run_dir, 'trace.json') if trace else None)
@@ -0,0 +1,122 @@
+import numpy as np
+from math import sqrt
+from scipy import ndimage
+from skimage.measure import regionprops_table
+
+# 8-connectivity, as skimage.measure.label uses for 2D images
+STRUCTURE_8 = np.ones((3, 3), dtype=bool)
+STRUCTURE_4 = ndimage.generate_binary_structure(2, 1)
+
+# Border configurations of skimage.measure.perimeter (4-neighbourhood)
+PERIMETER_WEIGHTS = np.zeros(50, dtype=np.float64)
+PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+PERIMETER_WEIGHTS[[21, 33]] = sqrt(2)
+PERIMETER_WEIGHTS[[13, 23]] = (1 + sqrt(2)) / 2
+PERIMETER_KERNEL = np.array([[10, 2, 10],
+                             [2, 1, 2],
+                             [10, 2, 10]], dtype=np.uint8)
+
+REGION_COLUMNS = ('label', 'area', 'mean_intensity', 'perimeter', 'major_axis_length',
+                  'minor_axis_length', 'eccentricity', 'extent', 'solidity')
+
+
+def label_mask(mask):
+    """
+    Label a uint8/bool mask with 8-connectivity, numbering regions in raster order
+    """
+    return ndimage.label(mask.view(np.uint8) if mask.dtype == bool else mask, structure=STRUCTURE_8)
+
+
+def region_perimeters(labels, n_regions):
+    """
+    skimage.measure.perimeter of every region, from a single erosion and
+    convolution of the whole label image. With 8-connected labels no two
+    regions are 4-adjacent, so the global border image equals the union of
+    the per-region ones.
+    """
+    mask = (labels > 0).view(np.uint8)
+    border = mask - ndimage.binary_erosion(mask, STRUCTURE_4, border_value=0).view(np.uint8)
+    config = ndimage.convolve(border, PERIMETER_KERNEL, mode='constant', cval=0)
+    on_border = border.astype(bool)
+    return np.bincount(labels[on_border], weights=PERIMETER_WEIGHTS[config[on_border]],
+                       minlength=n_regions + 1)[1:]
+
+
+def region_table(labels, n_regions, intensity, perimeter=True, solidity=False):
+    """
+    Columnar per-region statistics (as skimage.measure.regionprops_table) of
+    a label image, computed with bincounts over the labelled pixels.
+
+    Returns:
+        dict of 1D arrays of length n_regions, keyed by REGION_COLUMNS
+    """
+    table = {'label': np.arange(1, n_regions + 1)}
+    if n_regions == 0:
+        for column in REGION_COLUMNS[1:]:
+            table[column] = np.zeros(0, dtype=np.float64)
+        return table
+
+    xs, ys = np.nonzero(labels)
+    lab = labels[xs, ys]
+    xs = xs.astype(np.float64)
+    ys = ys.astype(np.float64)
+    n = n_regions + 1
+    area = np.bincount(lab, minlength=n)[1:].astype(np.float64)
+    table['area'] = area
+    table['mean_intensity'] = np.bincount(lab, weights=intensity[labels > 0], minlength=n)[1:] / area
+
+    # second order central moments -> inertia tensor eigenvalues
+    cx = np.bincount(lab, weights=xs, minlength=n)[1:] / area
+    cy = np.bincount(lab, weights=ys, minlength=n)[1:] / area
+    dx = xs - cx[lab - 1]
+    dy = ys - cy[lab - 1]
+    a = np.bincount(lab, weights=dx * dx, minlength=n)[1:] / area
+    b = np.bincount(lab, weights=dx * dy, minlength=n)[1:] / area
+    c = np.bincount(lab, weights=dy * dy, minlength=n)[1:] / area
+    root = np.sqrt(((a - c) / 2) ** 2 + b ** 2)
+    l1 = np.maximum((a + c) / 2 + root, 0)
+    l2 = np.maximum((a + c) / 2 - root, 0)
+    table['major_axis_length'] = 4 * np.sqrt(l1)
+    table['minor_axis_length'] = 4 * np.sqrt(l2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['eccentricity'] = np.where(l1 > 0, np.sqrt(1 - l2 / np.where(l1 > 0, l1, 1)), 0)
+
+    slices = ndimage.find_objects(labels, max_label=n_regions)
+    bbox_area = np.array([(s[0].stop - s[0].start) * (s[1].stop - s[1].start) for s in slices],
+                         dtype=np.float64)
+    table['extent'] = area / bbox_area
+
+    if perimeter:
+        table['perimeter'] = region_perimeters(labels, n_regions)
+    if solidity:
+        # the convex hull is the only property left to skimage
+        table['solidity'] = np.asarray(regionprops_table(labels, properties=('solidity',))['solidity'],
+                                       dtype=np.float64)
+    return table
+
+
+def threshold_tables(heatmap_prob, high=0.90, low=0.50):
+    """
+    Region tables of the heatmap at >= high and > low, the two thresholds of
+    the pN-stage features. The high mask is a subset of the low one, so both
+    are labelled on the bounding window of the low mask only.
+
+    Returns:
+        (table_high, table_low)
+    """
+    mask_low = heatmap_prob > low
+    rows = np.flatnonzero(mask_low.any(axis=1))
+    cols = np.flatnonzero(mask_low.any(axis=0))
+    if not len(rows):
+        return region_table(np.zeros((0, 0), dtype=np.int32), 0, None),\
+            region_table(np.zeros((0, 0), dtype=np.int32), 0, None)
+    window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    intensity = np.asarray(heatmap_prob[window], dtype=np.float64)
+    mask_low = mask_low[window].view(np.uint8)
+    mask_high = (intensity >= high).view(np.uint8)
+
+    labels_high, n_high = label_mask(mask_high)
+    labels_low, n_low = label_mask(mask_low)
+    table_high = region_table(labels_high, n_high, intensity, perimeter=True, solidity=True)
+    table_low = region_table(labels_low, n_low, intensity, perimeter=False, solidity=False)
+    return table_high, table_low
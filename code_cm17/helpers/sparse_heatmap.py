@@ -0,0 +1,277 @@
+import os
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from helpers.probs_map_store import load_probs_map
+
+
+class BlockSparseHeatmap(object):
+    """
+    Block-sparse probability map: the (X, Y) map is cut into square blocks
+    and only the blocks holding a non-zero value are kept, stacked in a
+    (n_blocks, block_size, block_size) array. An occupancy bitmap over the
+    block grid maps every occupied block to its row in the stack.
+
+    Conversion from and to the dense map is lossless.
+    """
+    def __init__(self, shape, block_size, occupancy, blocks):
+        """
+        Arguments:
+            shape: (X, Y) of the dense map
+            block_size: int, size of the square blocks
+            occupancy: bool array over the block grid, True for stored blocks
+            blocks: array (n_blocks, block_size, block_size), occupied blocks in
+                row-major order of the block grid
+        """
+        self._shape = tuple(int(s) for s in shape)
+        self._block_size = int(block_size)
+        self._occupancy = np.asarray(occupancy, dtype=bool)
+        self._blocks = blocks
+        self._index = np.full(self._occupancy.shape, -1, dtype=np.int64)
+        self._index[self._occupancy] = np.arange(np.count_nonzero(self._occupancy))
+        self._block_x, self._block_y = np.nonzero(self._occupancy)
+        self._block_max = None
+
+    @classmethod
+    def from_dense(cls, probs_map, block_size=64):
+        X, Y = probs_map.shape
+        bs = block_size
+        gx, gy = -(-X // bs), -(-Y // bs)
+        padded = np.zeros((gx*bs, gy*bs), dtype=probs_map.dtype)
+        padded[:X, :Y] = probs_map
+        grid = padded.reshape(gx, bs, gy, bs).swapaxes(1, 2)
+        occupancy = np.any(grid != 0, axis=(2, 3))
+        return cls((X, Y), bs, occupancy, np.ascontiguousarray(grid[occupancy]))
+
+    @classmethod
+    def from_npy(cls, path, block_size=64):
+        return cls.from_dense(np.load(path), block_size)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(tuple(data['shape']), int(data['block_size']), data['occupancy'], data['blocks'])
+
+    def save(self, path):
+        np.savez(path, shape=np.array(self._shape), block_size=np.array(self._block_size),
+                 occupancy=self._occupancy, blocks=self._blocks)
+
+    def to_npy(self, path):
+        np.save(path, self.to_dense())
+
+    def to_dense(self):
+        bs = self._block_size
+        gx, gy = self._occupancy.shape
+        grid = np.zeros((gx, gy, bs, bs), dtype=self._blocks.dtype)
+        grid[self._occupancy] = self._blocks
+        return grid.swapaxes(1, 2).reshape(gx*bs, gy*bs)[:self._shape[0], :self._shape[1]]
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self._blocks.dtype
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def occupancy(self):
+        return self._occupancy
+
+    @property
+    def n_blocks(self):
+        return len(self._blocks)
+
+    @property
+    def nbytes(self):
+        return self._blocks.nbytes + self._occupancy.nbytes
+
+    def _is_full(self):
+        return self._occupancy.all() and self._shape[0] % self._block_size == 0 and\
+            self._shape[1] % self._block_size == 0
+
+    def _global_coords(self, block_idx, i, j):
+        bs = self._block_size
+        return self._block_x[block_idx]*bs + i, self._block_y[block_idx]*bs + j
+
+    def block_max(self):
+        """
+        Maximum of every stored block, cached until the map is modified
+        """
+        if self._block_max is None:
+            self._block_max = self._blocks.reshape(len(self._blocks), -1).max(axis=1) if len(self._blocks)\
+                else np.zeros(0, dtype=self._blocks.dtype)
+        return self._block_max
+
+    def max(self):
+        block_max = self.block_max()
+        value = block_max.max() if len(block_max) else 0
+        return value if self._is_full() else max(value, 0)
+
+    def argmax(self):
+        """
+        (x, y) of the maximum, the first one in row-major order as np.where would give
+        """
+        value = self.max()
+        if not len(self._blocks) or value == 0 and not self._is_full():
+            return tuple(int(v) for v in np.unravel_index(np.argmax(self.to_dense()), self._shape))
+        candidates = np.flatnonzero(self.block_max() == value)
+        b, i, j = np.nonzero(self._blocks[candidates] == value)
+        xs, ys = self._global_coords(candidates[b], i, j)
+        first = np.lexsort((ys, xs))[0]
+        return int(xs[first]), int(ys[first])
+
+    def threshold_coords(self, threshold, strict=False):
+        """
+        Coordinates (xs, ys) of the pixels >= threshold (> threshold if strict),
+        in the row-major order of np.where
+        """
+        if threshold < 0 or threshold == 0 and not strict:
+            dense = self.to_dense()
+            return np.where(dense > threshold if strict else dense >= threshold)
+        selected = np.flatnonzero(self.block_max() > threshold if strict else self.block_max() >= threshold)
+        blocks = self._blocks[selected]
+        b, i, j = np.nonzero(blocks > threshold if strict else blocks >= threshold)
+        xs, ys = self._global_coords(selected[b], i, j)
+        order = np.lexsort((ys, xs))
+        return xs[order], ys[order]
+
+    def count_above(self, threshold, strict=False):
+        return len(self.threshold_coords(threshold, strict)[0])
+
+    def zero_window(self, x_min, x_max, y_min, y_max):
+        """
+        Set [x_min, x_max) x [y_min, y_max) to zero, e.g. the suppressed area of NMS
+        """
+        bs = self._block_size
+        for bx in range(max(x_min, 0) // bs, min(-(-x_max // bs), self._occupancy.shape[0])):
+            for by in range(max(y_min, 0) // bs, min(-(-y_max // bs), self._occupancy.shape[1])):
+                idx = self._index[bx, by]
+                if idx < 0:
+                    continue
+                self._blocks[idx, max(x_min - bx*bs, 0):max(x_max - bx*bs, 0),
+                             max(y_min - by*bs, 0):max(y_max - by*bs, 0)] = 0
+                if self._block_max is not None:
+                    self._block_max[idx] = self._blocks[idx].max()
+
+    def _edge_pairs(self, labels, connectivity):
+        """
+        Pairs of block-local labels touching across the borders of neighbouring blocks
+        """
+        gx, gy = self._occupancy.shape
+        pairs = []
+        offsets = [(1, 0), (0, 1)] + ([(1, 1), (1, -1)] if connectivity == 2 else [])
+        for dx, dy in offsets:
+            a_x, a_y = self._block_x, self._block_y
+            b_x, b_y = a_x + dx, a_y + dy
+            valid = (b_x < gx) & (b_y >= 0) & (b_y < gy)
+            a_idx = self._index[a_x[valid], a_y[valid]]
+            b_idx = self._index[b_x[valid], b_y[valid]]
+            keep = b_idx >= 0
+            a_idx, b_idx = a_idx[keep], b_idx[keep]
+            if not len(a_idx):
+                continue
+            if (dx, dy) == (1, 0):
+                a_edge, b_edge = labels[a_idx, -1, :], labels[b_idx, 0, :]
+            elif (dx, dy) == (0, 1):
+                a_edge, b_edge = labels[a_idx, :, -1], labels[b_idx, :, 0]
+            elif (dx, dy) == (1, 1):
+                a_edge, b_edge = labels[a_idx, -1, -1:], labels[b_idx, 0, :1]
+            else:
+                a_edge, b_edge = labels[a_idx, -1, :1], labels[b_idx, 0, -1:]
+            shifts = [0] if connectivity == 1 or dx == dy or dy == -1 else [-1, 0, 1]
+            for shift in shifts:
+                n = a_edge.shape[1]
+                a_part = a_edge[:, max(shift, 0):n + min(shift, 0)]
+                b_part = b_edge[:, max(-shift, 0):n + min(-shift, 0)]
+                touching = (a_part > 0) & (b_part > 0)
+                pairs.append(np.stack([a_part[touching], b_part[touching]], axis=1))
+        return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+    def label(self, threshold, strict=False, connectivity=2):
+        """
+        Connected components of the pixels >= threshold (> threshold if strict),
+        computed on the occupied blocks only. Components are numbered 1..n in
+        raster order, as skimage.measure.label numbers them.
+
+        Returns:
+            (labels, n) with labels a BlockSparseHeatmap of int32 labels
+        """
+        if threshold < 0 or threshold == 0 and not strict:
+            dense = self.to_dense()
+            labels, n = ndimage.label(dense > threshold if strict else dense >= threshold,
+                                      structure=ndimage.generate_binary_structure(2, connectivity))
+            return BlockSparseHeatmap.from_dense(labels.astype(np.int32), self._block_size), n
+        mask = self._blocks > threshold if strict else self._blocks >= threshold
+        # one call for all the blocks, no connectivity along the stacking axis
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[1] = ndimage.generate_binary_structure(2, connectivity)
+        local, n_local = ndimage.label(mask, structure=structure)
+        if n_local == 0:
+            return BlockSparseHeatmap(self._shape, self._block_size, np.zeros_like(self._occupancy),
+                                      np.zeros((0,) + self._blocks.shape[1:], dtype=np.int32)), 0
+
+        pairs = self._edge_pairs(local, connectivity)
+        graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                           shape=(n_local + 1, n_local + 1))
+        _, component = connected_components(graph, directed=False)
+
+        # renumber the components by their first pixel in raster order
+        b, i, j = np.nonzero(local)
+        xs, ys = self._global_coords(b, i, j)
+        raster = xs.astype(np.int64) * self._shape[1] + ys
+        comp = component[local[b, i, j]]
+        first = np.full(component.max() + 1, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first, comp, raster)
+        used = np.flatnonzero(first < np.iinfo(np.int64).max)
+        lookup = np.zeros(component.max() + 1, dtype=np.int32)
+        lookup[used[np.argsort(first[used])]] = np.arange(1, len(used) + 1, dtype=np.int32)
+
+        label_blocks = np.zeros(local.shape, dtype=np.int32)
+        label_blocks[b, i, j] = lookup[comp]
+        occupied = label_blocks.reshape(len(label_blocks), -1).any(axis=1)
+        occupancy = np.zeros_like(self._occupancy)
+        occupancy[self._block_x[occupied], self._block_y[occupied]] = True
+        return BlockSparseHeatmap(self._shape, self._block_size, occupancy, label_blocks[occupied]), len(used)
+
+    def bounding_box(self):
+        """
+        (x_min, x_max, y_min, y_max) of the stored blocks, clipped to the map
+        """
+        if not len(self._blocks):
+            return 0, 0, 0, 0
+        bs = self._block_size
+        return (int(self._block_x.min()*bs), int(min((self._block_x.max() + 1)*bs, self._shape[0])),
+                int(self._block_y.min()*bs), int(min((self._block_y.max() + 1)*bs, self._shape[1])))
+
+    def crop(self, x_min, x_max, y_min, y_max):
+        """
+        Dense window [x_min, x_max) x [y_min, y_max), built from the overlapping blocks only
+        """
+        bs = self._block_size
+        out = np.zeros((x_max - x_min, y_max - y_min), dtype=self._blocks.dtype)
+        for idx in range(len(self._blocks)):
+            cx, cy = self._block_x[idx]*bs, self._block_y[idx]*bs
+            if cx >= x_max or cy >= y_max or cx + bs <= x_min or cy + bs <= y_min:
+                continue
+            ox_min, oy_min = max(cx, x_min), max(cy, y_min)
+            ox_max, oy_max = min(cx + bs, x_max), min(cy + bs, y_max)
+            out[ox_min - x_min:ox_max - x_min, oy_min - y_min:oy_max - y_min] =\
+                self._blocks[idx, ox_min - cx:ox_max - cx, oy_min - cy:oy_max - cy]
+        return out
+
+
+def load_sparse_heatmap(path, block_size=64):
+    """
+    Load a probability map saved as a BlockSparseHeatmap (.npz), a numpy
+    file (.npy) or a chunked store as a BlockSparseHeatmap
+    """
+    if path.endswith('.npz') and os.path.isfile(path):
+        return BlockSparseHeatmap.load(path)
+    return BlockSparseHeatmap.from_dense(load_probs_map(path), block_size)
@@ -0,0 +1,118 @@
+import numpy as np
+
+
+class StitchAccumulator(object):
+    """
+    Accumulates overlapping patch predictions into (n_maps, X, Y) sum and count
+    buffers of configurable, compact dtypes and returns their normalized mean.
+    """
+    def __init__(self, shape, n_maps=1, sum_dtype='float32', count_dtype='uint16'):
+        """
+        Arguments:
+            shape: (X, Y) of the stitched maps
+            n_maps: int, number of maps stitched together (e.g. one per model)
+            sum_dtype: string, dtype of the sum buffer, e.g. 'float32' or 'float64'
+            count_dtype: string, dtype of the count buffer, 'uint8' is enough as long as
+                no pixel is covered by more than 255 patches
+        """
+        self._shape = tuple(shape)
+        self._n_maps = n_maps
+        self._sums = np.zeros((n_maps,) + self._shape, dtype=sum_dtype)
+        self._counts = np.zeros((n_maps,) + self._shape, dtype=count_dtype)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    def add(self, x, y, block, map_idx=0):
+        """
+        Add a block of predictions with its top-left corner at (x, y)
+        """
+        self._sums[map_idx, x:x + block.shape[0], y:y + block.shape[1]] += block
+        self._counts[map_idx, x:x + block.shape[0], y:y + block.shape[1]] += 1
+
+    def result(self, out_dtype='float32'):
+        """
+        Mean of the accumulated predictions, shape (n_maps, X, Y). With
+        out_dtype='float16' the probabilities are returned in half precision.
+        """
+        counts = np.maximum(self._counts, 1)
+        out = np.empty(self._sums.shape, dtype=out_dtype)
+        np.divide(self._sums, counts, out=out, casting='unsafe')
+        return out
+
+    def counts(self):
+        return self._counts
+
+    @property
+    def nbytes(self):
+        return self._sums.nbytes + self._counts.nbytes
+
+
+def to_runs(probs_map):
+    """
+    Run-length representation of the non-zero spans of a map (row-major).
+
+    Returns:
+        dict with the map 'shape', the flat 'starts' and 'lengths' of the
+        non-zero runs and their concatenated 'values'
+    """
+    flat = np.ravel(probs_map)
+    nonzero = np.concatenate(([False], flat != 0, [False]))
+    edges = np.flatnonzero(nonzero[1:] != nonzero[:-1])
+    starts, ends = edges[0::2], edges[1::2]
+    return {'shape': probs_map.shape,
+            'starts': starts.astype(np.int64),
+            'lengths': (ends - starts).astype(np.int64),
+            'values': flat[nonzero[1:-1]]}
+
+
+def from_runs(runs):
+    """
+    Dense map from its run-length representation
+    """
+    flat = np.zeros(int(np.prod(runs['shape'])), dtype=runs['values'].dtype)
+    if len(runs['starts']):
+        idx = np.repeat(runs['starts'] - np.cumsum(np.concatenate(([0], runs['lengths'][:-1]))),
+                        runs['lengths']) + np.arange(runs['values'].size)
+        flat[idx] = runs['values']
+    return flat.reshape(runs['shape'])
+
+
+def runs_nbytes(runs):
+    return runs['starts'].nbytes + runs['lengths'].nbytes + runs['values'].nbytes
+
+
+def memory_report(name, probs_map, accumulator=None):
+    """
+    Memory used by a stitched slide: float64 baseline, compact buffers and run-length form
+    """
+    runs = to_runs(probs_map)
+    report = {'slide': name,
+              'shape': list(probs_map.shape),
+              'nonzero_fraction': float(np.count_nonzero(probs_map)) / max(probs_map.size, 1),
+              'float64_dense_bytes': int(probs_map.size * 8),
+              'output_bytes': int(probs_map.nbytes),
+              'output_dtype': str(probs_map.dtype),
+              'run_length_bytes': int(runs_nbytes(runs)),
+              'runs': int(len(runs['starts']))}
+    if accumulator is not None:
+        report['accumulator_bytes'] = int(accumulator.nbytes)
+        # float64 sums and float64 counts, as allocated by np.zeros
+        report['float64_accumulator_bytes'] = int(accumulator.counts().size * 16)
+    return report
+
+
+def save_runs(path, probs_map):
+    """
+    Save a map in run-length form as an .npz file
+    """
+    runs = to_runs(probs_map)
+    np.savez(path, shape=np.array(runs['shape']), starts=runs['starts'],
+             lengths=runs['lengths'], values=runs['values'])
+
+
+def load_runs(path):
+    data = np.load(path)
+    return from_runs({'shape': tuple(data['shape']), 'starts': data['starts'],
+                      'lengths': data['lengths'], 'values': data['values']})
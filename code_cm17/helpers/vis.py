@@ -0,0 +1,69 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+def grid_to_single(image_batch, label_image=False):
+    shape = image_batch.shape
+    # print (shape)
+    n = int(np.sqrt(shape[0]))
+    x = shape[1]
+    y = shape[2]
+    if not label_image:
+        img_array = np.zeros((x*n,y*n,3))
+    else:
+        img_array = np.zeros((x*n,y*n))
+
+    # print (img_array.shape)
+    idx = 0
+    for i in range(n):
+        for j in range(n):
+            # print (i*x, (i+1)*x, j*y, (j+1)*y, idx)
+            # imshow(image_batch[idx])
+            if not label_image:
+                img_array[i*x: (i+1)*x, j*y: (j+1)*y, :] = image_batch[idx]
+            else:
+                img_array[i*x: (i+1)*x, j*y: (j+1)*y] = image_batch[idx]
+            idx=idx+1
+    return (img_array)
+
+def normalize_minmax(data):
+    """
+    Normalize contrast across volume
+    """
+    _min = np.float(np.min(data))
+    _max = np.float(np.max(data))
+    if (_max-_min)!=0:
+        img = (data - _min) / (_max-_min)
+    else:
+        img = np.zeros_like(data)            
+    return img
+    
+# Image Helper Functions
+def imshow(*args,**kwargs):
+    """ Handy function to show multiple plots in on row, possibly with different cmaps and titles
+    Usage:
+    imshow(img1, title="myPlot")
+    imshow(img1,img2, title=['title1','title2'])
+    imshow(img1,img2, cmap='hot')
+    imshow(img1,img2,cmap=['gray','Blues']) """
+    cmap = kwargs.get('cmap', 'gray')
+    title= kwargs.get('title','')
+    axis_off = kwargs.get('axis_off','')
+    if len(args)==0:
+        raise ValueError("No images given to imshow")
+    elif len(args)==1:
+        plt.title(title)
+        plt.imshow(args[0], interpolation='none')
+    else:
+        n=len(args)
+        if type(cmap)==str:
+            cmap = [cmap]*n
+        if type(title)==str:
+            title= [title]*n
+        plt.figure(figsize=(n*5,10))
+        for i in range(n):
+            plt.subplot(1,n,i+1)
+            plt.title(title[i])
+            plt.imshow(args[i], cmap[i])
+            if axis_off: 
+              plt.axis('off')  
+    plt.show()
@@ -0,0 +1,129 @@
+import sys
+import os
+import argparse
+import logging
+import json
+import time
+import numpy as np
+import openslide
+import tensorflow as tf
+from tensorflow.keras import backend as K
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from inference.probs_map import get_probs_map, make_dataloader
+from inference.tiled_probs_map import get_probs_map_tiled, load_fcn_model, load_tissue_mask
+np.random.seed(0)
+
+
+# python3 benchmark_tiled_inference.py /media/mak/mirlproject1/CAMELYON17/training/dataset/center_0/patient_004_node_4.tif /media/mak/Data/Projects/Camelyon17/saved_models/keras_models/segmentation/CM16/unet_densenet121_imagenet_pretrained_L0_20190712-173828/Model_Stage2.h5 ../configs/DenseNet121_UNET_NCRF_CM16_COORDS_CDL.json --out_json=./tiled_benchmark.json
+
+parser = argparse.ArgumentParser(description='Compare throughput and heatmap agreement of the'
+                                 ' large-tile inference against the overlapping patch inference')
+parser.add_argument('wsi_path', default=None, metavar='WSI_PATH', type=str,
+                    help='Path to the input WSI file')
+parser.add_argument('model_path', default=None, metavar='MODEL_PATH', type=str,
+                    help='Path to the saved model weights file of a Keras model')
+parser.add_argument('cfg_path', default=None, metavar='CFG_PATH', type=str,
+                    help='Path to the config file in json format related to'
+                    ' the ckpt file')
+parser.add_argument('--mask_path', default=None, metavar='MASK_PATH', type=str,
+                    help='Path to the tissue mask of the input WSI file')
+parser.add_argument('--model', default='densenet', type=str, choices=['densenet', 'inception'],
+                    help='Fully convolutional network the weights belong to, default densenet')
+parser.add_argument('--GPU', default='0', type=str, help='which GPU to use'
+                    ', default 0')
+parser.add_argument('--num_workers', default=5, type=int, help='number of '
+                    'workers to use to make batch for the patch path, default 5')
+parser.add_argument('--level', default=5, type=int, help='heatmap generation level,'
+                    ' default 5')
+parser.add_argument('--sampling_stride', default=16, type=int, help='Sampling pixels in tissue mask'
+                    ' for the patch path, default 16')
+parser.add_argument('--tile_size', default=4096, type=int, help='Size of the valid centre of'
+                    ' each tile at level 0, default 4096')
+parser.add_argument('--halo', default=None, type=int, help='Context added on every side of a'
+                    ' tile at level 0, default image_size//2 from the config')
+parser.add_argument('--threshold', default=0.5, type=float, help='Threshold used for the'
+                    ' dice agreement of the two heatmaps, default 0.5')
+parser.add_argument('--out_json', default=None, type=str, help='Path to save the benchmark'
+                    ' report in json format')
+
+
+def heatmap_agreement(probs_map_ref, probs_map_test, mask, threshold=0.5):
+    """
+    Agreement of two heatmaps over the tissue region
+    """
+    roi = mask > 0
+    ref = probs_map_ref[roi].astype(np.float64)
+    test = probs_map_test[roi].astype(np.float64)
+    abs_diff = np.abs(ref - test)
+    if ref.std() > 0 and test.std() > 0:
+        pearson = float(np.corrcoef(ref, test)[0, 1])
+    else:
+        pearson = float('nan')
+    ref_label = ref >= threshold
+    test_label = test >= threshold
+    label_sum = ref_label.sum() + test_label.sum()
+    dice_score = 1.0 if label_sum == 0 else 2.0 * np.logical_and(ref_label, test_label).sum() / label_sum
+    return {'mean_abs_diff': float(abs_diff.mean()) if abs_diff.size else 0.0,
+            'max_abs_diff': float(abs_diff.max()) if abs_diff.size else 0.0,
+            'pearson': pearson,
+            'dice_t{}'.format(threshold): float(dice_score)}
+
+
+def run(args):
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.GPU
+    logging.basicConfig(level=logging.WARNING)
+
+    with open(args.cfg_path) as f:
+        cfg = json.load(f)
+    halo = args.halo if args.halo is not None else cfg['image_size']//2
+
+    core_config = tf.ConfigProto()
+    core_config.gpu_options.allow_growth = True
+    session = tf.Session(config=core_config)
+    K.set_session(session)
+
+    model = load_fcn_model(args.model, args.model_path)
+    slide = openslide.OpenSlide(args.wsi_path)
+    mask = load_tissue_mask(slide, args.mask_path, args.level)
+    tissue_mpx = np.count_nonzero(mask) * pow(4, args.level) / 1e6
+
+    # Patch-overlap path
+    args.label_path = None
+    args.roi_masking = True
+    start = time.time()
+    dataloader = make_dataloader(args, cfg, flip='NONE', rotate='NONE')
+    probs_map_patch = get_probs_map(model, dataloader)
+    time_patch = time.time() - start
+    n_patches = len(dataloader) * dataloader.batch_size
+
+    # Large-tile path
+    start = time.time()
+    probs_map_tile = get_probs_map_tiled(model, slide, mask, args.level, tile_size=args.tile_size,
+                                         halo=halo, roi_masking=True)
+    time_tile = time.time() - start
+
+    report = {'wsi_path': args.wsi_path,
+              'level': args.level,
+              'tissue_megapixels_level_0': tissue_mpx,
+              'patch': {'image_size': cfg['image_size'], 'sampling_stride': args.sampling_stride,
+                        'patches': n_patches, 'seconds': time_patch,
+                        'tissue_megapixels_per_second': tissue_mpx / time_patch},
+              'tile': {'tile_size': args.tile_size, 'halo': halo, 'seconds': time_tile,
+                       'tissue_megapixels_per_second': tissue_mpx / time_tile},
+              'speedup': time_patch / time_tile,
+              'agreement': heatmap_agreement(probs_map_patch * (mask > 0), probs_map_tile, mask,
+                                             threshold=args.threshold)}
+    print (json.dumps(report, indent=1))
+    if args.out_json is not None:
+        with open(args.out_json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+def main():
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage as nd
+from skimage import measure
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from patch_extraction.annotation import Annotation
+
+parser = argparse.ArgumentParser(description='CAMELYON16 style FROC of the nms.py'
+                                 ' detections of a cohort against the lesion annotations')
+parser.add_argument('cohort_csv', default=None, metavar='COHORT_CSV', type=str,
+                    help='csv with the Image_Path and Mask_Path of every slide, Mask_Path a'
+                    ' label tif, an ASAP xml or a json annotation (empty for normal slides)')
+parser.add_argument('detections_path', default=None, metavar='DETECTIONS_PATH', type=str,
+                    help='Directory of the <slide>.csv detections (prob,x,y) written by nms.py')
+parser.add_argument('--out_csv', default=None, type=str, help='Path to save the FROC curve'
+                    ' (average false positives per slide, sensitivity, threshold)')
+parser.add_argument('--level', default=5, type=int, help='WSI level the lesions are'
+                    ' labelled at, default 5')
+parser.add_argument('--resolution', default=0.243, type=float, help='microns per level 0'
+                    ' pixel, default 0.243')
+parser.add_argument('--workers', default=4, type=int, help='number of processes evaluating'
+                    ' the slides, default 4')
+parser.add_argument('--cache_dir', default=None, type=str, help='directory of the labelled'
+                    ' lesions cache, default $CM17_FROC_CACHE or ~/.cache/cm17/froc')
+
+CACHE_ENV = 'CM17_FROC_CACHE'
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'cm17', 'froc')
+CACHE_VERSION = 2
+# lesions closer than 75 microns (5 tumor cells) are one lesion
+MERGE_DISTANCE_UM = 75
+# lesions whose major axis is below 275 microns are isolated tumor cells,
+# neither true nor false positives
+ITC_AXIS_UM = 275
+FP_RATES = (0.25, 0.5, 1, 2, 4, 8)
+
+
+def default_cache_dir():
+    return os.path.expanduser(os.environ.get(CACHE_ENV, DEFAULT_CACHE_DIR))
+
+
+def label_lesions(tumor_mask, level, resolution=0.243):
+    """
+    Evaluation mask of a binary [x, y] tumor mask at a level: the tumor is
+    dilated by half the merge distance (distance transform), holes filled,
+    and the connected components labelled (8-connectivity).
+
+    Returns:
+        (lesions, itc): [x, y] int32 labels (0 is background) and the sorted
+        labels of the isolated tumor cells
+    """
+    pixel_um = resolution * pow(2, level)
+    distance = nd.distance_transform_edt(~np.asarray(tumor_mask, dtype=bool))
+    filled = nd.binary_fill_holes(distance < MERGE_DISTANCE_UM / (pixel_um * 2))
+    lesions = measure.label(filled, connectivity=2).astype(np.int32)
+    itc = [region.label for region in measure.regionprops(lesions)
+           if region.major_axis_length < ITC_AXIS_UM / pixel_um]
+    return lesions, np.asarray(itc, dtype=np.int32)
+
+
+def read_tumor_mask(label_path, level, resolution=0.243):
+    """
+    Binary [x, y] tumor mask of a label tif, ASAP xml or json annotation at a level
+    """
+    downsample = pow(2, level)
+    if label_path.endswith('.xml') or label_path.endswith('.json'):
+        annotation = Annotation()
+        if label_path.endswith('.xml'):
+            annotation.from_xml(label_path)
+        else:
+            annotation.from_json(label_path)
+        vertices = annotation.polygon_vertices(is_positive=True)
+        if not vertices:
+            return np.zeros((1, 1), dtype=bool)
+        # the extent of the polygons, padded by the merge dilation of label_lesions,
+        # is enough for the hit tests
+        pad = int(np.ceil(MERGE_DISTANCE_UM / (2 * resolution * downsample))) + 1
+        extent = np.max([v.max(axis=0) for v in vertices], axis=0) // downsample + 2 + pad
+        return annotation.rasterize((int(extent[0]), int(extent[1])), downsample)
+    import openslide
+    slide = openslide.OpenSlide(label_path)
+    mask = np.array(slide.read_region((0, 0), level, slide.level_dimensions[level]).convert('L')).T > 0
+    slide.close()
+    return mask
+
+
+def cached_lesions(label_path, level, resolution=0.243, cache_dir=None):
+    """
+    label_lesions of a label, cached in cache_dir (cache_dir=False disables
+    the cache) under a key of the label path, size and modification time
+    and of the labelling parameters
+    """
+    if cache_dir is False:
+        return label_lesions(read_tumor_mask(label_path, level, resolution), level, resolution)
+    cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+    stat = os.stat(label_path)
+    config = json.dumps([CACHE_VERSION, os.path.abspath(label_path), stat.st_size, stat.st_mtime_ns,
+                         level, resolution, MERGE_DISTANCE_UM, ITC_AXIS_UM])
+    name = os.path.basename(label_path).split('.')[0]
+    path = os.path.join(cache_dir, '{}-{}.npz'.format(name, hashlib.sha1(config.encode()).hexdigest()[:16]))
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached['lesions'], cached['itc']
+    lesions, itc = label_lesions(read_tumor_mask(label_path, level, resolution), level, resolution)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # written under a temporary name and renamed, concurrent workers are harmless
+    tmp_path = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+    np.savez_compressed(tmp_path, lesions=lesions, itc=itc)
+    os.replace(tmp_path, path)
+    return lesions, itc
+
+
+def read_detections(path):
+    """
+    (probs, x, y) arrays of an nms.py csv, level 0 coordinates
+    """
+    if os.path.getsize(path) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    data = np.loadtxt(path, delimiter=',', ndmin=2)
+    return data[:, 0], data[:, 1].astype(np.int64), data[:, 2].astype(np.int64)
+
+
+def hit_test(probs, x, y, lesions, itc, level):
+    """
+    Scores of the detections of a slide: each lesion (isolated tumor cells
+    excluded) is scored by the highest detection inside it, 0 if missed,
+    detections outside every lesion are false positives, the others
+    (second hits, hits of isolated tumor cells) are ignored.
+
+    Returns:
+        (fp_probs, lesion_probs)
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    if lesions is None:
+        return probs, np.zeros(0)
+    downsample = pow(2, level)
+    X, Y = lesions.shape
+    # detections outside the labelled extent are background
+    inside = (x >= 0) & (y >= 0) & (x // downsample < X) & (y // downsample < Y)
+    hits = np.zeros(len(probs), dtype=np.int64)
+    hits[inside] = lesions[x[inside] // downsample, y[inside] // downsample]
+    lesion_probs = np.zeros(int(lesions.max()) + 1)
+    np.maximum.at(lesion_probs, hits, probs)
+    counted = np.ones(len(lesion_probs), dtype=bool)
+    counted[0] = False
+    counted[itc] = False
+    return probs[hits == 0], lesion_probs[counted]
+
+
+def evaluate_slide(detections_path, label_path, level=5, resolution=0.243, cache_dir=None):
+    """
+    (fp_probs, lesion_probs) of a slide, label_path None for a normal slide
+    """
+    probs, x, y = read_detections(detections_path)
+    if label_path is None:
+        return hit_test(probs, x, y, None, None, level)
+    lesions, itc = cached_lesions(label_path, level, resolution, cache_dir)
+    return hit_test(probs, x, y, lesions, itc, level)
+
+
+def compute_froc(fp_probs, lesion_probs, n_slides):
+    """
+    FROC curve of a cohort from the false positive scores and the lesion
+    scores of all its slides (a missed lesion scores 0), every distinct
+    score a threshold, counted with sorted searches.
+
+    Returns:
+        (average false positives per slide, sensitivity, thresholds), sorted by
+        decreasing threshold
+    """
+    fp_probs = np.sort(np.asarray(fp_probs, dtype=np.float64))
+    lesion_probs = np.sort(np.asarray(lesion_probs, dtype=np.float64))
+    thresholds = np.unique(np.concatenate([fp_probs, lesion_probs]))
+    # a 0 score is never a detection
+    thresholds = thresholds[thresholds > 0][::-1]
+    fps = len(fp_probs) - np.searchsorted(fp_probs, thresholds, side='left')
+    tps = len(lesion_probs) - np.searchsorted(lesion_probs, thresholds, side='left')
+    # the curve starts at (0, 0), above every detection
+    fps = np.concatenate([[0], fps]) / float(max(n_slides, 1))
+    sensitivity = np.concatenate([[0], tps]) / float(max(len(lesion_probs), 1))
+    thresholds = np.concatenate([[np.inf], thresholds])
+    return fps, sensitivity, thresholds
+
+
+def froc_score(fps, sensitivity, rates=FP_RATES):
+    """
+    Mean sensitivity at the average false positives per slide rates,
+    (score, [sensitivity at each rate])
+    """
+    at_rates = np.interp(rates, fps, sensitivity)
+    return float(np.mean(at_rates)), at_rates
+
+
+def _evaluate(job):
+    return evaluate_slide(*job)
+
+
+def run(args):
+    with open(args.cohort_csv) as f:
+        rows = list(csv.DictReader(f))
+    jobs = []
+    for row in rows:
+        slide_name = os.path.basename(row['Image_Path']).split('.')[0]
+        label_path = row.get('Mask_Path') or None
+        if label_path == 'empty':
+            label_path = None
+        jobs.append((os.path.join(args.detections_path, slide_name + '.csv'), label_path,
+                     args.level, args.resolution, args.cache_dir))
+
+    start = time.time()
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(_evaluate, jobs))
+    else:
+        results = [_evaluate(job) for job in jobs]
+    fp_probs = np.concatenate([fp for fp, _ in results]) if results else np.zeros(0)
+    lesion_probs = np.concatenate([lesion for _, lesion in results]) if results else np.zeros(0)
+    fps, sensitivity, thresholds = compute_froc(fp_probs, lesion_probs, len(jobs))
+    score, at_rates = froc_score(fps, sensitivity)
+
+    logging.info('{} slides, {} lesions, {} false positives, {:.2f}s'.format(
+        len(jobs), len(lesion_probs), len(fp_probs), time.time() - start))
+    for rate, value in zip(FP_RATES, at_rates):
+        logging.info('Sensitivity at {} FP/slide: {:.4f}'.format(rate, value))
+    logging.info('FROC score: {:.4f}'.format(score))
+    if args.out_csv is not None:
+        with open(args.out_csv, 'w') as f:
+            out = csv.writer(f)
+            out.writerow(('avg_fps', 'sensitivity', 'threshold'))
+            for row in zip(fps, sensitivity, thresholds):
+                out.writerow(row)
+    return score
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
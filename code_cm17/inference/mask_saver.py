@@ -24,8 +24,6 @@ from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import ModelCheckpoint, LearningRateScheduler, TensorBoard
 from tensorflow.keras import metrics
 
-from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms  # noqa
 
 import sklearn.metrics
 import io
@@ -41,6 +39,7 @@ import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.getcwd())))
 from models.seg_models import get_inception_resnet_v2_unet_softmax, unet_densenet121
 from models.deeplabv3p_original import Deeplabv3
+from dataloader.shared_batches import SharedBatchLoader
 # Random Seeds
 np.random.seed(0)
 random.seed(0)
@@ -301,7 +300,7 @@ def calc_jacc_score(x,y,smoothing=1):
 
 
 # DataLoader Implementation
-class WSIStridedPatchDataset(Dataset):
+class WSIStridedPatchDataset(object):
     """
     Data producer that generate all the square grids, e.g. 3x3, of patches,
     from a WSI and its tissue mask, and their corresponding indices with
@@ -526,7 +525,7 @@ for i,wsi_path in enumerate(wsi_paths):
                                         flip=None, rotate=None,
                                         level=level, sampling_stride=sampling_stride//16, roi_masking=True)
 
-    dataloader = DataLoader(dataset_obj, batch_size=batch_size, num_workers=0, drop_last=True)
+    dataloader = SharedBatchLoader(dataset_obj, batch_size=batch_size, num_workers=0, drop_last=True)
     dataset_obj.save_scaled_imgs()
     out_file = wsi_path.split('/')[-1].split('.')[0]
     # out_file = sample_id
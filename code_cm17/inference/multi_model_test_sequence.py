@@ -21,13 +21,16 @@ from scipy import stats
 from tensorflow.keras import backend as K
 from skimage.transform import resize, rescale
 from scipy import ndimage
-from torch.utils.data import DataLoader
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 from helpers.utils import *
+from helpers.probs_map_store import ProbsMapStore, save_probs_map
+from helpers.stitching import StitchAccumulator, memory_report, save_runs
+from helpers.profiling import get_profiler, enable_profiling, save_run_report
+from helpers.dihedral import DIHEDRAL_GROUP, dihedral, inverse_dihedral, from_pil, tta_predict
 from dataloader.inference_data_loader import WSIStridedPatchDataset
-from models.seg_models import get_inception_resnet_v2_unet_softmax, unet_densenet121
-from models.deeplabv3p_original import Deeplabv3
+from dataloader.shared_batches import SharedBatchLoader, normalize_batch
+from models.registry import load_model
 from models.utils import do_crf
 from collections import OrderedDict
 np.random.seed(0)
@@ -46,6 +49,9 @@ parser.add_argument('model_path_DLv3p', default=None, metavar='MODEL_PATH', type
                     help='Path to the saved model weights file of a Keras model')
 parser.add_argument('--GPU', default='0', type=str, help='which GPU to use'
                     ', default 0')
+parser.add_argument('--model_cache', default=None, type=str, help='directory of the'
+                    ' fast-loading model artifacts, default $CM17_MODEL_CACHE or'
+                    ' ~/.cache/cm17/models')
 parser.add_argument('--num_workers', default=4, type=int, help='number of '
                     'workers to use to make batch, default 5')
 parser.add_argument('--level', default=6, type=int, help='heatmap generation level,'
@@ -57,44 +63,38 @@ parser.add_argument('--radius', default=12, type=int, help='radius for nms,'
                     ' i.e. inference stride = 128)')
 parser.add_argument('--roi_masking', default=True, type=int, help='Sample pixels from tissue mask region,'
                     ' default True, points are not sampled from glass region')
+parser.add_argument('--save_store', default=0, type=int, help='Save the ensemble maps as chunked'
+                    ' multi-level stores instead of numpy files, default 0')
+parser.add_argument('--store_dtype', default='uint8', type=str, choices=['uint8', 'float16', 'float32'],
+                    help='Quantization of the chunked store, default uint8')
+parser.add_argument('--store_levels', default=4, type=int, help='Number of 2x down-sampled levels'
+                    ' of the chunked store, default 4')
+parser.add_argument('--sum_dtype', default='float32', type=str, help='dtype of the stitching'
+                    ' sum buffers, default float32')
+parser.add_argument('--count_dtype', default='uint16', type=str, help='dtype of the stitching'
+                    ' count buffers, default uint16')
+parser.add_argument('--out_dtype', default='float32', type=str, choices=['float32', 'float16'],
+                    help='dtype of the normalized probability maps, default float32')
+parser.add_argument('--save_runs', default=0, type=int, help='Save the per model maps in run-length'
+                    ' form (.npz) instead of dense numpy files, default 0')
+parser.add_argument('--tta', default=0, type=int, help='Average the predictions of every batch over'
+                    ' the 8 flip/rotate transforms, default 0')
+parser.add_argument('--profile_dir', default=None, type=str, help='Record per slide and stage timings,'
+                    ' counters and peak RSS into this directory (report.json, report.csv, trace.json)')
 
 
 def forward_transform(data, flip, rotate):
     """
-    Do inverse data augmentation
+    Do data augmentation of a patch (H x W x C), as the dataset does
     """
-    if flip == 'FLIP_LEFT_RIGHT':
-        data = np.fliplr(data)
-
-    if rotate == 'ROTATE_90':
-        data = np.rot90(data, 1)
-
-    if rotate == 'ROTATE_180':
-        data = np.rot90(data, 2)
-
-    if rotate == 'ROTATE_270':
-        data = np.rot90(data, 3)
-
-    return data
+    return dihedral(data, *from_pil(flip, rotate), axes=(0, 1))
 
 
 def inverse_transform(data, flip, rotate):
     """
-    Do inverse data augmentation
+    Do inverse data augmentation of a patch prediction (H x W x C)
     """
-    if flip == 'FLIP_LEFT_RIGHT':
-        data = np.fliplr(data)
-
-    if rotate == 'ROTATE_90':
-        data = np.rot90(data, 3)
-
-    if rotate == 'ROTATE_180':
-        data = np.rot90(data, 2)
-
-    if rotate == 'ROTATE_270':
-        data = np.rot90(data, 1)
-
-    return data
+    return inverse_dihedral(data, *from_pil(flip, rotate), axes=(0, 1))
 
 def get_index(coord_ax, probs_map_shape_ax, grid_ax):
     """
@@ -216,8 +216,10 @@ def get_wsi_cases(args, train_mode, model_name, dataset_name, patient_range, gro
             path_dic['model1_path'] = model1_npy_path + '/patient_{:03d}_node_{}.npy'.format(i,j)
             path_dic['model2_path'] = model2_npy_path + '/patient_{:03d}_node_{}.npy'.format(i,j)
             path_dic['model3_path'] = model3_npy_path + '/patient_{:03d}_node_{}.npy'.format(i,j)
-            path_dic['ensemble_model_path'] = ensemble_model_npy_path + '/patient_{:03d}_node_{}.npy'.format(i,j)
-            path_dic['crf_model_path'] = crf_model_npy_path + '/patient_{:03d}_node_{}.npy'.format(i,j)
+            # chunked stores are directories without the .npy extension
+            map_ext = '' if args.save_store else '.npy'
+            path_dic['ensemble_model_path'] = ensemble_model_npy_path + '/patient_{:03d}_node_{}'.format(i,j) + map_ext
+            path_dic['crf_model_path'] = crf_model_npy_path + '/patient_{:03d}_node_{}'.format(i,j) + map_ext
             path_dic['png_ensemble_path'] = png_base_path + '/patient_{:03d}_node_{}_ensemble.png'.format(i,j)
             path_dic['png_ensemble_crf_path'] = png_base_path + '/patient_{:03d}_node_{}_ensemble_crf.png'.format(i,j)
             path_dic['csv_ensemble_path'] = csv_base_path + '/patient_{:03d}_node_{}.csv'.format(i,j)
@@ -228,17 +230,32 @@ def get_wsi_cases(args, train_mode, model_name, dataset_name, patient_range, gro
 
     return wsi_dic
 
+def load_preview(probs_map_path):
+    '''
+    Load a probability map for visualization, chunked stores are read at their coarsest level
+    '''
+    if probs_map_path.endswith('.npy'):
+        return np.load(probs_map_path)
+    store = ProbsMapStore(probs_map_path)
+    return store.read(level=store.n_levels - 1)
+
 def rescale_image_intensity(image, factor=128):
     return np.uint8(image*128+128)
 
-def get_probs_map(model_dic, dataloader, count_map_enabled=True):
+def get_probs_map(model_dic, dataloader, count_map_enabled=True, sum_dtype='float32', count_dtype='uint16',
+                  out_dtype='float32', tta=None):
     """
-    Generate probability map
+    Generate probability map, with tta (dihedral (k, flip) elements, e.g.
+    DIHEDRAL_GROUP) the predictions of every batch are averaged over the
+    transformed batches
+
+    Returns the (n_models, X, Y) maps in out_dtype, the CRF label maps and the
+    stitching memory report of the slide.
     """
     n_models = len(model_dic)
-    probs_map = np.zeros((n_models,) + dataloader.dataset._mask.shape)
+    accumulator = StitchAccumulator(dataloader.dataset._mask.shape, n_maps=n_models,
+                                    sum_dtype=sum_dtype, count_dtype=count_dtype)
     label_map_t50 = np.zeros((n_models,) + dataloader.dataset._mask.shape, dtype=np.uint8)
-    count_map = np.zeros((n_models,) + dataloader.dataset._mask.shape, dtype='uint8')
     num_batch = len(dataloader)
     batch_size = dataloader.batch_size
     map_x_size = dataloader.dataset._mask.shape[0]
@@ -247,29 +264,42 @@ def get_probs_map(model_dic, dataloader, count_map_enabled=True):
     # factor = dataloader.dataset._sampling_stride
     factor =  dataloader.dataset._image_size//pow(2, level)
     down_scale = 1.0 / pow(2, level)
+    dataset_transform = from_pil(dataloader.dataset._flip, dataloader.dataset._rotate)
+    n_predictions = 1 if tta is None else len(tta)
     count = 0
     time_now = time.time()
+    profiler = get_profiler()
 
     for (image_patches, x_coords, y_coords, label_patches) in dataloader:
-        image_patches = image_patches.cpu().data.numpy()
-        label_patches = label_patches.cpu().data.numpy()
-        x_coords = x_coords.cpu().data.numpy()
-        y_coords = y_coords.cpu().data.numpy()
+        # uint8 views of the shared batch ring, normalized once per batch
+        with profiler.stage('normalize'):
+            image_patches = normalize_batch(image_patches)
         batch_size = image_patches.shape[0]
         for j in range(len(model_dic)):
-            y_preds = model_dic[j].predict(image_patches, batch_size=batch_size, verbose=1, steps=None)         
+            with profiler.stage('predict', patches=batch_size * n_predictions):
+                if tta is None:
+                    y_preds = model_dic[j].predict(image_patches, batch_size=batch_size, verbose=1, steps=None)
+                else:
+                    y_preds = tta_predict(lambda batch: model_dic[j].predict(batch, batch_size=batch_size, verbose=1,
+                                                                             steps=None), image_patches, tta)
+            # back to the orientation of the slide, image_patches too for the CRF
+            y_preds = inverse_dihedral(y_preds, *dataset_transform)
+            image_patches_slide = inverse_dihedral(image_patches, *dataset_transform)
             for i in range(batch_size):
+                rescale_start = time.time()
                 y_preds_rescaled = rescale(y_preds[i], down_scale, anti_aliasing=False)
+                stitch_start = time.time()
+                profiler.add_time('rescale', rescale_start, stitch_start - rescale_start)
                 xmin, xmax = get_index(x_coords[i], map_x_size, factor)
                 ymin, ymax = get_index(y_coords[i], map_y_size, factor)
-                probs_map[j, x_coords[i] - xmin: x_coords[i] + xmax, y_coords[i] - ymin: y_coords[i] + ymax] +=\
-                y_preds_rescaled[:,:,1].T[0:xmin+xmax, 0:ymin+ymax]
-                count_map[j, x_coords[i] - xmin: x_coords[i] + xmax, y_coords[i] - ymin: y_coords[i] + ymax] +=\
-                 np.ones_like(y_preds_rescaled[:,:,1].T[0:xmin+xmax, 0:ymin+ymax], dtype='uint8')
+                accumulator.add(x_coords[i] - xmin, y_coords[i] - ymin,
+                                y_preds_rescaled[:,:,1].T[0:xmin+xmax, 0:ymin+ymax], map_idx=j)
+                profiler.add_time('stitch', stitch_start, time.time() - stitch_start)
                 label_t50 = labelthreshold(y_preds[i][:,:,1], threshold=.5)
                 if np.sum(label_t50) >0:
-                    MAP = do_crf(rescale_image_intensity(image_patches[i]), np.argmax(y_preds[i], axis=2), 2, enable_color=True, zero_unsure=False) 
-                    MAP_rescaled = rescale(MAP, down_scale, order=0, preserve_range=True)
+                    with profiler.stage('crf'):
+                        MAP = do_crf(rescale_image_intensity(image_patches_slide[i]), np.argmax(y_preds[i], axis=2), 2, enable_color=True, zero_unsure=False) 
+                        MAP_rescaled = rescale(MAP, down_scale, order=0, preserve_range=True)
                 else:
                     MAP_rescaled = np.zeros_like(y_preds_rescaled[:,:,1])
                 label_map_t50[j, x_coords[i] - xmin: x_coords[i] + xmax, y_coords[i] - ymin: y_coords[i] + ymax] =\
@@ -280,23 +310,46 @@ def get_probs_map(model_dic, dataloader, count_map_enabled=True):
         print ('{}, batch : {}/{}, Run Time : {:.2f}'
             .format(
                 time.strftime("%Y-%m-%d %H:%M:%S"), count, num_batch, time_spent))
-    # imshow(count_map[0].T, count_map[1].T, count_map[2].T)        
-    np.place(count_map, count_map==0, 1)
-    probs_map /= count_map
+    probs_map = accumulator.result(out_dtype)
     # imshow(dataloader.dataset._gt.T, probs_map[0].T, probs_map[1].T, probs_map[2].T, np.mean(probs_map, axis=0).T)
+    report = memory_report(os.path.basename(dataloader.dataset._wsi_path), np.mean(probs_map, axis=0), accumulator)
+    report['label_map_bytes'] = int(label_map_t50.nbytes)
+    print ('Stitching memory:', report)
 
-    return probs_map, label_map_t50
+    return probs_map, label_map_t50, report
 
 def make_dataloader(wsi_path, mask_path, label_path, args, cfg, flip='NONE', rotate='NONE'):
     batch_size = cfg['batch_size']
-    dataloader = DataLoader(WSIStridedPatchDataset(wsi_path, mask_path,
-                            label_path,
-                            image_size=cfg['image_size'],
-                            normalize=True, flip=flip, rotate=rotate,
-                            level=args.level, sampling_stride=args.sampling_stride, roi_masking=args.roi_masking),
-                            batch_size=batch_size, num_workers=args.num_workers, drop_last=False)
+    dataloader = SharedBatchLoader(WSIStridedPatchDataset(wsi_path, mask_path,
+                                   label_path,
+                                   image_size=cfg['image_size'],
+                                   normalize=True, flip=flip, rotate=rotate,
+                                   level=args.level, sampling_stride=args.sampling_stride, roi_masking=args.roi_masking),
+                                   batch_size=batch_size, num_workers=args.num_workers, drop_last=False)
     return dataloader
 
+def load_models(args, image_size):
+    """
+    Load the segmentation models given on the command line, keyed 0, 1, 2
+    """
+    model_dic = {}
+    if args.model_path_DFCN is not None:
+        model = load_model('unet_densenet121', args.model_path_DFCN, (image_size, image_size),
+                           cache_dir=args.model_cache)
+        print ("Loaded Model Weights from", args.model_path_DFCN)
+        model_dic[0] = model
+    if args.model_path_IRFCN is not None:
+        model = load_model('inception_resnet_v2_unet', args.model_path_IRFCN, (image_size, image_size),
+                           cache_dir=args.model_cache)
+        print ("Loaded Model Weights from", args.model_path_IRFCN)
+        model_dic[1] = model
+    if args.model_path_DLv3p is not None:
+        model = load_model('deeplabv3p', args.model_path_DLv3p, (image_size, image_size),
+                           cache_dir=args.model_cache, OS=16)
+        print ("Loaded Model Weights from", args.model_path_DLv3p)
+        model_dic[2] = model
+    return model_dic
+
 def run(args):
     os.environ["CUDA_VISIBLE_DEVICES"] = args.GPU
     logging.basicConfig(level=logging.INFO)
@@ -309,70 +362,77 @@ def run(args):
     with open(args.cfg_path) as f:
         cfg = json.load(f)
 
-    model_dic = {}
     batch_size = cfg['batch_size']
     image_size = cfg['image_size']
-
-    if args.model_path_DFCN is not None:
-        model = unet_densenet121((image_size, image_size), weights=None)
-        model.load_weights(args.model_path_DFCN)
-        print ("Loaded Model Weights from", args.model_path_DFCN)
-        model_dic[0] = model
-    if args.model_path_IRFCN is not None:
-        model = get_inception_resnet_v2_unet_softmax((image_size, image_size), weights=None)
-        model.load_weights(args.model_path_IRFCN)
-        print ("Loaded Model Weights from", args.model_path_IRFCN)
-        model_dic[1] = model
-    if args.model_path_DLv3p is not None:
-        model = Deeplabv3(input_shape=(image_size, image_size, 3), weights=None,\
-                          classes=2,  activation = 'softmax', backbone='xception', OS=16)
-        model.load_weights(args.model_path_DLv3p)
-        print ("Loaded Model Weights from", args.model_path_DLv3p)
-        model_dic[2] = model
+    model_dic = load_models(args, image_size)
+    profiler = enable_profiling(args.profile_dir) if args.profile_dir is not None else get_profiler()
 
     wsi_dic = get_wsi_cases(args, train_mode=False, model_name='Ensemble', dataset_name='CM17_Train', patient_range=(100,125), group_range=(0,5))
+    # per slide memory used by the stitching buffers and the maps
+    memory_report_path = os.path.join(os.path.dirname(os.path.dirname(wsi_dic[next(iter(wsi_dic))]['model1_path'])),
+                                      'memory_report.json')
+    memory_reports = OrderedDict()
+    if os.path.exists(memory_report_path):
+        with open(memory_report_path) as f:
+            memory_reports.update(json.load(f))
 
     for key in wsi_dic.keys():
-        print ('Working on:', key)
-        wsi_path = wsi_dic[key]['wsi_path']
-        label_path = wsi_dic[key]['label_path']
-        mask_path = wsi_dic[key]['tissue_mask_path_v2']
-
-        if not os.path.exists(wsi_dic[key]['ensemble_model_path']):
-            dataloader = make_dataloader(wsi_path, mask_path, label_path, args, cfg, flip='NONE', rotate='NONE')
-            probs_map, label_t50_map = get_probs_map(model_dic, dataloader)
-
-            # Saving the results
-            np.save(wsi_dic[key]['model1_path'], probs_map[0])
-            np.save(wsi_dic[key]['model2_path'], probs_map[1])
-            np.save(wsi_dic[key]['model3_path'], probs_map[2])
-            ensemble_prob_map = np.mean(probs_map, axis=0)
-            np.save(wsi_dic[key]['ensemble_model_path'], ensemble_prob_map)
-            voted_label_t50_map = np.sum(label_t50_map, axis=0)
-            np.place(voted_label_t50_map, voted_label_t50_map==1,0) 
-            np.place(voted_label_t50_map, voted_label_t50_map>1,1) 
-            crf_ensemble_prob_map = ensemble_prob_map*voted_label_t50_map
-            np.save(wsi_dic[key]['crf_model_path'], crf_ensemble_prob_map)
-
-        if not os.path.exists(wsi_dic[key]['png_ensemble_path']):
-            im = np.load(wsi_dic[key]['ensemble_model_path'])
-            plt.imshow(im.T, cmap='jet')
-            plt.savefig(wsi_dic[key]['png_ensemble_path'])
-            im = np.load(wsi_dic[key]['crf_model_path'])
-            plt.imshow(im.T, cmap='jet')
-            plt.savefig(wsi_dic[key]['png_ensemble_crf_path'])
-
-        if not os.path.exists(wsi_dic[key]['csv_ensemble_path']):
-            nms_command = 'python3 nms.py'+' '+wsi_dic[key]['ensemble_model_path']+' '+wsi_dic[key]['csv_ensemble_path']+\
-                        ' '+wsi_dic[key]['xml_ensemble_path']+' --level='+str(args.level)+' --radius='+str(args.radius)
-            print (nms_command)
-            os.system(nms_command)
-
-        if not os.path.exists(wsi_dic[key]['csv_ensemble_crf_path']):
-            nms_command = 'python3 nms.py'+' '+wsi_dic[key]['crf_model_path']+' '+wsi_dic[key]['csv_ensemble_crf_path']+\
-                        ' '+wsi_dic[key]['xml_ensemble_crf_path']+' --level='+str(args.level)+' --radius='+str(args.radius)
-            print (nms_command)
-            os.system(nms_command)  
+        with profiler.slide(key):
+            print ('Working on:', key)
+            wsi_path = wsi_dic[key]['wsi_path']
+            label_path = wsi_dic[key]['label_path']
+            mask_path = wsi_dic[key]['tissue_mask_path_v2']
+
+            if not os.path.exists(wsi_dic[key]['ensemble_model_path']):
+                dataloader = make_dataloader(wsi_path, mask_path, label_path, args, cfg, flip='NONE', rotate='NONE')
+                probs_map, label_t50_map, memory_reports[key] = get_probs_map(model_dic, dataloader,
+                                                                              sum_dtype=args.sum_dtype,
+                                                                              count_dtype=args.count_dtype,
+                                                                              out_dtype=args.out_dtype,
+                                                                              tta=DIHEDRAL_GROUP if args.tta else None)
+                with open(memory_report_path, 'w') as f:
+                    json.dump(memory_reports, f, indent=1)
+
+                # Saving the results
+                save_start = time.time()
+                for idx, model_key in enumerate(['model1_path', 'model2_path', 'model3_path']):
+                    if args.save_runs:
+                        save_runs(wsi_dic[key][model_key].replace('.npy', '_runs.npz'), probs_map[idx])
+                    else:
+                        np.save(wsi_dic[key][model_key], probs_map[idx])
+                ensemble_prob_map = np.mean(probs_map, axis=0)
+                save_probs_map(wsi_dic[key]['ensemble_model_path'], ensemble_prob_map, dtype=args.store_dtype,
+                               n_levels=args.store_levels, scale=pow(2, args.level))
+                voted_label_t50_map = np.sum(label_t50_map, axis=0)
+                np.place(voted_label_t50_map, voted_label_t50_map==1,0) 
+                np.place(voted_label_t50_map, voted_label_t50_map>1,1) 
+                crf_ensemble_prob_map = ensemble_prob_map*voted_label_t50_map
+                save_probs_map(wsi_dic[key]['crf_model_path'], crf_ensemble_prob_map, dtype=args.store_dtype,
+                               n_levels=args.store_levels, scale=pow(2, args.level))
+                profiler.add_time('save', save_start, time.time() - save_start)
+
+            if not os.path.exists(wsi_dic[key]['png_ensemble_path']):
+                im = load_preview(wsi_dic[key]['ensemble_model_path'])
+                plt.imshow(im.T, cmap='jet')
+                plt.savefig(wsi_dic[key]['png_ensemble_path'])
+                im = load_preview(wsi_dic[key]['crf_model_path'])
+                plt.imshow(im.T, cmap='jet')
+                plt.savefig(wsi_dic[key]['png_ensemble_crf_path'])
+
+            if not os.path.exists(wsi_dic[key]['csv_ensemble_path']):
+                nms_command = 'python3 nms.py'+' '+wsi_dic[key]['ensemble_model_path']+' '+wsi_dic[key]['csv_ensemble_path']+\
+                            ' '+wsi_dic[key]['xml_ensemble_path']+' --level='+str(args.level)+' --radius='+str(args.radius)
+                print (nms_command)
+                with profiler.stage('nms'):
+                    os.system(nms_command)
+
+            if not os.path.exists(wsi_dic[key]['csv_ensemble_crf_path']):
+                nms_command = 'python3 nms.py'+' '+wsi_dic[key]['crf_model_path']+' '+wsi_dic[key]['csv_ensemble_crf_path']+\
+                            ' '+wsi_dic[key]['xml_ensemble_crf_path']+' --level='+str(args.level)+' --radius='+str(args.radius)
+                print (nms_command)
+                with profiler.stage('nms'):
+                    os.system(nms_command)  
+    save_run_report(profiler)
 
 def main():
     t0 = timeit.default_timer()
@@ -3,17 +3,18 @@ import os
 import argparse
 
 import numpy as np
-from skimage import filters
-import openslide
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
-from helpers.utils import GenerateXMLfromCSV
+from helpers.io_utils import GenerateXMLfromCSV
+from helpers.probs_map_store import ProbsMapStore, is_probs_map_store
+from helpers.sparse_heatmap import BlockSparseHeatmap
 
 
 parser = argparse.ArgumentParser(description='Generate predicted coordinates'
                                  ' from probability map of tumor patch'
                                  ' predictions, using non-maximal suppression')
 parser.add_argument('probs_map_path', default=None, metavar='PROBS_MAP_PATH',
-                    type=str, help='Path to the input probs_map numpy file')
+                    type=str, help='Path to the input probs_map numpy file, block-sparse'
+                    ' (.npz) file or chunked store')
 parser.add_argument('coord_path', default=None, metavar='COORD_PATH',
                     type=str, help='Path to the output coordinates csv file')
 parser.add_argument('xml_path', default=None, metavar='XML_PATH',
@@ -29,24 +30,43 @@ parser.add_argument('--prob_thred', default=0.5, type=float,
 parser.add_argument('--sigma', default=0, type=float,
                     help='sigma for Gaussian filter smoothing, default 0.0,'
                     ' which means disabled')
+parser.add_argument('--store_level', default=0, type=int, help='pyramid level to read when'
+                    ' the probs_map is a chunked store, default 0')
+parser.add_argument('--block_size', default=64, type=int, help='block size of the sparse'
+                    ' map the suppression runs on, default 64')
 
 
 # python3 nms.py ./patient_004_node_4.npy ./patient_004_node_4.csv ./patient_004_node_4.xml
 # python3 nms.py ./patient_099_node_4.npy ./patient_099_node_4.csv ./patient_099_node_4.xml
 def run(args):
-    probs_map = np.load(args.probs_map_path)
+    if is_probs_map_store(args.probs_map_path):
+        # only the chunks of the requested level that can hold a detection are read
+        store = ProbsMapStore(args.probs_map_path)
+        min_value = args.prob_thred if args.sigma == 0 else None
+        probs_map = store.read(level=args.store_level, min_value=min_value)
+        resolution = store.scale(args.store_level)
+    elif args.probs_map_path.endswith('.npz'):
+        probs_map = BlockSparseHeatmap.load(args.probs_map_path)
+        resolution = pow(2, args.level)
+    else:
+        probs_map = np.load(args.probs_map_path)
+        resolution = pow(2, args.level)
     # print (np.unique(probs_map))
     X, Y = probs_map.shape
-    resolution = pow(2, args.level)
 
     if args.sigma > 0:
+        if isinstance(probs_map, BlockSparseHeatmap):
+            probs_map = probs_map.to_dense()
+        from skimage import filters
         probs_map = filters.gaussian(probs_map, sigma=args.sigma)
+    if not isinstance(probs_map, BlockSparseHeatmap):
+        # max-finding and suppression only touch the blocks holding tissue predictions
+        probs_map = BlockSparseHeatmap.from_dense(probs_map, args.block_size)
 
     outfile = open(args.coord_path, 'w')
-    while np.max(probs_map) > args.prob_thred:
+    while probs_map.max() > args.prob_thred:
         prob_max = probs_map.max()
-        max_idx = np.where(probs_map == prob_max)
-        x_mask, y_mask = max_idx[0][0], max_idx[1][0]
+        x_mask, y_mask = probs_map.argmax()
         x_wsi = int((x_mask + 0.5) * resolution)
         y_wsi = int((y_mask + 0.5) * resolution)
         outfile.write('{:0.5f},{},{}'.format(prob_max, x_wsi, y_wsi) + '\n')
@@ -56,9 +76,7 @@ def run(args):
         y_min = y_mask - args.radius if y_mask - args.radius > 0 else 0
         y_max = y_mask + args.radius if y_mask + args.radius <= Y else Y
 
-        for x in range(x_min, x_max):
-            for y in range(y_min, y_max):
-                probs_map[x, y] = 0
+        probs_map.zero_window(x_min, x_max, y_min, y_max)
 
     outfile.close()
     GenerateXMLfromCSV(args.coord_path, args.xml_path)
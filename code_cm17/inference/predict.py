@@ -25,8 +25,6 @@ from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import ModelCheckpoint, LearningRateScheduler, TensorBoard
 from tensorflow.keras import metrics
 
-from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms  # noqa
 
 import sklearn.metrics
 import io
@@ -41,8 +39,9 @@ from skimage.filters import threshold_otsu
 
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.getcwd())))
-from models.seg_models import get_inception_resnet_v2_unet_softmax, unet_densenet121
-from models.deeplabv3p_original import Deeplabv3
+from models.registry import load_model
+from helpers.profiling import get_profiler, enable_profiling, save_run_report
+from dataloader.shared_batches import SharedBatchLoader
 
 # Random Seeds
 np.random.seed(0)
@@ -295,7 +294,7 @@ def calc_jacc_score(x,y,smoothing=1):
     return (numerator+smoothing)/(denominator+smoothing)
 
 # DataLoader Implementation
-class WSIStridedPatchDataset(Dataset):
+class WSIStridedPatchDataset(object):
     """
     Data producer that generate all the square grids, e.g. 3x3, of patches,
     from a WSI and its tissue mask, and their corresponding indices with
@@ -482,20 +481,17 @@ class WSIStridedPatchDataset(Dataset):
 
 
 def load_incep_resnet(model_path):
-    model = get_inception_resnet_v2_unet_softmax((None, None), weights=None)
-    model.load_weights(model_path)
+    model = load_model('inception_resnet_v2_unet', model_path)
     print ("Loaded Model Weights %s" % model_path)
     return model
 
 def load_unet_densenet(model_path):
-    model = unet_densenet121((None, None), weights=None)
-    model.load_weights(model_path)
+    model = load_model('unet_densenet121', model_path)
     print ("Loaded Model Weights %s" % model_path)
     return model
 
 def load_deeplabv3(model_path, OS):
-    model = Deeplabv3(input_shape=(image_size, image_size, 3),weights=None,classes=2,activation='softmax',backbone='xception',OS=OS)
-    model.load_weights(model_path)
+    model = load_model('deeplabv3p', model_path, (image_size, image_size), OS=OS)
     print ("Loaded Model Weights %s" % model_path)
     return model
 
@@ -517,6 +513,7 @@ if __name__ == '__main__':
             'id4': {"model_type": "ensemble"},
             },
         "models_to_save": ['id4'],
+        "profile_dir": None, #Path to record per stage timings (report.json, report.csv, trace.json), None to disable
         }
 
 
@@ -532,6 +529,7 @@ if __name__ == '__main__':
     # core_config.gpu_options.per_process_gpu_memory_fraction=0.47
     session =tf.Session(config=core_config) 
     K.set_session(session)
+    profiler = enable_profiling(CONFIG["profile_dir"]) if CONFIG["profile_dir"] else get_profiler()
 
 
     # infer_paths = glob.glob(os.path.join(out_dir_root,"infer-*"))
@@ -574,6 +572,8 @@ if __name__ == '__main__':
     sample_ids = os.listdir(CONFIG["in_folder"])
     for i,sample_id in enumerate(sample_ids):
         print(i+1,'/', len(sample_ids),sample_id)
+        profiler.end_slide()
+        profiler.begin_slide(sample_id)
         sample_dir = os.path.join(CONFIG["in_folder"],sample_id)
         wsi_path = glob.glob(os.path.join(sample_dir,'*.svs'))[0]
         if CONFIG["label"]== "True":
@@ -607,7 +607,7 @@ if __name__ == '__main__':
                                             flip=None, rotate=None,
                                             level=level, sampling_stride=scale_sampling_stride, roi_masking=True)
 
-        dataloader = DataLoader(dataset_obj, batch_size=batch_size, num_workers=batch_size, drop_last=True)
+        dataloader = SharedBatchLoader(dataset_obj, batch_size=batch_size, num_workers=batch_size, drop_last=True)
         dataset_obj.save_scaled_imgs()
         out_file = sample_id
 
@@ -625,18 +625,19 @@ if __name__ == '__main__':
         for i,(data, xes, ys, label) in enumerate(dataloader):
             tmp_pls= lambda x: x + image_size
             tmp_mns= lambda x: x 
-            image_patches = data.cpu().data.numpy()
-            image_patches = data.cpu().data.numpy()
+            image_patches = data
             
             pred_map_dict = {}
             pred_map_dict[ensemble_key] = 0
             for key in model_keys:
-                pred_map_dict[key] = model_dict[key].predict(image_patches,verbose=0,batch_size=8)
+                with profiler.stage('predict', patches=image_patches.shape[0]):
+                    pred_map_dict[key] = model_dict[key].predict(image_patches,verbose=0,batch_size=8)
                 # pred_map_dict[key] = model_dict[key].predict(image_patches,verbose=0,batch_size=1)
                 pred_map_dict[ensemble_key]+=pred_map_dict[key]
             pred_map_dict[ensemble_key]/=len(model_keys)
         
             actual_batch_size =  image_patches.shape[0]
+            stitch_start = time.time()
             for j in range(actual_batch_size):
                 x = int(xes[j])
                 y = int(ys[j])
@@ -653,6 +654,7 @@ if __name__ == '__main__':
                     prd_im_fll_dict[key][tmp_mns(x):tmp_pls(x),tmp_mns(y):tmp_pls(y)] += prediction
 
                 count_map[tmp_mns(x):tmp_pls(x),tmp_mns(y):tmp_pls(y)] += np.ones((image_size,image_size),dtype='uint8')
+            profiler.add_time('stitch', stitch_start, time.time() - stitch_start)
             if (i+1)%100==0 or i==0 or i<10:
                 print("Completed %i Time elapsed %.2f min | Max count %d "%(i,(time.time()-start_time)/60,count_map.max()))
             
@@ -684,7 +686,8 @@ if __name__ == '__main__':
         save_model_keys = models_to_save
         for key in  save_model_keys:
             print("\t Saving to %s %s" %(out_file,key))
-            tifffile.imsave(os.path.join(out_dir_dict[key],out_file)+'.tif', prd_im_fll_dict[key].T, compress=9)
+            with profiler.stage('save'):
+                tifffile.imsave(os.path.join(out_dir_dict[key],out_file)+'.tif', prd_im_fll_dict[key].T, compress=9)
         print("\t Calculated in %f" % ((time.time() - start_time)/60))
         start_time = time.time()
 
@@ -702,6 +705,9 @@ if __name__ == '__main__':
             np.place(ov_prob_stride,ov_prob_stride>255,255)
             imsave(mask_im,ov_prob_stride,prob_map_dict[key],scaled_prd_im_fll_dict[key],im_im,out=os.path.join(out_dir_dict[key],'ref_'+out_file)+'.png')
 
+    profiler.end_slide()
+    save_run_report(profiler)
+
     # for key in  models_to_save:
         # with open(os.path.join(out_dir_dict[key],'jacc_scores.txt'), 'a') as f:
             # f.write("Total,%f\n" %(total_jacc_score_dict[key]/len(sample_ids)))
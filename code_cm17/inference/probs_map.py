@@ -10,7 +10,6 @@ import PIL
 import cv2
 import matplotlib.pyplot as plt
 from scipy import ndimage
-from torch.utils.data import DataLoader
 import math
 import json
 import logging
@@ -23,8 +22,15 @@ import time
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 from helpers.utils import *
-from data.data_loader import WSIStridedPatchDataset
+from helpers.probs_map_store import ProbsMapStoreWriter, save_probs_map
+from helpers.stitching import StitchAccumulator, memory_report
+from helpers.profiling import get_profiler, enable_profiling, save_run_report
+from helpers.dihedral import DIHEDRAL_GROUP, from_pil, inverse_dihedral
+from dataloader.inference_data_loader import WSIStridedPatchDataset
+from dataloader.shared_batches import SharedBatchLoader
+from inference.sinks import HeatmapSink, PatchScoreSink, HardMineSink, run_inference
 from models.seg_models import *
+from models.registry import load_model
 np.random.seed(0)
 
 
@@ -40,13 +46,17 @@ parser.add_argument('cfg_path', default=None, metavar='CFG_PATH', type=str,
                     help='Path to the config file in json format related to'
                     ' the ckpt file')
 parser.add_argument('probs_map_path', default=None, metavar='PROBS_MAP_PATH',
-                    type=str, help='Path to the output probs_map numpy file')
+                    type=str, help='Path to the output probs_map numpy file (.npy), any'
+                    ' other path is written as a chunked multi-level store directory')
 parser.add_argument('--mask_path', default=None, metavar='MASK_PATH', type=str,
                     help='Path to the tissue mask of the input WSI file')
 parser.add_argument('--label_path', default=None, metavar='LABEL_PATH', type=str,
                     help='Path to the Ground-Truth label image')
 parser.add_argument('--GPU', default='0', type=str, help='which GPU to use'
                     ', default 0')
+parser.add_argument('--model_cache', default=None, type=str, help='directory of the'
+                    ' fast-loading model artifacts, default $CM17_MODEL_CACHE or'
+                    ' ~/.cache/cm17/models')
 parser.add_argument('--num_workers', default=5, type=int, help='number of '
                     'workers to use to make batch, default 5')
 parser.add_argument('--eight_avg', default=1, type=int, help='if using average'
@@ -58,25 +68,36 @@ parser.add_argument('--sampling_stride', default=32, type=int, help='Sampling pi
                     ' default 32')
 parser.add_argument('--roi_masking', default=True, type=int, help='Sample pixels from tissue mask region,'
                     ' default True, points are not sampled from glass region')
+parser.add_argument('--store_dtype', default='uint8', type=str, choices=['uint8', 'float16', 'float32'],
+                    help='Quantization of the chunked store, default uint8')
+parser.add_argument('--store_levels', default=4, type=int, help='Number of 2x down-sampled levels'
+                    ' of the chunked store, default 4')
+parser.add_argument('--chunk_size', default=256, type=int, help='Chunk size of the chunked store,'
+                    ' default 256')
+parser.add_argument('--sum_dtype', default='float32', type=str, help='dtype of the stitching'
+                    ' sum buffer, default float32')
+parser.add_argument('--count_dtype', default='uint16', type=str, help='dtype of the stitching'
+                    ' count buffer, default uint16')
+parser.add_argument('--out_dtype', default='float32', type=str, choices=['float32', 'float16'],
+                    help='dtype of the normalized output map, default float32')
+parser.add_argument('--scores_csv', default=None, type=str, help='Path to save the Dice and'
+                    ' Jaccard index of every patch against the label (needs --label_path)')
+parser.add_argument('--hardmine_csv', default=None, type=str, help='Path to save the hard examples,'
+                    ' level 0 patch centres scoring below --mining_threshold with their tumor'
+                    ' fraction (needs --label_path)')
+parser.add_argument('--mining_threshold', default=0.9, type=float, help='Dice below which a patch'
+                    ' is mined, default 0.9')
+parser.add_argument('--pred_threshold', default=0.45, type=float, help='tumor probability threshold'
+                    ' of the predicted masks scored against the label, default 0.45')
+parser.add_argument('--profile_dir', default=None, type=str, help='Record per stage timings, counters'
+                    ' and peak RSS of the run into this directory (report.json, report.csv, trace.json)')
 
 
 def transform_prob(data, flip, rotate):
     """
-    Do inverse data augmentation
+    Do inverse data augmentation of a patch prediction (H x W x C)
     """
-    if flip == 'FLIP_LEFT_RIGHT':
-        data = np.fliplr(data)
-
-    if rotate == 'ROTATE_90':
-        data = np.rot90(data, 3)
-
-    if rotate == 'ROTATE_180':
-        data = np.rot90(data, 2)
-
-    if rotate == 'ROTATE_270':
-        data = np.rot90(data, 1)
-
-    return data
+    return inverse_dihedral(data, *from_pil(flip, rotate), axes=(0, 1))
 
 def get_index(coord_ax, probs_map_shape_ax, grid_ax):
     """
@@ -99,82 +120,43 @@ def get_index(coord_ax, probs_map_shape_ax, grid_ax):
     return _min, _max
 
 
-def get_probs_map(model, dataloader):
+def get_probs_map(model, dataloader, writer=None, sum_dtype='float32', count_dtype='uint16',
+                  out_dtype='float32', tta=None):
     """
-    Generate probability map
+    Generate probability map, the mean of the overlapping patch windows
+    accumulated in sum_dtype/count_dtype buffers and returned as out_dtype.
+
+    With tta, a sequence of dihedral (k, flip) elements (e.g. DIHEDRAL_GROUP),
+    the predictions of every batch are averaged over the transformed batches
+    before stitching, so the slide is read and stitched once.
+
+    If a ProbsMapStoreWriter is given the patch windows are streamed into it,
+    finished chunks are written to disk while stitching and None is returned.
     """
-    eps = 0.0001
-    probs_map = np.zeros(dataloader.dataset._mask.shape)
-    count_map = np.zeros(dataloader.dataset._mask.shape)
-    num_batch = len(dataloader)
-    batch_size = dataloader.batch_size
-    map_x_size = dataloader.dataset._mask.shape[0]
-    map_y_size = dataloader.dataset._mask.shape[1]
-    level = dataloader.dataset._level
-    factor = dataloader.dataset._sampling_stride
-    flip = dataloader.dataset._flip
-    rotate = dataloader.dataset._rotate    
-    down_scale = 1.0 / pow(2, level)
-
-    count = 0
-    time_now = time.time()
-    # label_mask is not utilized     
-    for (image_patches, x_coords, y_coords, label_patches) in dataloader:
-
-        image_patches = image_patches.cpu().data.numpy()
-        label_patches = label_patches.cpu().data.numpy()
-        x_coords = x_coords.cpu().data.numpy()
-        y_coords = y_coords.cpu().data.numpy()
-
-        # start = time.time()
-        y_preds = model.predict(image_patches, batch_size=batch_size, verbose=1, steps=None)
-        # end = time.time()
-        # print('Elapsed Inference Time', (end - start))
-
-        # print (image_patches[0].shape, y_preds[0].shape)  
-        # imshow (normalize_minmax(image_patches[0]),label_patches[0], y_preds[0][:,:,0], y_preds[0][:,:,1], np.argmax(y_preds[0], axis=2))
-
-        for i in range(batch_size):
-            # start = time.time()
-            y_preds_transformed = transform_prob(y_preds[i], flip, rotate)
-            # img_patch_rescaled = rescale(image_patches[i], down_scale, anti_aliasing=True)
-            y_preds_rescaled = rescale(y_preds_transformed, down_scale, anti_aliasing=False)
-            # imshow(normalize_minmax(image_patches[i]), label_patches[i], y_preds[i][:,:,1], np.argmax(y_preds[i], axis=2), title=['Image', 'Ground-Truth', 'Heat-Map', 'Predicted-Label-Map'])            
-            # imshow(normalize_minmax(img_patch_rescaled), y_preds_rescaled[:,:,1], np.argmax(y_preds_rescaled, axis=2), title=['Rescaled-Image', 'Rescaled-Predicted-Heat-Map', 'Rescaled-Predicted-Label-Map'])
-            xmin, xmax = get_index(x_coords[i], map_x_size, factor)
-            ymin, ymax = get_index(y_coords[i], map_y_size, factor)
-            # print (xmin, xmax, ymin, ymax)   
-            probs_map[x_coords[i] - xmin: x_coords[i] + xmax, y_coords[i] - ymin: y_coords[i] + ymax] =\
-            y_preds_rescaled[0:xmin+xmax, 0:ymin+ymax, 1]
-            count_map[x_coords[i] - xmin: x_coords[i] + xmax, y_coords[i] - ymin: y_coords[i] + ymax] +=\
-            np.ones_like(y_preds_rescaled[0:xmin+xmax, 0:ymin+ymax, 1])
-            # end = time.time()
-            # print('Elapsed post inference time', (end - start))
-    
-        count += 1
-        time_spent = time.time() - time_now
-        time_now = time.time()
-        logging.info(
-            '{}, flip : {}, rotate : {}, batch : {}/{}, Run Time : {:.2f}'
-            .format(
-                time.strftime("%Y-%m-%d %H:%M:%S"), dataloader.dataset._flip,
-                dataloader.dataset._rotate, count, num_batch, time_spent))
-    # imshow(count_map)
-    return probs_map
+    heatmap = HeatmapSink(writer, sum_dtype=sum_dtype, count_dtype=count_dtype, out_dtype=out_dtype)
+    return run_inference(model, dataloader, [heatmap], tta=tta, verbose=1)[0]
 
 def make_dataloader(args, cfg, flip='NONE', rotate='NONE'):
     batch_size = cfg['batch_size']
-    dataloader = DataLoader(WSIStridedPatchDataset(args.wsi_path, args.mask_path,
-                            args.label_path,
-                            image_size=cfg['image_size'],
-                            normalize=True, flip=flip, rotate=rotate,
-                            level=args.level, sampling_stride=args.sampling_stride, roi_masking=args.roi_masking),
-                            batch_size=batch_size, num_workers=args.num_workers, drop_last=True)
+    dataloader = SharedBatchLoader(WSIStridedPatchDataset(args.wsi_path, args.mask_path,
+                                   args.label_path,
+                                   image_size=cfg['image_size'],
+                                   normalize=True, flip=flip, rotate=rotate,
+                                   level=args.level, sampling_stride=args.sampling_stride, roi_masking=args.roi_masking),
+                                   batch_size=batch_size, num_workers=args.num_workers, drop_last=True)
     return dataloader
 
 def run(args):
     os.environ["CUDA_VISIBLE_DEVICES"] = args.GPU
     logging.basicConfig(level=logging.INFO)
+    if args.profile_dir is not None:
+        enable_profiling(args.profile_dir)
+    with get_profiler().slide(os.path.basename(args.wsi_path)):
+        predict_slide(args)
+    save_run_report(get_profiler())
+
+
+def predict_slide(args):
 
     with open(args.cfg_path) as f:
         cfg = json.load(f)
@@ -184,60 +166,51 @@ def run(args):
     session =tf.Session(config=core_config) 
     K.set_session(session)
 
-    model = unet_densenet121((None, None), weights=None)
-    model.load_weights(args.model_path)
+    model = load_model('unet_densenet121', args.model_path, cache_dir=args.model_cache)
     print ("Loaded Model Weights")
 
     save_dir = os.path.dirname(args.probs_map_path)
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    if not args.eight_avg:
-        dataloader = make_dataloader(
-            args, cfg, flip='NONE', rotate='NONE')
-        probs_map = get_probs_map(model, dataloader)
-    else:        
-        dataloader = make_dataloader(
-            args, cfg, flip='NONE', rotate='NONE')
-        probs_map = np.zeros(dataloader.dataset._mask.shape)
-
-        probs_map += get_probs_map(model, dataloader)
-
-        dataloader = make_dataloader(
-            args, cfg, flip='NONE', rotate='ROTATE_90')
-        probs_map += get_probs_map(model, dataloader)
-
-        dataloader = make_dataloader(
-            args, cfg, flip='NONE', rotate='ROTATE_180')
-        probs_map += get_probs_map(model, dataloader)
-
-        dataloader = make_dataloader(
-            args, cfg, flip='NONE', rotate='ROTATE_270')
-        probs_map += get_probs_map(model, dataloader)
-
-        dataloader = make_dataloader(
-            args, cfg, flip='FLIP_LEFT_RIGHT', rotate='NONE')
-        probs_map += get_probs_map(model, dataloader)
-
-        dataloader = make_dataloader(
-            args, cfg, flip='FLIP_LEFT_RIGHT', rotate='ROTATE_90')
-        probs_map += get_probs_map(model, dataloader)
-
-        dataloader = make_dataloader(
-            args, cfg, flip='FLIP_LEFT_RIGHT', rotate='ROTATE_180')
-        probs_map += get_probs_map(model, dataloader)
-
-        dataloader = make_dataloader(
-            args, cfg, flip='FLIP_LEFT_RIGHT', rotate='ROTATE_270')
-        probs_map += get_probs_map(model, dataloader)
-
-        probs_map /= 8
-
-    np.save(args.probs_map_path, probs_map)
+    dataloader = make_dataloader(
+        args, cfg, flip='NONE', rotate='NONE')
+    # the 8 flip/rotate predictions of every batch are averaged before stitching
+    tta = DIHEDRAL_GROUP if args.eight_avg else None
+    writer = None
+    if not args.probs_map_path.endswith('.npy'):
+        # stream the map into a chunked store while stitching
+        writer = ProbsMapStoreWriter(args.probs_map_path, dataloader.dataset._mask.shape,
+                                     chunk_size=args.chunk_size, dtype=args.store_dtype,
+                                     n_levels=args.store_levels, scale=pow(2, args.level))
+    sinks = [HeatmapSink(writer, sum_dtype=args.sum_dtype, count_dtype=args.count_dtype,
+                         out_dtype=args.out_dtype)]
+    # the patch scores and the mining share the inference pass of the heatmap
+    scorer = None
+    if args.hardmine_csv is not None:
+        scorer = HardMineSink(args.pred_threshold, args.mining_threshold, scale=pow(2, args.level))
+    elif args.scores_csv is not None:
+        scorer = PatchScoreSink(args.pred_threshold)
+    if scorer is not None:
+        sinks.append(scorer)
+    probs_map = run_inference(model, dataloader, sinks, tta=tta, verbose=1)[0]
+
+    with get_profiler().stage('save'):
+        if args.scores_csv is not None:
+            PatchScoreSink.write_csv(scorer, args.scores_csv)
+        if args.hardmine_csv is not None:
+            scorer.write_csv(args.hardmine_csv)
+        if writer is not None:
+            writer.close()
+        else:
+            save_probs_map(args.probs_map_path, probs_map, chunk_size=args.chunk_size,
+                           dtype=args.store_dtype, n_levels=args.store_levels, scale=pow(2, args.level))
 
 
 def main():
     args = parser.parse_args()
+    if (args.scores_csv is not None or args.hardmine_csv is not None) and args.label_path is None:
+        parser.error('--scores_csv and --hardmine_csv need --label_path')
     run(args)
 
 
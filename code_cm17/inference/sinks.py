@@ -0,0 +1,295 @@
+import os
+import csv
+import time
+import logging
+import numpy as np
+from skimage.transform import rescale
+
+from helpers.stitching import StitchAccumulator, memory_report
+from helpers.metrics import batch_counts, batch_dice, batch_jaccard, batch_tumor_fraction,\
+    quadrant_tumor_fractions
+from helpers.profiling import get_profiler
+from helpers.dihedral import from_pil, inverse_dihedral, tta_predict
+from dataloader.shared_batches import normalize_batch
+
+# quadrants of the mined patches in the row order of the mined points files:
+# top-left, top-right, bottom-right, bottom-left ([x, y] quadrant indices)
+QUADRANT_ORDER = ((0, 0), (0, 1), (1, 1), (1, 0))
+
+
+class PredictionBatch(object):
+    """
+    One predicted batch as seen by the sinks: normalized images (NHWC),
+    predictions (NHWC softmax) and labels (NHW, None without label) in the
+    orientation of the slide, and the coordinates given by the dataset
+    """
+    def __init__(self, images, preds, x_coords, y_coords, labels=None):
+        self.images = images
+        self.preds = preds
+        self.x_coords = x_coords
+        self.y_coords = y_coords
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.x_coords)
+
+
+class BatchSink(object):
+    """
+    Consumer of the batches of a fused inference pass (run_inference):
+    start is called with the dataset before the first batch, add with
+    every PredictionBatch, finish returns the result of the sink
+    """
+    name = 'sink'
+
+    def start(self, dataset):
+        self.dataset = dataset
+
+    def add(self, batch):
+        raise NotImplementedError
+
+    def finish(self):
+        return None
+
+
+class HeatmapSink(BatchSink):
+    """
+    Stitches the tumor probabilities of the patches into the probability
+    map of the slide (the mean of the overlapping windows), at the level of
+    the dataset mask. With a ProbsMapStoreWriter the windows are streamed
+    into the chunked store and finish returns None.
+    """
+    name = 'heatmap'
+
+    def __init__(self, writer=None, sum_dtype='float32', count_dtype='uint16', out_dtype='float32'):
+        self.writer = writer
+        self.sum_dtype = sum_dtype
+        self.count_dtype = count_dtype
+        self.out_dtype = out_dtype
+
+    def start(self, dataset):
+        BatchSink.start(self, dataset)
+        self.map_shape = dataset._mask.shape
+        self.factor = dataset._sampling_stride
+        self.down_scale = 1.0 / pow(2, dataset._level)
+        self.accumulator = None
+        if self.writer is None:
+            self.accumulator = StitchAccumulator(self.map_shape, sum_dtype=self.sum_dtype,
+                                                 count_dtype=self.count_dtype)
+
+    def add(self, batch):
+        profiler = get_profiler()
+        target = self.writer if self.writer is not None else self.accumulator
+        for i in range(len(batch)):
+            rescale_start = time.time()
+            y_preds_rescaled = rescale(batch.preds[i], self.down_scale, anti_aliasing=False)
+            stitch_start = time.time()
+            profiler.add_time('rescale', rescale_start, stitch_start - rescale_start)
+            xmin, xmax = window_extent(batch.x_coords[i], self.map_shape[0], self.factor)
+            ymin, ymax = window_extent(batch.y_coords[i], self.map_shape[1], self.factor)
+            # PIL image: H x W, i.e. (y, x) -> transpose to the (x, y) layout of the map
+            # and keep the window centred on the patch centre
+            y_preds_window = y_preds_rescaled[:, :, 1].T
+            half = y_preds_window.shape[0] // 2
+            target.add(batch.x_coords[i] - xmin, batch.y_coords[i] - ymin,
+                       y_preds_window[half - xmin:half + xmax, half - ymin:half + ymax])
+            profiler.add_time('stitch', stitch_start, time.time() - stitch_start)
+        if self.writer is not None:
+            # coordinates come sorted along x, rows above the current window are final
+            self.writer.flush_rows(batch.x_coords[-1] - self.factor // 2)
+
+    def finish(self):
+        if self.writer is not None:
+            return None
+        probs_map = self.accumulator.result(self.out_dtype)[0]
+        logging.info('Stitching memory: {}'.format(
+            memory_report(os.path.basename(self.dataset._wsi_path), probs_map, self.accumulator)))
+        return probs_map
+
+
+class PatchScoreSink(BatchSink):
+    """
+    Dice and Jaccard index of every thresholded patch prediction against
+    its label, and the pooled Jaccard index of the slide (sum of the
+    intersections over sum of the unions).
+
+    Arguments:
+        threshold: tumor probability threshold of the predicted masks
+        patch_mask: optional function of the [0, 255] RGB batch (NHWC) returning
+            the NHW masks the predicted masks are multiplied with (e.g.
+            helpers.mask_utils.patch_tissue_mask)
+    """
+    name = 'patch_scores'
+
+    def __init__(self, threshold=0.45, patch_mask=None):
+        self.threshold = threshold
+        self.patch_mask = patch_mask
+
+    def start(self, dataset):
+        BatchSink.start(self, dataset)
+        self.x, self.y, self.dice, self.jaccard = [], [], [], []
+        self.num, self.den = 0, 0
+
+    def score_batch(self, batch):
+        """
+        [N] dice and jaccard arrays of the patches of a batch, thresholded,
+        masked and counted on the whole batch at once
+        """
+        if batch.labels is None:
+            raise ValueError('{} needs the labels, give the dataset a label_path'.format(self.name))
+        prediction = batch.preds[..., 1] >= self.threshold
+        if self.patch_mask is not None:
+            prediction &= self.patch_mask(np.asarray(batch.images) * 128 + 128)
+        intersection, union, pred_count, label_count = batch_counts(prediction, batch.labels)
+        self.num += int(intersection.sum())
+        self.den += int(union.sum())
+        return batch_dice(intersection, pred_count, label_count), batch_jaccard(intersection, union)
+
+    def add(self, batch):
+        dices, jaccards = self.score_batch(batch)
+        self.x.extend(batch.x_coords)
+        self.y.extend(batch.y_coords)
+        self.dice.extend(dices)
+        self.jaccard.extend(jaccards)
+
+    def finish(self):
+        return {'x': np.asarray(self.x), 'y': np.asarray(self.y),
+                'dice': np.asarray(self.dice), 'jaccard': np.asarray(self.jaccard),
+                'num': self.num, 'den': self.den,
+                'jaccard_index': self.num / self.den if self.den else 1.0}
+
+    def write_csv(self, path):
+        with open(path, 'w') as f:
+            out = csv.writer(f)
+            for row in zip(self.x, self.y, self.dice, self.jaccard):
+                out.writerow(row)
+
+
+class HardMineSink(PatchScoreSink):
+    """
+    Hard examples: the patches whose score is below max_score, as level 0
+    (x, y) points with the tumor fraction of their label.
+
+    Arguments:
+        score: 'dice' or 'jaccard'
+        max_score: patches scoring below are mined
+        scale, offset: level 0 point of dataset coordinates c, c * scale + offset
+            (e.g. scale = 2 ** level for mask coordinates of patch centres)
+        quadrants: mine the centres of the 4 quadrants of the patch, each with
+            the tumor fraction of its quadrant (labels indexed [x, y]), in the
+            order (x, y), (x, y + 1), (x + 1, y + 1), (x + 1, y) of the quadrants
+
+    finish returns the patch scores (PatchScoreSink) with the mined rows
+    (wsi_path, x, y, score, tumor_fraction) under 'mined'.
+    """
+    name = 'hardmine'
+
+    def __init__(self, threshold=0.45, max_score=0.9, score='dice', scale=1, offset=0,
+                 quadrants=False, patch_mask=None):
+        if score not in ('dice', 'jaccard'):
+            raise ValueError('score should be dice or jaccard, got {}'.format(score))
+        PatchScoreSink.__init__(self, threshold, patch_mask)
+        self.max_score = max_score
+        self.score = score
+        self.scale = scale
+        self.offset = offset
+        self.quadrants = quadrants
+
+    def start(self, dataset):
+        PatchScoreSink.start(self, dataset)
+        self.mined = []
+
+    def add(self, batch):
+        n_scored = len(self.dice)
+        PatchScoreSink.add(self, batch)
+        scores = np.asarray((self.dice if self.score == 'dice' else self.jaccard)[n_scored:])
+        mined = np.flatnonzero(scores < self.max_score)
+        if len(mined) == 0:
+            return
+        wsi_path = self.dataset._wsi_path
+        xs = np.asarray(batch.x_coords)[mined].astype(np.int64) * self.scale + self.offset
+        ys = np.asarray(batch.y_coords)[mined].astype(np.int64) * self.scale + self.offset
+        labels = np.asarray(batch.labels)[mined]
+        if not self.quadrants:
+            fractions = batch_tumor_fraction(labels)
+            self.mined.extend(zip([wsi_path] * len(mined), xs.tolist(), ys.tolist(),
+                                  scores[mined].tolist(), fractions.tolist()))
+            return
+        fractions = quadrant_tumor_fractions(labels)
+        half_x, half_y = labels.shape[1] // 2, labels.shape[2] // 2
+        for n, i in enumerate(mined):
+            for qx, qy in QUADRANT_ORDER:
+                self.mined.append((wsi_path, int(xs[n]) + half_x // 2 + qx * half_x,
+                                   int(ys[n]) + half_y // 2 + qy * half_y,
+                                   float(scores[i]), float(fractions[n, qx, qy])))
+
+    def finish(self):
+        result = PatchScoreSink.finish(self)
+        result['mined'] = self.mined
+        return result
+
+    def write_csv(self, path):
+        with open(path, 'w') as f:
+            out = csv.writer(f)
+            for row in self.mined:
+                out.writerow(row)
+
+
+def window_extent(coord_ax, probs_map_shape_ax, grid_ax):
+    """
+    Extent (before, after) of the window of a patch centre along an axis,
+    clipped to the map
+    """
+    half = grid_ax // 2
+    return min(half, coord_ax), min(half, probs_map_shape_ax - coord_ax)
+
+
+def run_inference(model, dataloader, sinks, tta=None, verbose=0):
+    """
+    One inference pass over a slide feeding every sink: each batch is read
+    and predicted once (averaged over the dihedral elements of tta if
+    given), the flip/rotate of the dataset is undone on the predictions and
+    labels, then the batch goes to the sinks in order.
+
+    Returns:
+        list of the results of the sinks (sink.finish())
+    """
+    dataset = dataloader.dataset
+    batch_size = dataloader.batch_size
+    num_batch = len(dataloader)
+    k, flip = from_pil(getattr(dataset, '_flip', None) or 'NONE', getattr(dataset, '_rotate', None) or 'NONE')
+    n_predictions = 1 if tta is None else len(tta)
+    predict = lambda batch: model.predict(batch, batch_size=batch_size, verbose=verbose, steps=None)
+    for sink in sinks:
+        sink.start(dataset)
+
+    count = 0
+    time_now = time.time()
+    profiler = get_profiler()
+    for (image_patches, x_coords, y_coords, label_patches) in dataloader:
+        if image_patches.dtype == np.uint8:
+            # uint8 views of the shared batch ring, normalized once per batch
+            with profiler.stage('normalize'):
+                image_patches = normalize_batch(image_patches)
+
+        with profiler.stage('predict', patches=image_patches.shape[0] * n_predictions):
+            y_preds = predict(image_patches) if tta is None else tta_predict(predict, image_patches, tta)
+        # undo the flip/rotate of the dataset on the whole batch (strided views)
+        y_preds = inverse_dihedral(y_preds, k, flip)
+        image_patches = inverse_dihedral(image_patches, k, flip)
+        if label_patches is not None:
+            label_patches = inverse_dihedral(label_patches, k, flip)
+        batch = PredictionBatch(image_patches, y_preds, x_coords, y_coords, label_patches)
+        for sink in sinks:
+            with profiler.stage(sink.name):
+                sink.add(batch)
+
+        count += 1
+        time_spent = time.time() - time_now
+        time_now = time.time()
+        logging.info(
+            '{}, flip : {}, rotate : {}, batch : {}/{}, Run Time : {:.2f}'
+            .format(
+                time.strftime("%Y-%m-%d %H:%M:%S"), getattr(dataset, '_flip', None),
+                getattr(dataset, '_rotate', None), count, num_batch, time_spent))
+    return [sink.finish() for sink in sinks]
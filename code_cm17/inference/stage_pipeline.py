@@ -0,0 +1,222 @@
+import sys
+import os
+import re
+import argparse
+import logging
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import joblib
+import tensorflow as tf
+from tensorflow.keras import backend as K
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from helpers.probs_map_store import save_probs_map
+from inference.multi_model_test_sequence import get_probs_map, make_dataloader, load_models
+from pn_stage_classification.feature_extraction import extract_features, image_open
+from pn_stage_classification.pn_staging import get_patient_stages, format_submission, NUMBER_NODES
+
+
+# python3 stage_pipeline.py ../configs/Inference_Config.json ../../saved_models/keras_models/DFCN_UNET_CM17_RANDOM_16_NCRF_BCE_DICE_fold_1/model.10-0.24.h5 ../../saved_models/keras_models/IncpResV2_UNET_CM17_RANDOM_16_NCRF_BCE_DICE_fold_0/model.10-0.28.h5 ../../saved_models/keras_models/DeeplabV3p_CM17_RANDOM_16_NCRF_BCE_DICE_fold_2/model.09-0.28.h5 ../predictions/Models_NCRF_CM16/<hash> /media/mak/mirlproject1/CAMELYON17/testing/centers ../predictions/submission.csv
+parser = argparse.ArgumentParser(description='Stream patient node slides to pN stages: heatmap,'
+                                 ' features and node classification of each slide in memory,'
+                                 ' the patient stage as soon as all its nodes are done')
+parser.add_argument('cfg_path', default=None, metavar='CFG_PATH', type=str,
+                    help='Path to the config file in json format related to'
+                    ' the ckpt file')
+parser.add_argument('model_path_DFCN', default=None, metavar='MODEL_PATH', type=str,
+                    help='Path to the saved model weights file of a Keras model')
+parser.add_argument('model_path_IRFCN', default=None, metavar='MODEL_PATH', type=str,
+                    help='Path to the saved model weights file of a Keras model')
+parser.add_argument('model_path_DLv3p', default=None, metavar='MODEL_PATH', type=str,
+                    help='Path to the saved model weights file of a Keras model')
+parser.add_argument('classifier_dir', default=None, metavar='CLASSIFIER_DIR', type=str,
+                    help='Directory of the persisted pN-stage classifier and scaler'
+                    ' (see classification_pipeline.py)')
+parser.add_argument('slides', default=None, metavar='SLIDES', type=str,
+                    help='Directory of the patient_XXX_node_Y.tif slides or a text file with one path per line')
+parser.add_argument('submission_path', default=None, metavar='SUBMISSION_PATH', type=str,
+                    help='Path to the output submission csv file')
+parser.add_argument('--classifier', default='RF_scaled', type=str, help='Persisted classifier'
+                    ' to use, default RF_scaled')
+parser.add_argument('--mask_dir', default=None, type=str, help='Directory of the tissue masks'
+                    ' <patient_XXX_node_Y>.npy, generated in memory when missing')
+parser.add_argument('--save_dir', default=None, type=str, help='Optional directory for the'
+                    ' intermediate heatmaps and features, nothing is written without it')
+parser.add_argument('--GPU', default='0', type=str, help='which GPU to use'
+                    ', default 0')
+parser.add_argument('--num_workers', default=4, type=int, help='number of '
+                    'workers to use to make batch, default 4')
+parser.add_argument('--feature_workers', default=2, type=int, help='processes extracting the'
+                    ' features while the next slide is predicted, default 2')
+parser.add_argument('--level', default=6, type=int, help='heatmap generation level,'
+                    ' default 6')
+parser.add_argument('--sampling_stride', default=int(256//64), type=int, help='Sampling pixels in tissue mask,'
+                    ' default 4')
+parser.add_argument('--roi_masking', default=True, type=int, help='Sample pixels from tissue mask region,'
+                    ' default True, points are not sampled from glass region')
+
+SLIDE_NAME = re.compile(r'(patient_\d+)_node_(\d+)')
+
+
+def get_patient_slides(slides):
+    """
+    Slides grouped by patient, in patient order
+    Returns
+    -------
+    OrderedDict patient -> list of (patient_XXX_node_Y, wsi_path)
+    """
+    if os.path.isdir(slides):
+        paths = [os.path.join(slides, name) for name in os.listdir(slides) if name.endswith('.tif')]
+    else:
+        with open(slides) as f:
+            paths = [line.strip() for line in f if line.strip()]
+    patients = OrderedDict()
+    for path in sorted(paths):
+        match = SLIDE_NAME.search(os.path.basename(path))
+        if match is None:
+            logging.warning('Not a patient node slide, skipped: {}'.format(path))
+            continue
+        patients.setdefault(match.group(1), []).append((match.group(0), path))
+    return patients
+
+
+def slide_features(heatmap, tissue_mask):
+    """
+    Heatmap features of a slide, run in the feature worker processes
+    """
+    return extract_features(heatmap, image_open(tissue_mask))
+
+
+class StagePipeline(object):
+    """
+    WSI -> ensemble heatmap -> features -> node stage -> patient pN stage,
+    without files in between. The features of a slide are extracted in a
+    worker process while the next slide is predicted on the GPU, and a
+    patient is staged as soon as the last of its slides is classified.
+    """
+    def __init__(self, model_dic, classifier, scaler, class_names, cfg, args, number_nodes=NUMBER_NODES):
+        self._model_dic = model_dic
+        self._classifier = classifier
+        self._scaler = scaler
+        self._class_names = class_names
+        self._cfg = cfg
+        self._args = args
+        self._number_nodes = number_nodes
+        self._save_dir = args.save_dir
+        if self._save_dir is not None and not os.path.exists(self._save_dir):
+            os.makedirs(self._save_dir)
+
+    def tissue_mask_path(self, slide_name):
+        if self._args.mask_dir is not None:
+            mask_path = os.path.join(self._args.mask_dir, slide_name + '.npy')
+            if os.path.exists(mask_path):
+                return mask_path
+        # the dataset generates the tissue mask on the fly
+        return None
+
+    def heatmap(self, slide_name, wsi_path):
+        """
+        Ensemble heatmap and tissue mask of a slide, kept in memory
+        """
+        dataloader = make_dataloader(wsi_path, self.tissue_mask_path(slide_name), None, self._args, self._cfg)
+        probs_map, _, _ = get_probs_map(self._model_dic, dataloader)
+        return np.mean(probs_map, axis=0), dataloader.dataset._mask
+
+    def classify(self, features):
+        pred = self._classifier.predict(self._scaler.transform(np.array([features], dtype=np.float64)))[0]
+        return self._class_names[int(pred)]
+
+    def stage_patient(self, node_stages):
+        """
+        Arguments:
+            node_stages: list of (patient_XXX_node_Y, node stage)
+        Returns:
+            (patient DataFrame with the pN stage, completed node DataFrame)
+        """
+        return get_patient_stages(pd.DataFrame(node_stages, columns=['patient', 'stage']),
+                                  number_nodes=self._number_nodes)
+
+    def run(self, patients):
+        """
+        Arguments:
+            patients: OrderedDict patient -> list of (slide name, wsi path)
+        Yields:
+            (patient DataFrame row with the pN stage, completed node DataFrame) per patient
+        """
+        pending = OrderedDict()
+        node_stages = dict((patient, []) for patient in patients)
+        executor = ProcessPoolExecutor(max_workers=self._args.feature_workers)
+        start = time.time()
+        for patient, slides in patients.items():
+            for slide_name, wsi_path in slides:
+                time_now = time.time()
+                heatmap, tissue_mask = self.heatmap(slide_name, wsi_path)
+                if self._save_dir is not None:
+                    save_probs_map(os.path.join(self._save_dir, slide_name + '.npy'), heatmap)
+                pending[slide_name] = (patient, executor.submit(slide_features, heatmap, tissue_mask))
+                logging.info('{}, {}, heatmap Run Time : {:.2f}'.format(time.strftime("%Y-%m-%d %H:%M:%S"),
+                                                                         slide_name, time.time() - time_now))
+                # classify the slides whose features are ready and stage the completed patients
+                for result in self._collect(pending, node_stages, patients, wait=False):
+                    yield result
+        for result in self._collect(pending, node_stages, patients, wait=True):
+            yield result
+        executor.shutdown()
+        logging.info('{} patients staged in {:.2f}s'.format(len(patients), time.time() - start))
+
+    def _collect(self, pending, node_stages, patients, wait):
+        for slide_name in list(pending.keys()):
+            patient, future = pending[slide_name]
+            if not wait and not future.done():
+                continue
+            features = future.result()
+            del pending[slide_name]
+            node_stages[patient].append((slide_name, self.classify(features)))
+            if self._save_dir is not None:
+                with open(os.path.join(self._save_dir, slide_name + '_features.json'), 'w') as f:
+                    json.dump({'features': features, 'stage': node_stages[patient][-1][1]}, f)
+            if len(node_stages[patient]) == len(patients[patient]):
+                patient_df, nodes = self.stage_patient(node_stages[patient])
+                yield patient_df.iloc[0], nodes
+
+
+def run(args):
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.GPU
+    logging.basicConfig(level=logging.INFO)
+
+    core_config = tf.ConfigProto()
+    core_config.gpu_options.allow_growth = True
+    session = tf.Session(config=core_config)
+    K.set_session(session)
+
+    with open(args.cfg_path) as f:
+        cfg = json.load(f)
+    model_dic = load_models(args, cfg['image_size'])
+
+    with open(os.path.join(args.classifier_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    classifier = joblib.load(os.path.join(args.classifier_dir, args.classifier + '.joblib'))
+    scaler = joblib.load(os.path.join(args.classifier_dir, 'scaler.joblib'))
+
+    pipeline = StagePipeline(model_dic, classifier, scaler, manifest['class_names'], cfg, args)
+    with open(args.submission_path, 'w') as f:
+        f.write('patient,stage\n')
+        for patient_row, nodes in pipeline.run(get_patient_slides(args.slides)):
+            print (patient_row['patient'], patient_row['pn_stage'])
+            patient_df = patient_row.to_frame().T
+            # the header line is written once above
+            f.write('\n'.join(format_submission(patient_df, nodes, NUMBER_NODES)[1:]) + '\n')
+            f.flush()
+
+
+def main():
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
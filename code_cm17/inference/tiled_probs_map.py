@@ -0,0 +1,177 @@
+import sys
+import os
+import argparse
+import logging
+import json
+import time
+import numpy as np
+import openslide
+import tensorflow as tf
+from tensorflow.keras import backend as K
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from helpers.utils import *
+from models.registry import load_model
+np.random.seed(0)
+
+
+# python3 tiled_probs_map.py /media/mak/mirlproject1/CAMELYON17/training/dataset/center_0/patient_004_node_4.tif /media/mak/Data/Projects/Camelyon17/saved_models/keras_models/segmentation/CM16/unet_densenet121_imagenet_pretrained_L0_20190712-173828/Model_Stage2.h5 ../configs/DenseNet121_UNET_NCRF_CM16_COORDS_CDL.json ../../../predictions/DenseNet-121_UNET/patient_004_node_4_mask.npy --tile_size=4096
+
+parser = argparse.ArgumentParser(description='Get the probability map of tumor'
+                                 ' predictions given a WSI, running the fully convolutional'
+                                 ' network on large tiles instead of overlapping patches')
+parser.add_argument('wsi_path', default=None, metavar='WSI_PATH', type=str,
+                    help='Path to the input WSI file')
+parser.add_argument('model_path', default=None, metavar='MODEL_PATH', type=str,
+                    help='Path to the saved model weights file of a Keras model')
+parser.add_argument('cfg_path', default=None, metavar='CFG_PATH', type=str,
+                    help='Path to the config file in json format related to'
+                    ' the ckpt file')
+parser.add_argument('probs_map_path', default=None, metavar='PROBS_MAP_PATH',
+                    type=str, help='Path to the output probs_map numpy file')
+parser.add_argument('--mask_path', default=None, metavar='MASK_PATH', type=str,
+                    help='Path to the tissue mask of the input WSI file')
+parser.add_argument('--model', default='densenet', type=str, choices=['densenet', 'inception'],
+                    help='Fully convolutional network the weights belong to, default densenet')
+parser.add_argument('--GPU', default='0', type=str, help='which GPU to use'
+                    ', default 0')
+parser.add_argument('--model_cache', default=None, type=str, help='directory of the'
+                    ' fast-loading model artifacts, default $CM17_MODEL_CACHE or'
+                    ' ~/.cache/cm17/models')
+parser.add_argument('--level', default=5, type=int, help='heatmap generation level,'
+                    ' default 5')
+parser.add_argument('--tile_size', default=4096, type=int, help='Size of the valid centre of'
+                    ' each tile at level 0, default 4096')
+parser.add_argument('--halo', default=None, type=int, help='Context added on every side of a'
+                    ' tile at level 0 and cropped after prediction, default image_size//2 from the config')
+parser.add_argument('--roi_masking', default=True, type=int, help='Zero the probabilities outside'
+                    ' the tissue mask, default True')
+
+# Total down-sampling of the encoders, the network input has to be a multiple of it
+NETWORK_STRIDE = 32
+
+
+def round_up(value, multiple):
+    return int(np.ceil(value / float(multiple)) * multiple)
+
+
+def get_tile_grid(mask, resolution, tile_size):
+    """
+    Level 0 top-left corners of all the tiles that contain tissue
+    """
+    X_mask, Y_mask = mask.shape
+    tile_mask = tile_size // resolution
+    tiles = []
+    for x_mask in range(0, X_mask, tile_mask):
+        for y_mask in range(0, Y_mask, tile_mask):
+            if np.any(mask[x_mask:x_mask + tile_mask, y_mask:y_mask + tile_mask]):
+                tiles.append((x_mask * resolution, y_mask * resolution))
+    return tiles
+
+
+def downsample_tile(tile, resolution):
+    """
+    Block average a (X, Y) level 0 prediction down to the heatmap level
+    """
+    X, Y = tile.shape
+    return tile.reshape(X // resolution, resolution, Y // resolution, resolution).mean(axis=(1, 3))
+
+
+def get_probs_map_tiled(model, slide, mask, level, tile_size=4096, halo=256, roi_masking=True):
+    """
+    Generate probability map by predicting large tiles with a halo of context
+    and keeping only their valid centre, so each pixel is predicted once.
+
+    Arguments:
+        model: fully convolutional Keras model, built with input shape (None, None)
+        slide: openslide object of the WSI
+        mask: tissue mask at `level`, indexed [x, y]
+        level: level of the tissue mask and of the returned heatmap
+        tile_size: size of the valid centre of a tile at level 0
+        halo: context on every side of a tile at level 0, ideally the receptive field
+        roi_masking: zero the probabilities outside the tissue mask
+    """
+    resolution = pow(2, level)
+    tile_size = round_up(tile_size, max(resolution, NETWORK_STRIDE))
+    halo = round_up(halo, NETWORK_STRIDE // 2)
+    read_size = tile_size + 2 * halo
+    probs_map = np.zeros(mask.shape, dtype=np.float32)
+    map_x_size, map_y_size = mask.shape
+    tiles = get_tile_grid(mask, resolution, tile_size)
+    num_tiles = len(tiles)
+
+    time_now = time.time()
+    for count, (x, y) in enumerate(tiles):
+        img = slide.read_region((x - halo, y - halo), 0, (read_size, read_size)).convert('RGB')
+        img = (np.asarray(img, dtype=np.float32) - 128.0)/128.0
+        y_pred = model.predict(img[np.newaxis], batch_size=1, verbose=0)[0]
+        # PIL image: H x W, i.e. (y, x) -> transpose to the (x, y) heatmap layout
+        valid = y_pred[halo:halo + tile_size, halo:halo + tile_size, 1].T
+        valid = downsample_tile(valid, resolution)
+
+        x_mask, y_mask = x // resolution, y // resolution
+        x_max = min(x_mask + valid.shape[0], map_x_size)
+        y_max = min(y_mask + valid.shape[1], map_y_size)
+        probs_map[x_mask:x_max, y_mask:y_max] = valid[0:x_max - x_mask, 0:y_max - y_mask]
+
+        time_spent = time.time() - time_now
+        time_now = time.time()
+        logging.info(
+            '{}, tile : {}/{}, Run Time : {:.2f}'
+            .format(time.strftime("%Y-%m-%d %H:%M:%S"), count + 1, num_tiles, time_spent))
+
+    if roi_masking:
+        probs_map *= (mask > 0)
+    return probs_map
+
+
+def load_fcn_model(model_name, model_path, cache_dir=None):
+    architecture = 'inception_resnet_v2_unet' if model_name == 'inception' else 'unet_densenet121'
+    model = load_model(architecture, model_path, cache_dir=cache_dir)
+    print ("Loaded Model Weights from", model_path)
+    return model
+
+
+def load_tissue_mask(slide, mask_path, level):
+    if mask_path is None:
+        return TissueMaskGeneration(slide, level)
+    if mask_path.endswith('.npy'):
+        return np.load(mask_path)
+    mask_obj = openslide.OpenSlide(mask_path)
+    return np.array(mask_obj.read_region((0, 0), level,
+                    mask_obj.level_dimensions[level]).convert('L')).T
+
+
+def run(args):
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.GPU
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.cfg_path) as f:
+        cfg = json.load(f)
+    halo = args.halo if args.halo is not None else cfg['image_size']//2
+
+    core_config = tf.ConfigProto()
+    core_config.gpu_options.allow_growth = True
+    session = tf.Session(config=core_config)
+    K.set_session(session)
+
+    model = load_fcn_model(args.model, args.model_path, args.model_cache)
+
+    save_dir = os.path.dirname(args.probs_map_path)
+    if save_dir and not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    slide = openslide.OpenSlide(args.wsi_path)
+    mask = load_tissue_mask(slide, args.mask_path, args.level)
+    probs_map = get_probs_map_tiled(model, slide, mask, args.level, tile_size=args.tile_size,
+                                    halo=halo, roi_masking=args.roi_masking)
+    np.save(args.probs_map_path, probs_map)
+
+
+def main():
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
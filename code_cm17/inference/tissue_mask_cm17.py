@@ -7,7 +7,6 @@ import numpy as np
 import openslide
 from skimage.color import rgb2hsv
 from skimage.filters import threshold_otsu
-import matplotlib.pyplot as plt
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../../')
 
@@ -52,6 +51,8 @@ def run(args):
         os.makedirs(dirname)
 
     np.save(args.npy_path, tissue_mask)
+    # pyplot is slow to import, only loaded for the preview
+    import matplotlib.pyplot as plt
     plt.imshow(tissue_mask.T)
     plt.savefig(os.path.dirname(args.npy_path) + '/' + os.path.basename(args.npy_path).split('.')[0]+'.png')
 
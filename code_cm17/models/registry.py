@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import importlib
+import numpy as np
+
+# name: (module, builder), the builders are imported when first used
+ARCHITECTURES = {
+    'unet_densenet121': ('models.seg_models', 'unet_densenet121'),
+    'inception_resnet_v2_unet': ('models.seg_models', 'get_inception_resnet_v2_unet_softmax'),
+    'deeplabv3p': ('models.deeplabv3p_original', 'Deeplabv3'),
+}
+CACHE_ENV = 'CM17_MODEL_CACHE'
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'cm17', 'models')
+# byte alignment of every weight array in weights.bin
+ALIGNMENT = 64
+FORMAT_VERSION = 1
+
+# models already loaded by this process, keyed as the artifacts
+_LOADED = {}
+
+
+def default_cache_dir():
+    return os.path.expanduser(os.environ.get(CACHE_ENV, DEFAULT_CACHE_DIR))
+
+
+def build_model(architecture, input_shape=(None, None), **kwargs):
+    """
+    Keras model of a registered architecture without weights, input_shape
+    is (H, W), None for fully convolutional inference on any patch size.
+    kwargs go to the builder (e.g. OS=16 for deeplabv3p).
+    """
+    if architecture not in ARCHITECTURES:
+        raise ValueError('Unknown architecture {}, expected one of {}'.format(
+            architecture, sorted(ARCHITECTURES)))
+    module, builder = ARCHITECTURES[architecture]
+    builder = getattr(importlib.import_module(module), builder)
+    if architecture == 'deeplabv3p':
+        options = dict(weights=None, classes=2, activation='softmax', backbone='xception', OS=16)
+        options.update(kwargs)
+        return builder(input_shape=tuple(input_shape) + (3,), **options)
+    return builder(tuple(input_shape), weights=None, **kwargs)
+
+
+def file_sha1(path, chunk_size=1 << 24):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def weights_hash(weights_path, cache_dir):
+    """
+    sha1 of a weights file, remembered in cache_dir/hashes.json against the
+    file size and modification time so unchanged files are hashed once
+    """
+    weights_path = os.path.abspath(weights_path)
+    stat = os.stat(weights_path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    hashes_path = os.path.join(cache_dir, 'hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_path):
+        try:
+            with open(hashes_path) as f:
+                hashes = json.load(f)
+        except ValueError:
+            hashes = {}
+    entry = hashes.get(weights_path)
+    if entry is not None and entry['signature'] == signature:
+        return entry['sha1']
+    sha1 = file_sha1(weights_path)
+    hashes[weights_path] = {'signature': signature, 'sha1': sha1}
+    tmp_path = '{}.{}.tmp'.format(hashes_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(hashes, f, indent=1)
+    os.replace(tmp_path, hashes_path)
+    return sha1
+
+
+def artifact_key(architecture, weights_sha1, input_shape, kwargs):
+    """
+    Name of the artifact of a built, weight-loaded model
+    """
+    import tensorflow as tf
+    config = json.dumps([FORMAT_VERSION, tf.__version__, architecture, list(input_shape),
+                         sorted(kwargs.items())])
+    shape = 'x'.join('any' if size is None else str(size) for size in input_shape)
+    return '{}-{}-{}-{}'.format(architecture, shape, weights_sha1[:16],
+                                hashlib.sha1(config.encode()).hexdigest()[:8])
+
+
+def save_artifact(model, path):
+    """
+    Write the model as path/architecture.json, path/weights.bin (all weights
+    back to back, aligned, little endian) and path/manifest.json (dtype,
+    shape and offset of each weight). Written to a temporary directory and
+    renamed, concurrent writers of the same artifact are harmless.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, 'architecture.json'), 'w') as f:
+        f.write(model.to_json())
+    entries = []
+    offset = 0
+    with open(os.path.join(tmp_path, 'weights.bin'), 'wb') as f:
+        for weight in model.get_weights():
+            weight = np.ascontiguousarray(weight, dtype=np.dtype(weight.dtype).newbyteorder('<'))
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            f.write(weight.tobytes())
+            entries.append({'dtype': weight.dtype.str, 'shape': list(weight.shape), 'offset': offset})
+            offset += weight.nbytes
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'weights': entries}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process wrote it first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def mapped_weights(path):
+    """
+    Read-only views of path/weights.bin, one per weight: the file is memory
+    mapped, processes loading the same artifact share its pages
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    weights_bin = os.path.join(path, 'weights.bin')
+    if os.path.getsize(weights_bin) == 0:
+        return [np.zeros(entry['shape'], dtype=entry['dtype']) for entry in manifest['weights']]
+    buffer = np.memmap(weights_bin, dtype=np.uint8, mode='r')
+    return [np.ndarray(tuple(entry['shape']), dtype=np.dtype(entry['dtype']), buffer=buffer,
+                       offset=entry['offset']) for entry in manifest['weights']]
+
+
+def model_from_artifact(path, architecture, input_shape, kwargs):
+    """
+    Model of an artifact: graph from architecture.json (falls back to the
+    builder if it does not deserialize), weights from the mapped file
+    """
+    import tensorflow as tf
+    from tensorflow.keras import backend as K
+    from tensorflow.keras.models import model_from_json
+    from tensorflow.keras.activations import relu
+    with open(os.path.join(path, 'architecture.json')) as f:
+        architecture_json = f.read()
+    try:
+        # the Lambda layers of the models refer to these names
+        model = model_from_json(architecture_json, custom_objects={'tf': tf, 'K': K, 'relu': relu,
+                                                                   'np': np})
+    except Exception as e:
+        logging.warning('Rebuilding {}, architecture.json did not load: {}'.format(architecture, e))
+        model = build_model(architecture, input_shape, **kwargs)
+    model.set_weights(mapped_weights(path))
+    return model
+
+
+def load_model(architecture, weights_path, input_shape=(None, None), cache_dir=None, **kwargs):
+    """
+    Built model of a registered architecture with the weights of an h5
+    file, through a cache of fast-loading artifacts keyed by architecture,
+    weights hash, input shape and builder arguments.
+
+    The first load builds the model, loads the h5 weights and writes the
+    artifact into cache_dir (default $CM17_MODEL_CACHE or
+    ~/.cache/cm17/models); later loads, in any process, read its json graph
+    and memory map its weights. Within a process the model is built once.
+    cache_dir=False disables the cache.
+    """
+    start = time.time()
+    input_shape = tuple(input_shape)
+    if cache_dir is False:
+        model = build_model(architecture, input_shape, **kwargs)
+        model.load_weights(weights_path)
+        return model
+    cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    key = artifact_key(architecture, weights_hash(weights_path, cache_dir), input_shape, kwargs)
+    if key in _LOADED:
+        return _LOADED[key]
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        model = model_from_artifact(path, architecture, input_shape, kwargs)
+        source = 'cache'
+    else:
+        model = build_model(architecture, input_shape, **kwargs)
+        model.load_weights(weights_path)
+        save_artifact(model, path)
+        source = 'h5'
+    logging.info('Loaded {} from {} ({}) in {:.2f}s'.format(architecture, weights_path, source,
+                                                           time.time() - start))
+    _LOADED[key] = model
+    return model
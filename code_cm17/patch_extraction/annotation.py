@@ -0,0 +1,384 @@
+import argparse
+import json
+import xml.etree.cElementTree as ET
+import numpy as np
+
+
+# python3 annotation.py ../../data/lesion_annotations/tumor_001.xml ../../data/json/tumor_001.json
+
+# ASAP annotation groups (CAMELYON16/17): tumor regions and the exclusion
+# (normal) regions drawn inside them
+POSITIVE_GROUPS = ('Tumor', '_0', '_1', 'metastases')
+NEGATIVE_GROUPS = ('Exclusion', '_2')
+# polygons named BBOX delimit the annotated regions
+BBOX_NAME = 'BBOX'
+# elements of the (points x edges) / (rows x edges) work matrices
+CHUNK_ELEMENTS = 1 << 22
+# cells per axis of the grid index
+MAX_GRID_CELLS = 1024
+
+
+def edges_of(vertices):
+    """
+    (x0, y0, x1, y1) arrays of the closed polygon edges, horizontal edges dropped
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    x0, y0 = vertices[:, 0], vertices[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    keep = y0 != y1
+    return x0[keep], y0[keep], x1[keep], y1[keep]
+
+
+def points_in_polygon(points, vertices):
+    """
+    Even-odd point in polygon test of an [M, 2] array of (x, y) points,
+    vectorized over points and edges
+
+    Returns:
+        [M] bool array
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    x0, y0, x1, y1 = edges_of(vertices)
+    inside = np.zeros(len(points), dtype=bool)
+    if len(x0) == 0:
+        return inside
+    slope = (x1 - x0) / (y1 - y0)
+    step = max(1, CHUNK_ELEMENTS // len(x0))
+    for start in range(0, len(points), step):
+        px = points[start:start + step, 0:1]
+        py = points[start:start + step, 1:2]
+        crosses = (y0 > py) != (y1 > py)
+        crosses &= px < x0 + (py - y0) * slope
+        inside[start:start + step] = np.count_nonzero(crosses, axis=1) % 2 == 1
+    return inside
+
+
+def scanline_fill(vertices, shape):
+    """
+    Pixels of a (W, H) grid whose centers are inside the polygon (even-odd
+    rule), filled scanline by scanline
+
+    Returns:
+        [W, H] bool array, indexed [x, y]
+    """
+    width, height = shape
+    fill = np.zeros((height + 1, width + 1), dtype=np.int32)
+    x0, y0, x1, y1 = edges_of(vertices)
+    if len(x0) == 0 or width == 0 or height == 0:
+        return np.zeros((width, height), dtype=bool)
+    slope = (x1 - x0) / (y1 - y0)
+    row_min = int(max(np.floor(min(y0.min(), y1.min())), 0))
+    row_max = int(min(np.ceil(max(y0.max(), y1.max())), height))
+    step = max(1, CHUNK_ELEMENTS // len(x0))
+    for start in range(row_min, row_max, step):
+        rows = np.arange(start, min(start + step, row_max))
+        yc = rows[:, None] + 0.5
+        crosses = (y0 > yc) != (y1 > yc)
+        xs = np.where(crosses, x0 + (yc - y0) * slope, np.inf)
+        xs.sort(axis=1)
+        # even-odd crossings come in pairs, an odd last column is the inf padding
+        n_pairs = xs.shape[1] // 2
+        if n_pairs == 0:
+            continue
+        xs = xs[:, :2 * n_pairs]
+        # crossing pairs delimit the spans, pixel i is in [a, b) if a <= i + 0.5 < b
+        span_from = np.clip(np.ceil(xs[:, 0::2] - 0.5), 0, width)
+        span_to = np.clip(np.ceil(xs[:, 1::2] - 0.5), 0, width)
+        valid = np.isfinite(xs[:, 1::2])
+        row_index = np.broadcast_to(rows[:, None], valid.shape)[valid]
+        np.add.at(fill, (row_index, span_from[valid].astype(np.int64)), 1)
+        np.add.at(fill, (row_index, span_to[valid].astype(np.int64)), -1)
+    return (np.cumsum(fill, axis=1)[:height, :width] > 0).T
+
+
+class Polygon(object):
+    """
+    Polygon represented as [N, 2] array of vertices
+    """
+    def __init__(self, name, vertices):
+        """
+        Initialize the polygon.
+
+        Arguments:
+            name: string, name of the polygon
+            vertices: [N, 2] 2D numpy array of int
+        """
+        self._name = name
+        self._vertices = np.asarray(vertices)
+        self.bbox = (self._vertices[:, 0].min(), self._vertices[:, 1].min(),
+                     self._vertices[:, 0].max(), self._vertices[:, 1].max())
+
+    def __str__(self):
+        return self._name
+
+    def inside(self, coord):
+        """
+        Determine if a given coordinate is inside the polygon or not.
+
+        Arguments:
+            coord: 2 element tuple of int, e.g. (x, y)
+
+        Returns:
+            bool, if the coord is inside the polygon.
+        """
+        return bool(self.contains(np.asarray([coord]))[0])
+
+    def contains(self, points):
+        """
+        [M] bool array, which of the [M, 2] (x, y) points are inside
+        """
+        points = np.asarray(points).reshape(-1, 2)
+        x_min, y_min, x_max, y_max = self.bbox
+        inside = np.zeros(len(points), dtype=bool)
+        in_bbox = np.flatnonzero((points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+                                 (points[:, 1] >= y_min) & (points[:, 1] <= y_max))
+        inside[in_bbox] = points_in_polygon(points[in_bbox], self._vertices)
+        return inside
+
+    def vertices(self):
+
+        return np.array(self._vertices)
+
+
+class GridIndex(object):
+    """
+    Uniform grid over the polygon bounding boxes: every cell lists the
+    polygons whose bbox overlaps it, a batch of points is bucketed by cell
+    once and each polygon only tests the points of its cells.
+    """
+    def __init__(self, polygons, cell_size=None):
+        self.polygons = list(polygons)
+        if not self.polygons:
+            self.origin, self.cell_size, self.n_cells, self.cells = (0, 0), 1, (0, 0), []
+            return
+        bboxes = np.array([polygon.bbox for polygon in self.polygons], dtype=np.float64)
+        if cell_size is None:
+            # about one cell per typical polygon
+            cell_size = np.median(np.maximum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]))
+        self.origin = (bboxes[:, 0].min(), bboxes[:, 1].min())
+        extent = max(bboxes[:, 2].max() - self.origin[0], bboxes[:, 3].max() - self.origin[1])
+        cell_size = max(cell_size, extent / MAX_GRID_CELLS, 1)
+        self.cell_size = float(cell_size)
+        self.n_cells = (int((bboxes[:, 2].max() - self.origin[0]) // self.cell_size) + 1,
+                        int((bboxes[:, 3].max() - self.origin[1]) // self.cell_size) + 1)
+        # flat cell ids covered by each polygon's bbox
+        self.cells = []
+        for x_min, y_min, x_max, y_max in bboxes:
+            cx0, cy0 = self._cell(x_min, y_min)
+            cx1, cy1 = self._cell(x_max, y_max)
+            cx, cy = np.meshgrid(np.arange(cx0, cx1 + 1), np.arange(cy0, cy1 + 1), indexing='ij')
+            self.cells.append((cx * self.n_cells[1] + cy).ravel())
+
+    def _cell(self, x, y):
+        return (int((x - self.origin[0]) // self.cell_size),
+                int((y - self.origin[1]) // self.cell_size))
+
+    def query(self, points):
+        """
+        Polygon containing each point of an [M, 2] (x, y) array
+
+        Returns:
+            [M] int array, index of the (first) polygon containing the point, -1 if none
+        """
+        points = np.asarray(points).reshape(-1, 2)
+        found = np.full(len(points), -1, dtype=np.int64)
+        if not self.polygons or len(points) == 0:
+            return found
+        cx = np.floor((points[:, 0] - self.origin[0]) / self.cell_size).astype(np.int64)
+        cy = np.floor((points[:, 1] - self.origin[1]) / self.cell_size).astype(np.int64)
+        valid = (cx >= 0) & (cx < self.n_cells[0]) & (cy >= 0) & (cy < self.n_cells[1])
+        flat = np.where(valid, cx * self.n_cells[1] + cy, -1)
+        order = np.argsort(flat, kind='stable')
+        sorted_cells = flat[order]
+        for p, polygon in enumerate(self.polygons):
+            starts = np.searchsorted(sorted_cells, self.cells[p], 'left')
+            ends = np.searchsorted(sorted_cells, self.cells[p], 'right')
+            if not np.any(ends > starts):
+                continue
+            candidates = np.concatenate([order[s:e] for s, e in zip(starts, ends) if e > s])
+            candidates = candidates[found[candidates] < 0]
+            found[candidates[polygon.contains(points[candidates])]] = p
+        return found
+
+
+class Annotation(object):
+    """
+    Annotation about the regions within BBOX in terms of vertices of polygons.
+
+    The polygons (level 0 (x, y) coordinates) are held in grid indices, the
+    queries take one (x, y) coordinate or whole [M, 2] coordinate arrays.
+    """
+    def __init__(self):
+        self._bbox = []
+        self._polygons_positive = []
+        self._polygons_negative = []
+        self._path = None
+        self._indices = {}
+
+    def __str__(self):
+        return self._path
+
+    def _add(self, name, vertices, is_positive=True):
+        polygon = Polygon(name, np.asarray(vertices))
+        if name == BBOX_NAME:
+            self._bbox.append(polygon)
+        elif is_positive:
+            self._polygons_positive.append(polygon)
+        else:
+            self._polygons_negative.append(polygon)
+        self._indices = {}
+
+    def from_json(self, json_path):
+        """
+        Initialize the annotation from a json file.
+
+        Arguments:
+            json_path: string, path to the json annotation.
+        """
+        self._path = json_path
+        with open(json_path) as f:
+            annotations_json = json.load(f)
+        for annotation in annotations_json['positive']:
+            self._add(annotation['name'], annotation['vertices'])
+        for annotation in annotations_json.get('negative', []):
+            self._add(annotation['name'], annotation['vertices'], is_positive=False)
+
+    def from_xml(self, xml_path):
+        """
+        Initialize the annotation from an ASAP xml file, the polygons of the
+        tumor groups are positive, those of the exclusion groups negative.
+
+        Arguments:
+            xml_path: string, path to the xml annotation.
+        """
+        self._path = xml_path
+        root = ET.parse(xml_path).getroot()
+        for annotation in root.iter('Annotation'):
+            group = annotation.get('PartOfGroup')
+            name = annotation.get('Name')
+            if name != BBOX_NAME and group not in POSITIVE_GROUPS + NEGATIVE_GROUPS:
+                continue
+            coordinates = sorted(annotation.iter('Coordinate'), key=lambda c: int(c.get('Order', 0)))
+            vertices = np.array([[float(c.get('X')), float(c.get('Y'))] for c in coordinates])
+            if len(vertices) < 3:
+                continue
+            self._add(name, np.round(vertices).astype(np.int64), is_positive=group not in NEGATIVE_GROUPS)
+
+    def to_json(self, json_path):
+        """
+        Write the annotation in the json format read by from_json
+        """
+        def entries(polygons):
+            return [{'name': str(polygon), 'vertices': polygon.vertices().tolist()} for polygon in polygons]
+        with open(json_path, 'w') as f:
+            json.dump({'positive': entries(self._bbox + self._polygons_positive),
+                       'negative': entries(self._polygons_negative)}, f, indent=1)
+
+    def _index(self, kind):
+        if kind not in self._indices:
+            polygons = {'bbox': self._bbox, 'positive': self._polygons_positive,
+                        'negative': self._polygons_negative}[kind]
+            self._indices[kind] = GridIndex(polygons)
+        return self._indices[kind]
+
+    def _inside(self, kind, coords):
+        single = np.ndim(coords) == 1
+        inside = self._index(kind).query(np.asarray(coords).reshape(-1, 2)) >= 0
+        return bool(inside[0]) if single else inside
+
+    def inside_bbox(self, coord):
+        """
+        Determine if given coordinates are inside the BBOX polygons of the annotation.
+
+        Arguments:
+            coord: 2 element tuple of int, e.g. (x, y), or [M, 2] array of coordinates
+
+        Returns:
+            bool, or [M] bool array for an array of coordinates
+        """
+        return self._inside('bbox', coord)
+
+    def bbox_vertices(self):
+        """
+        Return the BBOX polygons, each represented as [N, 2] array of vertices
+        """
+        return list(map(lambda x: x.vertices(), self._bbox))
+
+    def inside_polygons(self, coord, is_positive=True):
+        """
+        Determine if given coordinates are inside the positive (or negative) polygons of the annotation.
+
+        Arguments:
+            coord: 2 element tuple of int, e.g. (x, y), or [M, 2] array of coordinates
+            is_positive: bool, test the positive or the negative polygons
+
+        Returns:
+            bool, or [M] bool array for an array of coordinates
+        """
+        return self._inside('positive' if is_positive else 'negative', coord)
+
+    def polygon_index(self, coords, is_positive=True):
+        """
+        Index of the polygon containing each of the [M, 2] coordinates, -1 if none
+        """
+        return self._index('positive' if is_positive else 'negative').query(coords)
+
+    def polygon_vertices(self, is_positive=True):
+        """
+        Return the polygons represented as [N, 2] array of vertices
+
+        Arguments:
+            is_positive: bool, return positive or negative polygons.
+
+        Returns:
+            list of [N, 2] 2D array of int
+        """
+        polygons = self._polygons_positive if is_positive else self._polygons_negative
+        return list(map(lambda x: x.vertices(), polygons))
+
+    def rasterize(self, dimensions, downsample=1):
+        """
+        Label mask of the annotation at a pyramid level: pixels whose center
+        is inside a positive and not inside a negative polygon.
+
+        Arguments:
+            dimensions: (width, height) of the level, e.g. slide.level_dimensions[level]
+            downsample: level 0 pixels per level pixel, e.g. slide.level_downsamples[level]
+
+        Returns:
+            [width, height] bool array, indexed [x, y] as the tissue masks
+        """
+        width, height = dimensions
+        mask = np.zeros((width, height), dtype=bool)
+        for polygons, value in ((self._polygons_positive, True), (self._polygons_negative, False)):
+            for polygon in polygons:
+                vertices = polygon.vertices() / float(downsample)
+                x0 = int(max(np.floor(vertices[:, 0].min()), 0))
+                y0 = int(max(np.floor(vertices[:, 1].min()), 0))
+                x1 = int(min(np.ceil(vertices[:, 0].max()) + 1, width))
+                y1 = int(min(np.ceil(vertices[:, 1].max()) + 1, height))
+                if x0 >= x1 or y0 >= y1:
+                    continue
+                fill = scanline_fill(vertices - (x0, y0), (x1 - x0, y1 - y0))
+                if value:
+                    mask[x0:x1, y0:y1] |= fill
+                else:
+                    mask[x0:x1, y0:y1] &= ~fill
+        return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert an ASAP xml annotation to'
+                                     ' the json annotation format')
+    parser.add_argument('xml_path', default=None, metavar='XML_PATH', type=str,
+                        help='Path to the input ASAP xml annotation')
+    parser.add_argument('json_path', default=None, metavar='JSON_PATH', type=str,
+                        help='Path to the output json annotation')
+    args = parser.parse_args()
+    anno = Annotation()
+    anno.from_xml(args.xml_path)
+    anno.to_json(args.json_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,6 @@ import numpy as np
 from six.moves import range
 import openslide
 import tensorflow as tf
-from torchvision import transforms  # noqa
-from torch.utils.data import DataLoader, Dataset
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 from helpers.utils import *
@@ -33,6 +31,8 @@ class AutomineDataGeneratorCoordFly(tf.keras.utils.Sequence):
         self.coord_path = coord_path
         self.image_size = image_size
         self.n_channels = n_channels
+        # imported here, the inference side of this module does not need torch
+        from torchvision import transforms
         self._color_jitter = transforms.ColorJitter(64.0/255, 0.75, 0.25, 0.04)
         self.transform = transform
         self.shuffle = shuffle
@@ -133,7 +133,7 @@ class AutomineDataGeneratorCoordFly(tf.keras.utils.Sequence):
         return X, y
 
 
-class WSIStridedPatchDataset(Dataset):
+class WSIStridedPatchDataset(object):
     """
     Data producer that generate all the square grids, e.g. 3x3, of patches,
     from a WSI and its tissue mask, and their corresponding indices with
@@ -19,13 +19,22 @@ from torch.utils.data import DataLoader, Dataset
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 from helpers.utils import *
+from dataloader.samplers import HierarchicalSampler, slide_keys, new_seed, batch_rng, BALANCED, PROPORTIONAL
 
 # DataLoader Implementation
 class DataGeneratorCoordFly(tf.keras.utils.Sequence):
     'Generates data for Keras'
     def __init__(self, wsi_path, mask_path, coord_path, image_size=(1024, 1024), batch_size=32, n_classes=2, n_channels=3,
-                  shuffle=True, level=0, transform=None):
-        'Initialization'
+                  shuffle=True, level=0, transform=None, balance_slides=False, seed=None):
+        '''
+        Initialization
+
+        shuffle: draw the batches at random (alias table over slide -> coordinate,
+            with replacement), otherwise walk the list in order (e.g. validation)
+        balance_slides: draw the slides equally often, instead of in proportion
+            to their number of coordinates
+        seed: base seed of the draws, default from the global numpy state
+        '''
         self.batch_size = batch_size
         self.n_classes = n_classes
         self.wsi_path = wsi_path
@@ -45,6 +54,12 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
             self.coords.append((pid, x_center, y_center))
         f.close()
         self._num_image = len(self.coords)            
+        self._seed = new_seed() if seed is None else seed
+        self._epoch = 0
+        self.sampler = None
+        if self.shuffle:
+            level_weights = [BALANCED, BALANCED] if balance_slides else [PROPORTIONAL, PROPORTIONAL]
+            self.sampler = HierarchicalSampler(slide_keys([c[0] for c in self.coords]), level_weights)
         self.on_epoch_end()
 
     def __len__(self):
@@ -59,8 +74,14 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
 
     def on_epoch_end(self):
         'Updates indexes after each epoch'
-        if self.shuffle == True:
-            random.shuffle(self.coords)
+        # shuffled batches are drawn by the sampler, seeded by (seed, epoch,
+        # batch index), the list never moves
+        self._epoch += 1
+
+    def _batch_coords(self, index):
+        if self.sampler is None:
+            return self.coords[index*self.batch_size:(index+1)*self.batch_size]
+        return [self.coords[i] for i in self.sampler.sample(self.batch_size, batch_rng(self._seed, self._epoch, index))]
 
     def _get_one_hot(self, targets):
         res = np.eye(self.n_classes)[np.array(targets).reshape(-1)]
@@ -106,8 +127,7 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
         X = np.empty((self.batch_size, *self.image_size, self.n_channels))
         y = np.empty((self.batch_size, *self.image_size, self.n_classes))
 
-        for i in range(self.batch_size):
-            pid, x_center, y_center = self.coords[(index)*self.batch_size+i]        
+        for i, (pid, x_center, y_center) in enumerate(self._batch_coords(index)):
             # Generate data
             x_top_left = int(int(x_center) - self.image_size[0] / 2)
             y_top_left = int(int(y_center) - self.image_size[1] / 2)
@@ -135,8 +155,17 @@ class DataGeneratorCoordFly(tf.keras.utils.Sequence):
 class DataGeneratorCoordFlyCM17(tf.keras.utils.Sequence):
     'Generates data for Keras'
     def __init__(self, coord_path, image_size=(1024, 1024), batch_size=32, n_classes=2, n_channels=3,
-                  shuffle=True, level=0, transform=None):
-        'Initialization'
+                  shuffle=True, level=0, transform=None, balance_slides=False, seed=None):
+        '''
+        Initialization
+
+        shuffle: draw the batches at random (alias table over centre -> slide ->
+            coordinate, with replacement), otherwise walk the list in order (e.g.
+            validation)
+        balance_slides: draw the centres and the slides equally often, instead of
+            in proportion to their number of coordinates
+        seed: base seed of the draws, default from the global numpy state
+        '''
         self.batch_size = batch_size
         self.n_classes = n_classes
         self.coord_path = coord_path
@@ -154,6 +183,12 @@ class DataGeneratorCoordFlyCM17(tf.keras.utils.Sequence):
             self.coords.append((pid_path, mask_path, x_center, y_center))
         f.close()
         self._num_image = len(self.coords)            
+        self._seed = new_seed() if seed is None else seed
+        self._epoch = 0
+        self.sampler = None
+        if self.shuffle:
+            level_weights = [BALANCED, BALANCED] if balance_slides else [PROPORTIONAL, PROPORTIONAL]
+            self.sampler = HierarchicalSampler(slide_keys([c[0] for c in self.coords]), level_weights)
         self.on_epoch_end()
 
     def __len__(self):
@@ -168,8 +203,14 @@ class DataGeneratorCoordFlyCM17(tf.keras.utils.Sequence):
 
     def on_epoch_end(self):
         'Updates indexes after each epoch'
-        if self.shuffle == True:
-            random.shuffle(self.coords)
+        # shuffled batches are drawn by the sampler, seeded by (seed, epoch,
+        # batch index), the list never moves
+        self._epoch += 1
+
+    def _batch_coords(self, index):
+        if self.sampler is None:
+            return self.coords[index*self.batch_size:(index+1)*self.batch_size]
+        return [self.coords[i] for i in self.sampler.sample(self.batch_size, batch_rng(self._seed, self._epoch, index))]
 
     def _get_one_hot(self, targets):
         res = np.eye(self.n_classes)[np.array(targets).reshape(-1)]
@@ -215,8 +256,7 @@ class DataGeneratorCoordFlyCM17(tf.keras.utils.Sequence):
         X = np.empty((self.batch_size, *self.image_size, self.n_channels))
         y = np.empty((self.batch_size, *self.image_size, self.n_classes))
 
-        for i in range(self.batch_size):
-            pid_path, mask_path, x_center, y_center = self.coords[(index)*self.batch_size+i]        
+        for i, (pid_path, mask_path, x_center, y_center) in enumerate(self._batch_coords(index)):
             # Generate data
             x_top_left = int(int(x_center) - self.image_size[0] / 2)
             y_top_left = int(int(y_center) - self.image_size[1] / 2)
@@ -538,7 +578,7 @@ if __name__ == '__main__':
                           'batch_size': 16,
                           'n_classes': 2,
                           'n_channels': 3,
-                          'shuffle': True,
+                          'shuffle': False,
                           'level': 0,
                           'transform': None
                          }
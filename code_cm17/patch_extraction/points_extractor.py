@@ -16,11 +16,9 @@ import pandas as pd
 import cv2
 from skimage.color import rgb2hsv
 from skimage.filters import threshold_otsu
-from skimage.measure import points_in_poly
 from skimage import feature
 from skimage.feature import canny
 from sklearn.model_selection import KFold
-import copy
 import glob
 import json
 import random
@@ -30,6 +28,9 @@ from collections import defaultdict
 np.random.seed(0)
 import math
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from patch_extraction.annotation import Polygon, Annotation
+
 parser = argparse.ArgumentParser()
 parser.add_argument('mode' )
 parser.add_argument('tumor_type')
@@ -95,131 +96,6 @@ def ReadWholeSlideImage(image_path, level=None, RGB=True, read_image=True):
 
     return wsi_obj, image_data, level
 
-class Polygon(object):
-    """
-    Polygon represented as [N, 2] array of vertices
-    """
-    def __init__(self, name, vertices):
-        """
-        Initialize the polygon.
-
-        Arguments:
-            name: string, name of the polygon
-            vertices: [N, 2] 2D numpy array of int
-        """
-        self._name = name
-        self._vertices = vertices
-
-    def __str__(self):
-        return self._name
-
-    def inside(self, coord):
-        """
-        Determine if a given coordinate is inside the polygon or not.
-
-        Arguments:
-            coord: 2 element tuple of int, e.g. (x, y)
-
-        Returns:
-            bool, if the coord is inside the polygon.
-        """
-        return points_in_poly([coord], self._vertices)[0]
-
-    def vertices(self):
-
-        return np.array(self._vertices)
-
-class Annotation(object):
-    """
-    Annotation about the regions within BBOX in terms of vertices of polygons.
-    """
-    def __init__(self):
-        self._bbox = []
-        self._polygons_positive = []
-
-    def __str__(self):
-        return self._json_path
-
-    def from_json(self, json_path):
-        """
-        Initialize the annotation from a json file.
-
-        Arguments:
-            json_path: string, path to the json annotation.
-        """
-        self._json_path = json_path
-        with open(json_path) as f:
-            annotations_json = json.load(f)
-
-        for annotation in annotations_json['positive']:
-            name = annotation['name']
-            vertices = np.array(annotation['vertices'])      
-            polygon = Polygon(name, vertices)
-            if name == 'BBOX':
-                self._bbox.append(polygon)
-            else:
-                self._polygons_positive.append(polygon)
-                
-    def inside_bbox(self, coord):
-        """
-        Determine if a given coordinate is inside the positive polygons of the annotation.
-
-        Arguments:
-            coord: 2 element tuple of int, e.g. (x, y)
-
-        Returns:
-            bool, if the coord is inside the positive/negative polygons of the
-            annotation.
-        """
-        bboxes = copy.deepcopy(self._bbox)
-        for bbox in bboxes:
-            if bbox.inside(coord):
-                return True
-        return False
-    
-    def bbox_vertices(self):
-        """
-        Return the polygon represented as [N, 2] array of vertices
-
-        Arguments:
-            is_positive: bool, return positive or negative polygons.
-
-        Returns:
-            [N, 2] 2D array of int
-        """
-        return list(map(lambda x: x.vertices(), self._bbox))
-    
-    def inside_polygons(self, coord):
-        """
-        Determine if a given coordinate is inside the positive polygons of the annotation.
-
-        Arguments:
-            coord: 2 element tuple of int, e.g. (x, y)
-
-        Returns:
-            bool, if the coord is inside the positive/negative polygons of the
-            annotation.
-        """
-        polygons = copy.deepcopy(self._polygons_positive)
-        
-        for polygon in polygons:
-            if polygon.inside(coord):
-                return True
-
-        return False
-
-    def polygon_vertices(self):
-        """
-        Return the polygon represented as [N, 2] array of vertices
-
-        Arguments:
-            is_positive: bool, return positive or negative polygons.
-
-        Returns:
-            [N, 2] 2D array of int
-        """
-        return list(map(lambda x: x.vertices(), self._polygons_positive))
-    
 def TissueMask(img_RGB, level):
     RGB_min = 50
     # note the shape of img_RGB is the transpose of slide.level_dimensions
@@ -240,7 +116,7 @@ def ShuffleAndSampleFirstN(data, n=10):
     """
     Sampling by shuffling the data, then get only the first n elements.";
     """
-    data=copy.deepcopy(data);
+    data=list(data);
     random.shuffle(data);
     sample=data[0:n];
     return sample
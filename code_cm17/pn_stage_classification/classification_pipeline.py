@@ -18,6 +18,11 @@ from sklearn.metrics import confusion_matrix
 import sklearn
 from datetime import datetime
 import time
+import json
+import hashlib
+import argparse
+import joblib
+from joblib import Parallel, delayed
 from xgboost import XGBClassifier
 from sklearn.metrics import accuracy_score
 from sklearn.model_selection import cross_val_score, cross_val_predict
@@ -30,6 +35,8 @@ from sklearn.neural_network import MLPClassifier
 from sklearn.neighbors import KNeighborsClassifier
 
 sys.path.append("../")
+from helpers.feature_io import load_features
+from pn_staging import write_submission
 
 # Stage Mapping
 NEGATIVE = 'negative'
@@ -54,6 +61,17 @@ END_COL = 32
 class_names = [NEGATIVE, ITC, MICRO, MACRO]
 class_names_for_cm = [NEGATIVE, ITC, MICRO, MACRO]
 
+# Fitted models are persisted in <MODEL_CACHE_DIR>/<training data hash>
+MODEL_CACHE_DIR = '../predictions/Models_{}'.format(MODEL_NAME)
+MODEL_MANIFEST = 'manifest.json'
+
+parser = argparse.ArgumentParser(description='Train, validate and test the pN-stage classifiers')
+parser.add_argument('--model_dir', default=None, type=str, help='Directory of persisted models,'
+                    ' only the final test set is predicted with them, no training')
+parser.add_argument('--testing_data', default=testing_data, type=str, help='Feature file of the'
+                    ' final test set')
+parser.add_argument('--retrain', default=0, type=int, help='Ignore the model cache and refit, default 0')
+
 def visualize_tree(tree, feature_names, save_dir='./'):
     """Create tree png using graphviz.
     Args
@@ -107,11 +125,106 @@ def drop_defective_cases(df, feature_list):
     return df
 
 
+def training_data_hash(X, y, params=None):
+    """
+    sha1 of the training features, targets and fitting parameters, the key of the model cache
+    """
+    sha1 = hashlib.sha1()
+    # X is a DataFrame, or an ndarray once scaled
+    if hasattr(X, 'columns'):
+        sha1.update(json.dumps([str(column) for column in X.columns]).encode())
+    sha1.update(np.ascontiguousarray(np.asarray(X), dtype=np.float64).tobytes())
+    sha1.update(np.ascontiguousarray(np.asarray(y), dtype=np.int64).tobytes())
+    sha1.update(json.dumps(params or {}, sort_keys=True).encode())
+    return sha1.hexdigest()[:16]
+
+
+def estimator_key(clf, X, y):
+    """
+    Cache key of a persisted estimator: the training data, every (nested)
+    parameter of the estimator and the sklearn version it is pickled with
+    """
+    params = repr(sorted(clf.get_params(deep=True).items()))
+    return training_data_hash(X, y, {'class': type(clf).__name__, 'params': params,
+                                     'sklearn': sklearn.__version__})
+
+
+def _fit(clf, X, y):
+    return clf.fit(X, y)
+
+
+def fit_cached(estimators, model_dir, retrain=False):
+    """
+    Fit the estimators not yet persisted in model_dir and persist them, the
+    already persisted ones are loaded instead. A persisted estimator is only
+    reused if its <name>.key (estimator_key) matches, otherwise it is refitted.
+    Args
+    ----
+    estimators -- dict name -> (estimator, X, y)
+    model_dir -- directory of the <name>.joblib files
+    Returns
+    -------
+    dict name -> fitted estimator
+    """
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    fitted = {}
+    todo = []
+    keys = {}
+    for name, (clf, X, y) in estimators.items():
+        path = os.path.join(model_dir, name + '.joblib')
+        key_path = os.path.join(model_dir, name + '.key')
+        keys[name] = estimator_key(clf, X, y)
+        cached_key = None
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                cached_key = f.read().strip()
+        if os.path.exists(path) and cached_key == keys[name] and not retrain:
+            fitted[name] = joblib.load(path)
+        else:
+            todo.append(name)
+    # forests parallelize internally over all the cores, the other estimators are fitted side by side
+    for name in [name for name in todo if getattr(estimators[name][0], 'n_jobs', None) == -1]:
+        clf, X, y = estimators[name]
+        fitted[name] = _fit(clf, X, y)
+    rest = [name for name in todo if name not in fitted]
+    if rest:
+        results = Parallel(n_jobs=len(rest))(delayed(_fit)(*estimators[name]) for name in rest)
+        fitted.update(zip(rest, results))
+    for name in todo:
+        joblib.dump(fitted[name], os.path.join(model_dir, name + '.joblib'))
+        with open(os.path.join(model_dir, name + '.key'), 'w') as f:
+            f.write(keys[name])
+    return fitted
+
+
+def save_scaler(scaler, features, model_dir):
+    joblib.dump(scaler, os.path.join(model_dir, 'scaler.joblib'))
+    with open(os.path.join(model_dir, MODEL_MANIFEST), 'w') as f:
+        json.dump({'features': features, 'class_names': class_names, 'model_name': MODEL_NAME}, f, indent=1)
+
+
+def load_models(model_dir):
+    """
+    Persisted models of a model directory
+    Returns
+    -------
+    (dict name -> estimator, scaler, feature list)
+    """
+    with open(os.path.join(model_dir, MODEL_MANIFEST)) as f:
+        manifest = json.load(f)
+    models = {}
+    for file_name in sorted(os.listdir(model_dir)):
+        if file_name.endswith('.joblib') and file_name != 'scaler.joblib':
+            models[file_name[:-len('.joblib')]] = joblib.load(os.path.join(model_dir, file_name))
+    return models, joblib.load(os.path.join(model_dir, 'scaler.joblib')), manifest['features']
+
+
 def load_dataframe(csv_file, shuffle=False):
     """
-    Load Patient information from the csv file as a dataframe
+    Load Patient information from the feature file (csv, npz, parquet or feather) as a dataframe
     """
-    df = pd.read_csv(csv_file)
+    df = load_features(csv_file)
     if shuffle:
         df = df.sample(frac=1).reset_index(drop=True)
     # patient_data = df.to_dict("records")
@@ -154,9 +267,12 @@ def plot_confusion_matrix(cm, classes,
     # Tweak spacing to prevent clipping of tick-labels
     plt.subplots_adjust(bottom=0.2)
 
-def ModelTester(clf, final_test_path, name, scaler, save_dir='./', label_available=False, prediction_csv=None):
+def ModelTester(clf, final_test_path, name, scaler, save_dir='./', label_available=False, prediction_csv=None,
+                stage_submission=True):
     """
     This code does the cardiac disease classification (5-classes)
+    With stage_submission the patient pN stages are computed from the node
+    predictions and written to save_dir/<name>_submission_<time>.csv
     """
     class_names = [NEGATIVE, ITC, MICRO, MACRO]
     df = load_dataframe(final_test_path)
@@ -180,6 +296,11 @@ def ModelTester(clf, final_test_path, name, scaler, save_dir='./', label_availab
         target.write("\n")
     target.close()
     print (classes)
+    if stage_submission:
+        node_df = pd.DataFrame({'patient': df['patient_name'], 'stage': [class_names[pred] for pred in y_pred]})
+        patient_df = write_submission(save_dir+'/'+ name+'_submission_{}.csv'.format(time.strftime("%Y%m%d_%H%M%S")),
+                                      node_df)
+        print (patient_df['pn_stage'].value_counts().to_dict())
     if label_available:
         y_true,_ = encode_target(df, 'stage', stage_label_map)
         accuracy = accuracy_score(y_true['stage'], y_pred)
@@ -191,9 +312,20 @@ def ModelTester(clf, final_test_path, name, scaler, save_dir='./', label_availab
             df.to_csv(prediction_csv,  index=False)
 
 if __name__ == '__main__':
+    args = parser.parse_args()
+    testing_data = args.testing_data
 
     save_dir ='../predictions/Report_{}'.format(time.strftime("%Y%m%d_%H%M%S"))
     os.makedirs(save_dir)   
+    if args.model_dir is not None:
+        ##################### Persisted models on Final Test data ###########################
+        models, scaler, _ = load_models(args.model_dir)
+        ModelTester(models['Ensemble'], testing_data, name='EnsembleOnFinalTestSet', scaler=scaler,
+                    save_dir=save_dir, label_available=False, prediction_csv=None)
+        ModelTester(models['RF_scaled'], testing_data, name='RFOnFinalTestSet', scaler=scaler,
+                    save_dir=save_dir, label_available=False, prediction_csv=None)
+        sys.exit(0)
+
     # Prepare the feature vectors for training and validation
     train_df, train_targets = encode_target(load_dataframe(training_data), 'stage', stage_label_map)
 
@@ -204,10 +336,25 @@ if __name__ == '__main__':
     print(len(train_df))
     X_train = train_df[features]
     y_train = train_df['stage']
+    n_estimators = 1000
+    model_dir = os.path.join(MODEL_CACHE_DIR, training_data_hash(X_train, y_train, {'n_estimators': n_estimators,
+                                                                         'sklearn': sklearn.__version__}))
+    print ('Models cached in', model_dir)
+    scaler = StandardScaler() 
+    scaler.fit(X_train) 
+    X_scaled = scaler.transform(X_train)
+
+    # One forest serves the training predictions and the feature importances
+    models = fit_cached({'DT': (DecisionTreeClassifier(min_samples_split=10, random_state=99), X_train, y_train),
+                         'RF': (RandomForestClassifier(n_estimators=n_estimators, random_state=0, n_jobs=-1),
+                                X_train, y_train),
+                         'MLP': (MLPClassifier(hidden_layer_sizes=(100, 100), random_state=1, max_iter=1000),
+                                 X_scaled, y_train)},
+                        model_dir, retrain=args.retrain)
+    save_scaler(scaler, features, model_dir)
 
     ################ Model trained on simple decision train #############
-    DT_clf = DecisionTreeClassifier(min_samples_split=10, random_state=99)
-    DT_clf.fit(X_train, y_train)
+    DT_clf = models['DT']
     print ('Generating features learnt from decision trees')
     # Code to visualize learnt features
     visualize_tree(DT_clf, features, save_dir=save_dir)
@@ -218,9 +365,7 @@ if __name__ == '__main__':
 
     
     ################# Model trained on Random Forest ##################
-    n_estimators = 1000
-    RF_clf = RandomForestClassifier(n_estimators=n_estimators)
-    RF_clf.fit(X_train, y_train)
+    RF_clf = models['RF']
     print ('Results of training on Random Forest:')
     print ('Score on training Set')
     y_pred = RF_clf.predict(X_train)
@@ -239,19 +384,13 @@ if __name__ == '__main__':
 
     ################# Model trained on MLP ##################
     print ('Results of training MLP:')
-    scaler = StandardScaler() 
-    scaler.fit(X_train) 
-    X_scaled = scaler.transform(X_train)
-    MLP_clf = MLPClassifier(hidden_layer_sizes=(100, 100), random_state=1, max_iter=1000)
-    MLP_clf.fit(X_scaled, y_train)
+    MLP_clf = models['MLP']
 
     #***************** Feature importances study of the forest *****************#
-    # Build a forest and compute the feature importances
+    # Feature importances of the forest trained above
     # forest = ExtraTreesClassifier(n_estimators=n_estimators,
     #                               random_state=0)
-    forest = RandomForestClassifier(n_estimators=n_estimators,
-                                  random_state=0)
-    forest.fit(X_train, y_train)
+    forest = RF_clf
     importances = forest.feature_importances_
     std = np.std([tree.feature_importances_ for tree in forest.estimators_],
                  axis=0)
@@ -301,7 +440,7 @@ if __name__ == '__main__':
     X_scaled = scaler.transform(X)
 
     # Range of classifiers experimented with
-    RF_clf = RandomForestClassifier(n_estimators=n_estimators)
+    RF_clf = RandomForestClassifier(n_estimators=n_estimators, random_state=0, n_jobs=-1)
     XG_clf = XGBClassifier(n_estimators=n_estimators)
     MLP_clf = MLPClassifier(hidden_layer_sizes=(100, 100), random_state=1, max_iter=1000)
     LR_clf = LogisticRegression()
@@ -333,12 +472,16 @@ if __name__ == '__main__':
         # plt.show()
         plt.savefig(save_dir+'/confusion_matrix_Manual_{}'.format(label))
     #********************* Evaluate Ensemble classifier model on Validation Set******************************# 
-    EN_clf = E_clf.fit(X_scaled, y)
+    final_models = fit_cached({'Ensemble': (E_clf, X_scaled, y), 'RF_scaled': (RF_clf, X_scaled, y)},
+                              model_dir, retrain=args.retrain)
+    EN_clf = final_models['Ensemble']
     # TODO: If preferred Naive Bayes over Ensemble 
     # EN_clf = GNB_clf.fit(X_scaled, y)
     # EN_clf = MLP_clf.fit(X_scaled, y)
     # EN_clf = SVM_clf.fit(X_scaled, y)
-    RF_clf = RF_clf.fit(X_scaled, y)
+    RF_clf = final_models['RF_scaled']
+    save_scaler(scaler, features, model_dir)
+    print ('Persisted models in', model_dir, '- predict new test sets with --model_dir')
     ##################### Results on Final Test data ########################### 
     # No Group/label is available in final test dataset 
     ModelTester(EN_clf, testing_data, name='EnsembleOnFinalTestSet', scaler=scaler, save_dir=save_dir, label_available=False,
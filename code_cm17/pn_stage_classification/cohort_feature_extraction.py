@@ -0,0 +1,140 @@
+import os, sys
+import argparse
+import logging
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from feature_extraction import extract_features, image_open, heatmap_feature_names
+from helpers.probs_map_store import load_probs_map
+from helpers.sparse_heatmap import BlockSparseHeatmap
+from helpers.feature_io import save_features
+from helpers.feature_store import FeatureStore
+
+
+# python3 cohort_feature_extraction.py /media/mak/Data/Projects/Camelyon17/predictions/NCRF_CM17/training/resnet18_crf_inhouse_768_3_3/LEVEL_6_STRIDE_1/npy /media/mak/mirlproject1/CAMELYON17/training/dataset/TissueMask_Level_5 ../predictions/CM17_TrainWSI_Features_NCRF_CM16.npz --stage_labels=/media/mak/mirlproject1/CAMELYON17/training/groundtruth/stage_labels.csv
+
+parser = argparse.ArgumentParser(description='Extract the pN-stage heatmap features of a'
+                                 ' cohort of slides with a pool of worker processes')
+parser.add_argument('heat_maps_path', default=None, metavar='HEAT_MAPS_PATH', type=str,
+                    help='Directory of the heatmaps (.npy, block-sparse .npz or chunked stores)')
+parser.add_argument('tissue_maps_path', default=None, metavar='TISSUE_MAPS_PATH', type=str,
+                    help='Directory of the tissue masks <patient_node_name>.npy')
+parser.add_argument('out_path', default=None, metavar='OUT_PATH', type=str,
+                    help='Output feature file, .npz, .parquet, .feather or .csv')
+parser.add_argument('--stage_labels', default=None, type=str, help='csv with the patient'
+                    ' and stage columns, the stage is "unknown" without it')
+parser.add_argument('--tissue_cache', default=None, type=str, help='Directory caching the'
+                    ' opened tissue masks, default <tissue_maps_path>/image_open')
+parser.add_argument('--num_workers', default=4, type=int, help='number of worker processes,'
+                    ' default 4')
+parser.add_argument('--feature_store', default=None, type=str, help='json feature store, only the'
+                    ' slides whose heatmap, tissue mask or parameters changed are recomputed')
+
+# Parameters the features depend on, a change invalidates the feature store
+FEATURE_PARAMS = {'extractor': 'extract_features', 'thresholds': [0.90, 0.50], 'tissue': 'image_open'}
+
+
+def load_heatmap(path):
+    """
+    Heatmap of a slide, numpy files are memory-mapped instead of read
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if path.endswith('.npz'):
+        return BlockSparseHeatmap.load(path)
+    return load_probs_map(path)
+
+
+def load_tissue_open(tissue_map_path, cache_dir):
+    """
+    image_open of a tissue mask, cached as <cache_dir>/<name>.npy and
+    recomputed when the tissue mask is newer than the cache
+    """
+    cache_path = os.path.join(cache_dir, os.path.basename(tissue_map_path))
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(tissue_map_path):
+        return np.load(cache_path, mmap_mode='r')
+    tissue_open = image_open(np.load(tissue_map_path, mmap_mode='r'))
+    # write then rename, so concurrent workers never read a partial file
+    tmp_path = cache_path + '.{}.tmp.npy'.format(os.getpid())
+    np.save(tmp_path, tissue_open)
+    os.rename(tmp_path, cache_path)
+    return tissue_open
+
+
+def process_slide(task):
+    patient_node_name, heat_map_path, tissue_map_path, cache_dir = task
+    start = time.time()
+    features = extract_features(load_heatmap(heat_map_path), load_tissue_open(tissue_map_path, cache_dir))
+    logging.info('{}, {}, Run Time : {:.2f}'.format(time.strftime("%Y-%m-%d %H:%M:%S"),
+                                                     patient_node_name, time.time() - start))
+    return patient_node_name, features
+
+
+def get_tasks(args, cache_dir):
+    tasks = []
+    for heat_map_file in sorted(os.listdir(args.heat_maps_path)):
+        patient_node_name = heat_map_file.split('.')[0]
+        tissue_map_path = os.path.join(args.tissue_maps_path, patient_node_name + '.npy')
+        if not os.path.exists(tissue_map_path):
+            logging.warning('No tissue mask for {}, skipped'.format(heat_map_file))
+            continue
+        tasks.append((patient_node_name, os.path.join(args.heat_maps_path, heat_map_file),
+                      tissue_map_path, cache_dir))
+    return tasks
+
+
+def run(args):
+    logging.basicConfig(level=logging.INFO)
+    cache_dir = args.tissue_cache or os.path.join(args.tissue_maps_path, 'image_open')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    stage_map = {}
+    if args.stage_labels is not None:
+        df_labels = pd.read_csv(args.stage_labels)
+        stage_map = dict(zip(df_labels['patient'], df_labels['stage']))
+
+    tasks = get_tasks(args, cache_dir)
+    store = None
+    if args.feature_store is not None:
+        store = FeatureStore(args.feature_store, FEATURE_PARAMS)
+        stale = set(store.stale([(task[0], {'heatmap': task[1], 'tissue_map': task[2]}) for task in tasks]))
+        logging.info('{}/{} slides to (re)compute'.format(len(stale), len(tasks)))
+        todo = [task for task in tasks if task[0] in stale]
+    else:
+        todo = tasks
+
+    start = time.time()
+    pool = Pool(args.num_workers)
+    results = pool.map(process_slide, todo, chunksize=1)
+    pool.close()
+    pool.join()
+
+    patient_names = [task[0] for task in tasks]
+    stages = [stage_map.get(name + '.tif', 'unknown') for name in patient_names]
+    if store is not None:
+        inputs = dict((task[0], {'heatmap': task[1], 'tissue_map': task[2]}) for task in todo)
+        for name, feature in results:
+            store.update(name, inputs[name], feature)
+        for name, stage in zip(patient_names, stages):
+            store.set_stage(name, stage)
+        store.save()
+        store.export(args.out_path, heatmap_feature_names[1:-1], names=patient_names)
+    else:
+        features = np.array([feature for _, feature in results], dtype=np.float64).reshape(len(results), -1)
+        save_features(args.out_path, patient_names, features, stages, heatmap_feature_names[1:-1])
+    logging.info('{} slides computed in {:.2f}s, {} saved to {}'.format(len(results), time.time() - start,
+                                                                      len(patient_names), args.out_path))
+
+
+def main():
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,19 @@
 import os, sys
 import numpy as np
-import pandas as pd
 import csv
 
 import glob
 import random
 import cv2
 from openslide import OpenSlide, OpenSlideUnsupportedFormatError
-import scipy.stats.stats as st
 from skimage.measure import label
 from skimage.measure import regionprops
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
-from helpers.utils import *
+from helpers.mask_utils import *
+from helpers.probs_map_store import load_probs_map
+from helpers.sparse_heatmap import BlockSparseHeatmap, load_sparse_heatmap
+from helpers.region_features import threshold_tables
 
 N_FEATURES = 31
 MAX, MEAN, VARIANCE, SKEWNESS, KURTOSIS = 0, 1, 2, 3, 4
@@ -70,6 +71,19 @@ def get_region_props(heatmap_threshold_2d, heatmap_prob_2d):
     return regionprops(labeled_img, intensity_image=heatmap_prob_2d)
 
 
+def get_sparse_region_props(heatmap_sparse, threshold, strict=False):
+    """
+    regionprops of a BlockSparseHeatmap thresholded at >= threshold (> if strict),
+    labelled over the occupied blocks only and measured on the window holding the regions
+    """
+    labels, n_regions = heatmap_sparse.label(threshold, strict=strict)
+    if n_regions == 0:
+        return []
+    x_min, x_max, y_min, y_max = labels.bounding_box()
+    return regionprops(labels.crop(x_min, x_max, y_min, y_max),
+                       intensity_image=heatmap_sparse.crop(x_min, x_max, y_min, y_max))
+
+
 def draw_bbox(heatmap_threshold, region_props, threshold_label='t90'):
     n_regions = len(region_props)
     print('No of regions(%s): %d' % (threshold_label, n_regions))
@@ -135,14 +149,32 @@ def get_tumor_region_to_bbox_ratio(region_props):
 
 
 def get_feature(region_props, n_region, feature_name):
+    # scipy.stats takes over a second to import, only loaded when a feature is computed
+    from scipy import stats
     feature = [0] * 5
     if n_region > 0:
         feature_values = [region[feature_name] for region in region_props]
         feature[MAX] = format_2f(np.max(feature_values))
         feature[MEAN] = format_2f(np.mean(feature_values))
         feature[VARIANCE] = format_2f(np.var(feature_values))
-        feature[SKEWNESS] = format_2f(st.skew(np.array(feature_values)))
-        feature[KURTOSIS] = format_2f(st.kurtosis(np.array(feature_values)))
+        feature[SKEWNESS] = format_2f(stats.skew(np.array(feature_values)))
+        feature[KURTOSIS] = format_2f(stats.kurtosis(np.array(feature_values)))
+
+    return feature
+
+
+def get_feature_from_values(feature_values):
+    """
+    get_feature on a column of a region table
+    """
+    from scipy import stats
+    feature = [0] * 5
+    if len(feature_values) > 0:
+        feature[MAX] = format_2f(np.max(feature_values))
+        feature[MEAN] = format_2f(np.mean(feature_values))
+        feature[VARIANCE] = format_2f(np.var(feature_values))
+        feature[SKEWNESS] = format_2f(stats.skew(feature_values))
+        feature[KURTOSIS] = format_2f(stats.kurtosis(feature_values))
 
     return feature
 
@@ -154,6 +186,38 @@ def get_average_prediction_across_tumor_regions(region_props):
 
 
 def extract_features(heatmap_prob, image_open):
+    """
+    Same 31 features as extract_features_regionprops, computed from one
+    labelling pass per threshold on uint8 masks and vectorized region tables.
+    :param heatmap_prob: dense heatmap or BlockSparseHeatmap
+    :param image_open: tissue mask
+    :return:
+    """
+    if isinstance(heatmap_prob, BlockSparseHeatmap):
+        heatmap_prob = heatmap_prob.crop(*heatmap_prob.bounding_box())
+    table_t90, table_t50 = threshold_tables(heatmap_prob, high=0.90, low=0.50)
+
+    f_count_tumor_region = len(table_t90['label'])
+    if f_count_tumor_region == 0:
+        return [0.00] * N_FEATURES
+
+    largest_t50 = int(np.argmax(table_t50['area']))
+    features = [format_2f(f_count_tumor_region),
+                format_2f(table_t90['area'].sum() / np.count_nonzero(image_open)),
+                format_2f(table_t50['area'][largest_t50]),
+                format_2f(max(table_t50['major_axis_length'][largest_t50],
+                              table_t50['minor_axis_length'][largest_t50])),
+                format_2f(table_t90['area'].sum()),
+                format_2f(np.mean(table_t90['mean_intensity']))]
+    features += get_feature_from_values(table_t90['area'])
+    features += get_feature_from_values(table_t90['perimeter'])
+    features += get_feature_from_values(table_t90['eccentricity'])
+    features += get_feature_from_values(table_t50['extent'])
+    features += get_feature_from_values(table_t90['solidity'])
+    return features
+
+
+def extract_features_regionprops(heatmap_prob, image_open):
     """
         Feature list:
         -> (01) given t = 0.90, total number of tumor regions
@@ -167,10 +231,15 @@ def extract_features(heatmap_prob, image_open):
         -> (17-21) given t = 0.90, max, mean, variance, skewness, and kurtosis of  'compactness(eccentricity[?])'
         -> (22-26) given t = 0.50, max, mean, variance, skewness, and kurtosis of  'rectangularity(extent)'
         -> (27-31) given t = 0.90, max, mean, variance, skewness, and kurtosis of 'solidity'
-    :param heatmap_prob:
+    :param heatmap_prob: dense heatmap or BlockSparseHeatmap
     :param image_open:
     :return:
     """
+    if isinstance(heatmap_prob, BlockSparseHeatmap):
+        region_props_t90 = get_sparse_region_props(heatmap_prob, 0.90)
+        region_props_t50 = get_sparse_region_props(heatmap_prob, 0.50, strict=True)
+        pixels_count_prob_gt_90 = heatmap_prob.count_above(0.90)
+        return extract_region_features(region_props_t90, region_props_t50, pixels_count_prob_gt_90, image_open)
 
     heatmap_threshold_t90 = np.array(heatmap_prob)
     heatmap_threshold_t50 = np.array(heatmap_prob)
@@ -188,7 +257,11 @@ def extract_features(heatmap_prob, image_open):
 
     region_props_t90 = get_region_props(np.array(heatmap_threshold_t90_2d), heatmap_prob_2d)
     region_props_t50 = get_region_props(np.array(heatmap_threshold_t50_2d), heatmap_prob_2d)
+    pixels_count_prob_gt_90 = cv2.countNonZero(heatmap_threshold_t90_2d)
+    return extract_region_features(region_props_t90, region_props_t50, pixels_count_prob_gt_90, image_open)
+
 
+def extract_region_features(region_props_t90, region_props_t50, pixels_count_prob_gt_90, image_open):
     features = []
 
     f_count_tumor_region = len(region_props_t90)
@@ -209,7 +282,7 @@ def extract_features(heatmap_prob, image_open):
                                                                                        largest_tumor_region_index_t50)
     features.append(format_2f(f_longest_axis_largest_tumor_region_t50))
 
-    f_pixels_count_prob_gt_90 = cv2.countNonZero(heatmap_threshold_t90_2d)
+    f_pixels_count_prob_gt_90 = pixels_count_prob_gt_90
     features.append(format_2f(f_pixels_count_prob_gt_90))
 
     f_avg_prediction_across_tumor_regions = get_average_prediction_across_tumor_regions(region_props_t90)
@@ -247,6 +320,8 @@ def extract_features(heatmap_prob, image_open):
 
 
 if __name__ == '__main__':
+    import pandas as pd
+
     TRAIN = False
     # MODEL_NAME = 'DFCN_121_UNET' 
     MODEL_NAME = 'NCRF_CM16' 
@@ -269,8 +344,8 @@ if __name__ == '__main__':
             patient_node_name = heat_map_file.split('.')[0]
             patient_stage = df_labels['stage'][df_labels.patient[df_labels.patient == patient_node_name+'.tif'].index].tolist()
 
-            heat_map = np.load(os.path.join(heat_maps_path, heat_map_file))
-            tissue_map = np.load(os.path.join(tissue_map_level_5_path, heat_map_file))
+            heat_map = load_sparse_heatmap(os.path.join(heat_maps_path, heat_map_file))
+            tissue_map = np.load(os.path.join(tissue_map_level_5_path, patient_node_name + '.npy'))
             tissue_map = image_open(tissue_map)
             # imshow(heat_map.T, tissue_map.T)
             features = [patient_node_name]
@@ -294,8 +369,8 @@ if __name__ == '__main__':
             patient_node_name = heat_map_file.split('.')[0]
             patient_stage = 'Unknow'
 
-            heat_map = np.load(os.path.join(heat_maps_path, heat_map_file))
-            tissue_map = np.load(os.path.join(tissue_map_level_5_path, heat_map_file))
+            heat_map = load_sparse_heatmap(os.path.join(heat_maps_path, heat_map_file))
+            tissue_map = np.load(os.path.join(tissue_map_level_5_path, patient_node_name + '.npy'))
             tissue_map = image_open(tissue_map)
             # imshow(heat_map.T, tissue_map.T)
             features = [patient_node_name]
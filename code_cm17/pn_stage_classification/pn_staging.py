@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 # DFCN
@@ -29,6 +30,89 @@ def get_patient_stage(node_stages):
 
     return pn_stage
 
+
+STAGES = [NEGATIVE, ITC, MICRO, MACRO]
+NUMBER_NODES = 5
+
+
+def complete_nodes(node_df, patient_col='patient', stage_col='stage', number_nodes=NUMBER_NODES):
+    """
+    One row per patient and node 0..number_nodes-1, sorted by patient and node.
+    Nodes without a prediction are filled as negative.
+    Args
+    ----
+    node_df -- DataFrame of node predictions, patient_col holds names such as
+               'patient_100_node_0' (an extension is ignored)
+    Returns
+    -------
+    DataFrame with the patient, node and stage columns
+    """
+    names = node_df[patient_col].astype(str)
+    parsed = names.str.extract(r'^(.*)_node_(\d+)')
+    parsed[0] = parsed[0].fillna(names.str[0:11])
+    nodes = pd.DataFrame({'patient': parsed[0].values,
+                          'node': pd.to_numeric(parsed[1], errors='coerce').fillna(-1).astype(int).values,
+                          'stage': node_df[stage_col].values})
+    nodes = nodes[(nodes['node'] >= 0) & (nodes['node'] < number_nodes)].drop_duplicates(['patient', 'node'])
+    index = pd.MultiIndex.from_product([sorted(nodes['patient'].unique()), range(number_nodes)],
+                                       names=['patient', 'node'])
+    nodes = nodes.set_index(['patient', 'node']).reindex(index)
+    nodes['stage'] = nodes['stage'].fillna(NEGATIVE)
+    return nodes.reset_index()
+
+
+def get_patient_stages(node_df, patient_col='patient', stage_col='stage', number_nodes=NUMBER_NODES):
+    """
+    get_patient_stage of all patients at once, from the counts of the node stages
+    Returns
+    -------
+    (patient DataFrame with the stage counts and the pN stage, completed node DataFrame)
+    """
+    nodes = complete_nodes(node_df, patient_col, stage_col, number_nodes)
+    codes = pd.Categorical(nodes['stage'], categories=STAGES).codes
+    if (codes < 0).any():
+        bad = nodes[codes < 0]
+        raise ValueError('Unknown node stages (expected one of {}): {}'.format(
+            STAGES, ', '.join('{}_node_{}={!r}'.format(*row) for row in
+                              zip(bad['patient'], bad['node'], bad['stage']))))
+    patients = nodes['patient'].values[::number_nodes]
+    # complete_nodes gives number_nodes consecutive rows per patient
+    counts = np.zeros((len(patients), len(STAGES)), dtype=np.int64)
+    np.add.at(counts, (np.arange(len(codes)) // number_nodes, codes), 1)
+    negative, micro, macro = counts[:, 0], counts[:, 2], counts[:, 3]
+    pn_stage = np.select([negative == number_nodes,
+                          (micro == 0) & (macro == 0),
+                          (micro >= 1) & (micro <= 3) & (macro != 0)],
+                         ['pN0', 'pN0(i+)', 'pN1'], default='pN2')
+    patient_df = pd.DataFrame(counts, columns=STAGES)
+    patient_df.insert(0, 'patient', patients)
+    patient_df['pn_stage'] = pn_stage
+    return patient_df, nodes
+
+
+def format_submission(patient_df, nodes, number_nodes=NUMBER_NODES):
+    """
+    Lines of the submission file: header, then each patient followed by its nodes
+    """
+    node_lines = (nodes['patient'] + '_node_' + nodes['node'].astype(str) + ',' + nodes['stage']).values
+    node_lines = node_lines.reshape(len(patient_df), number_nodes)
+    lines = ['patient,stage']
+    for patient, pn_stage, patient_nodes in zip(patient_df['patient'], patient_df['pn_stage'], node_lines):
+        lines.append(patient + '.zip,' + pn_stage)
+        lines.extend(patient_nodes)
+    return lines
+
+
+def write_submission(path, node_df, patient_col='patient', stage_col='stage', number_nodes=NUMBER_NODES):
+    """
+    Stage all the patients of node_df and write the submission file in one go
+    """
+    patient_df, nodes = get_patient_stages(node_df, patient_col, stage_col, number_nodes)
+    with open(path, 'w') as f:
+        f.write('\n'.join(format_submission(patient_df, nodes, number_nodes)) + '\n')
+    return patient_df
+
+
 if __name__ == '__main__':
     # Submission_file_name = 'Submit_RF_DFCN_UNET'
     # Submission_file_name = 'Submit_EN_DFCN_UNET'
@@ -36,23 +120,9 @@ if __name__ == '__main__':
     Submission_file_name = 'Submit_RF_NCRF'
     # Submission_file_name = 'Submit_EN_NCRF'
 
-    f = open('../predictions/Report_20190802_113031/{}.csv'.format(Submission_file_name), 'a')
-    f.write("patient" + "," + "stage" + "\n")
     df = pd.read_csv(raw_prediction_path_RF)
-    number_nodes = 5
-    node_stages = []
-    for index, row in df.iterrows():
-        print (index, row['patient'], row['stage'])
-        node_stages.append(row['stage']) 
-        if (index+1) % number_nodes == 0:
-            patient_name = row['patient'][0:11]
-            # print (patient_name, node_stages)
-            pn_stage = get_patient_stage(node_stages)
-            f.write(patient_name + ".zip" + "," + pn_stage + "\n")
-            for i in range(number_nodes):
-                f.write(patient_name + "_node_"+str(i)+ "," + node_stages[i] + "\n")
-            node_stages = []
-    f.close()
+    patient_df = write_submission('../predictions/Report_20190802_113031/{}.csv'.format(Submission_file_name), df)
+    print (patient_df['pn_stage'].value_counts())
 
 
 
@@ -10,7 +10,6 @@ import PIL
 import cv2
 import matplotlib.pyplot as plt
 from scipy import ndimage
-from torch.utils.data import DataLoader
 import math
 import json
 import logging
@@ -27,8 +26,11 @@ import tensorflow as tf
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 from helpers.utils import *
-from data.automine_data_loader import WSIStridedPatchDataset
+from patch_extraction.automine_data_loader import WSIStridedPatchDataset
+from dataloader.shared_batches import SharedBatchLoader
+from inference.sinks import HardMineSink, run_inference
 from models.seg_models import *
+from models.registry import load_model
 np.random.seed(0)
 
 
@@ -50,6 +52,9 @@ parser.add_argument('--label_path', default=None, metavar='LABEL_PATH', type=str
                     help='Path to the Ground-Truth label image')
 parser.add_argument('--GPU', default='0,1', type=str, help='which GPU to use'
                     ', default 0')
+parser.add_argument('--model_cache', default=None, type=str, help='directory of the'
+                    ' fast-loading model artifacts, default $CM17_MODEL_CACHE or'
+                    ' ~/.cache/cm17/models')
 parser.add_argument('--num_workers', default=8, type=int, help='number of '
                     'workers to use to make batch, default 5')
 parser.add_argument('--level', default=5, type=int, help='heatmap generation level,'
@@ -60,68 +65,12 @@ parser.add_argument('--roi_masking', default=True, type=int, help='Sample pixels
                     ' default True, points are not sampled from glass region')
 
 
-def dice(im1, im2, empty_score=1.0):
-    """
-    Computes the Dice coefficient, a measure of set similarity.
-    Parameters
-    ----------
-    im1 : array-like, bool
-        Any array of arbitrary size. If not boolean, will be converted.
-    im2 : array-like, bool
-        Any other array of identical size. If not boolean, will be converted.
-    Returns
-    -------
-    dice : float
-        Dice coefficient as a float on range [0,1].
-        Maximum similarity = 1
-        No similarity = 0
-        Both are empty (sum eq to zero) = empty_score
-        
-    Notes
-    -----
-    The order of inputs for `dice` is irrelevant. The result will be
-    identical if `im1` and `im2` are switched.
-    """
-    im1 = np.asarray(im1).astype(np.bool)
-    im2 = np.asarray(im2).astype(np.bool)
-
-    if im1.shape != im2.shape:
-        raise ValueError("Shape mismatch: im1 and im2 must have the same shape.")
-
-    im_sum = im1.sum() + im2.sum()
-    if im_sum == 0:
-        return empty_score
-
-    # Compute Dice coefficient
-    intersection = np.logical_and(im1, im2)
-
-    return 2. * intersection.sum() / im_sum
-
-
-
 def get_probs_map(model, dataloader):
     """
-    Generate probability map
+    Mine the patches whose Dice against the label is below DICE_THRESHOLD,
+    rows of (wsi name, level 0 x, y, dice, tumor fraction)
     """
-    probs_map = np.zeros(dataloader.dataset._mask.shape)
-    count_map = np.zeros(dataloader.dataset._mask.shape)
-    num_batch = len(dataloader)
-    batch_size = dataloader.batch_size
-    map_x_size = dataloader.dataset._mask.shape[0]
-    map_y_size = dataloader.dataset._mask.shape[1]
-    level = dataloader.dataset._level
-    factor = dataloader.dataset._sampling_stride
-    flip = dataloader.dataset._flip
-    rotate = dataloader.dataset._rotate
-    wsi_name = os.path.basename(dataloader.dataset._wsi_path)   
-    down_scale = 1.0 / pow(2, level)
-
-    count = 0
-    time_now = time.time()
-    probs_map = []
-
     DICE_THRESHOLD = 0.90
-    # label_mask is not utilized     
     print ('Started Mining')
     try:
         model = multi_gpu_model(model, gpus=2, cpu_merge=False)
@@ -129,47 +78,20 @@ def get_probs_map(model, dataloader):
     except:
         print("Inference on single GPU or CPU..")
 
-    for (image_patches, x_coords, y_coords, label_patches) in dataloader:
-
-        image_patches = image_patches.cpu().data.numpy()
-        label_patches = label_patches.cpu().data.numpy()
-        x_coords = x_coords.cpu().data.numpy()*pow(2,level)
-        y_coords = y_coords.cpu().data.numpy()*pow(2,level)
-
-        y_preds = model.predict(image_patches, batch_size=batch_size, verbose=0, steps=None)
-
-        for i in range(batch_size):
-            y_pred_mask = labelthreshold(y_preds[i][:,:,1],  threshold=0.45)
-            y_true_mask = label_patches[i]
-            dice_score = dice(y_pred_mask, y_true_mask)
-            if dice_score < DICE_THRESHOLD:
-                # print (wsi_name, str(x_coords[i]), str(y_coords[i]), str(dice_score))
-                probs_map.append((wsi_name, str(x_coords[i]), str(y_coords[i]), str(dice_score)))
-                # imshow(normalize_minmax(image_patches[i]), y_pred_mask, y_true_mask)
-        count += 1
-        time_spent = time.time() - time_now
-        time_now = time.time()
-        print ('{}, flip : {}, rotate : {}, batch : {}/{}, Run Time : {:.2f}'
-            .format(
-                time.strftime("%Y-%m-%d %H:%M:%S"), dataloader.dataset._flip,
-                dataloader.dataset._rotate, count, num_batch, time_spent))
-
-        # logging.info(
-        #     '{}, flip : {}, rotate : {}, batch : {}/{}, Run Time : {:.2f}'
-        #     .format(
-        #         time.strftime("%Y-%m-%d %H:%M:%S"), dataloader.dataset._flip,
-        #         dataloader.dataset._rotate, count, num_batch, time_spent))
-    # imshow(count_map)
-    return probs_map
+    miner = HardMineSink(threshold=0.45, max_score=DICE_THRESHOLD, score='dice',
+                         scale=pow(2, dataloader.dataset._level))
+    mined = run_inference(model, dataloader, [miner])[0]['mined']
+    wsi_name = os.path.basename(dataloader.dataset._wsi_path)
+    return [(wsi_name, str(x), str(y), str(dice_score), str(fraction)) for _, x, y, dice_score, fraction in mined]
 
 def make_dataloader(args, cfg, flip='NONE', rotate='NONE'):
     batch_size = cfg['batch_size']
-    dataloader = DataLoader(WSIStridedPatchDataset(args.wsi_path, args.mask_path,
-                            args.label_path,
-                            image_size=cfg['image_size'],
-                            normalize=True, flip=flip, rotate=rotate,
-                            level=args.level, sampling_stride=args.sampling_stride, roi_masking=args.roi_masking),
-                            batch_size=batch_size, num_workers=args.num_workers, drop_last=True)
+    dataloader = SharedBatchLoader(WSIStridedPatchDataset(args.wsi_path, args.mask_path,
+                                   args.label_path,
+                                   image_size=cfg['image_size'],
+                                   normalize=True, flip=flip, rotate=rotate,
+                                   level=args.level, sampling_stride=args.sampling_stride, roi_masking=args.roi_masking),
+                                   batch_size=batch_size, num_workers=args.num_workers, drop_last=True)
     return dataloader
 
 def run(args):
@@ -190,9 +112,7 @@ def run(args):
     # Otherwise they may end up hosted on a GPU, which would
     # complicate weight sharing.
     # with tf.device('/cpu:0'):
-    model = unet_densenet121((None, None), weights=None)
-    
-    model.load_weights(args.model_path)
+    model = load_model('unet_densenet121', args.model_path, cache_dir=args.model_cache)
     print ("Loaded Model Weights")
 
     save_dir = os.path.dirname(args.out_csv_path)
@@ -26,8 +26,6 @@ from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import ModelCheckpoint, LearningRateScheduler, TensorBoard
 from tensorflow.keras import metrics
 
-from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms  # noqa
 
 import sklearn.metrics
 import io
@@ -41,7 +39,10 @@ from skimage.filters import threshold_otsu
 
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.getcwd())))
-from models.seg_models import unet_densenet121, get_inception_resnet_v2_unet_softmax
+from models.registry import load_model
+from dataloader.shared_batches import SharedBatchLoader
+from inference.sinks import HardMineSink, run_inference
+from helpers.io_utils import MinedPointsWriter
 # Random Seeds
 np.random.seed(0)
 random.seed(0)
@@ -297,7 +298,7 @@ def get_tumor_fraction(mask_image):
 
 
 # DataLoader Implementation
-class WSIStridedPatchDataset(Dataset):
+class WSIStridedPatchDataset(object):
     """
     Data producer that generate all the square grids, e.g. 3x3, of patches,
     from a WSI and its tissue mask, and their corresponding indices with
@@ -498,7 +499,6 @@ class WSIStridedPatchDataset(Dataset):
 
 
 #Model
-model = get_inception_resnet_v2_unet_softmax((None, None), weights=None)
 #model_path = glob.glob('../../results/saved_models/dense_80k/fold2/model.06*')[0]
 model_root_path = '../../results/saved_models/incep_viable_200k/'
 model_path = glob.glob(os.path.join(model_root_path,'5fold_0/model.10*'))[0]
@@ -508,7 +508,7 @@ core_config.gpu_options.allow_growth = False
 session =tf.Session(config=core_config) 
 K.set_session(session)
 
-model.load_weights(model_path)
+model = load_model('inception_resnet_v2_unet', model_path)
 print ("Loaded Model Weights")
 
 
@@ -533,14 +533,16 @@ except FileExistsError:
         input()
 
         
+# the lines are appended to the files in bulk, once per slide
+mined_points_writer = MinedPointsWriter(mined_points_path)
+
 def save_mined_points(x,y,tf):
     if tf > 0.0:
         coord_type = 'normal'
     else:
         coord_type = 'tumor'
         
-    with open(os.path.join(mined_points_path,'%s.txt' % coord_type),'a') as f:
-        f.write('%s,%s,%d,%d,%f\n'%(wsi_path,label_path,x,y,tf))
+    mined_points_writer.add(coord_type, '%s,%s,%d,%d,%f\n'%(wsi_path,label_path,x,y,tf))
         
 #Get train ids from cv split file containing path to wsi images
 sample_ids = [ x.split('/')[-2] for x in list(pd.read_csv('../../data/raw-data/cross_val_splits_%d_whole/training_fold_%d.csv'%(kfold_k,fold))['Image_Path'])]
@@ -558,55 +560,22 @@ for i,sample_id in enumerate(sample_ids):
                                         flip=None, rotate=None,
                                         level=2, sampling_stride=sampling_stride//16, roi_masking=True)
     
-    meta_dict= {'num': 0, 'den': 0, 'jaccs':[]}
-
-    dataloader = DataLoader(dataset_obj, batch_size=batch_size, num_workers=0, drop_last=True)
+    dataloader = SharedBatchLoader(dataset_obj, batch_size=batch_size, num_workers=0, drop_last=True)
     dataset_obj.save_scaled_imgs()
     imsave(dataset_obj.get_mask(), dataset_obj.get_strided_mask(), dataset_obj._label_scld, dataset_obj._slide_scld, out=os.path.join(mined_points_path, sample_id+'.png'))
     
     print("Total iterations: %d and %d" % (dataloader.__len__(),dataloader.dataset.__len__()))
-    for i,(data, x, y, label) in enumerate(dataloader):
-        #print(i,x,y)
-        image_patches = data.cpu().data.numpy()
-        patch_mask = TissueMaskGenerationPatch(image_patches[0]*128+128)
-        label_patches = label.cpu().data.numpy()
-        
-        pred_map = model.predict(image_patches,verbose=0,batch_size=1)
-        for j in range(batch_size):
-            jacc_score = calc_jacc_score(labelthreshold(pred_map[j,:,:,1],threshold=0.45),label_patches[j])
-            meta_dict['jaccs'].append(jacc_score)
-            meta_dict['num']+=int(np.sum(labelthreshold(pred_map[j,:,:,1],threshold=0.45)*label_patches[j].clip(max=1)))
-            meta_dict['den']+=int(np.sum(np.logical_or(labelthreshold(pred_map[j,:,:,1],threshold=0.45),label_patches[j])))
-            
-            if jacc_score < mining_threshold:
-                #top-left
-                tf = get_tumor_fraction(label_patches[j,:im_by2,:im_by2])
-                point_x = int(x[j]) + im_by4
-                point_y = int(y[j]) + im_by4
-                save_mined_points(point_x,point_y,tf)
-                    
-                #top-right
-                tf = get_tumor_fraction(label_patches[j,:im_by2,im_by2:image_size])
-                point_y += im_by4
-                save_mined_points(point_x,point_y,tf)
-                    
-                #bottom-right
-                tf = get_tumor_fraction(label_patches[j,im_by2:image_size,im_by2:image_size])
-                point_x += im_by4
-                save_mined_points(point_x,point_y,tf)
-                    
-                #bottom-left
-                tf = get_tumor_fraction(label_patches[j,im_by2:image_size,:im_by2])
-                point_y -= im_by4
-                save_mined_points(point_x,point_y,tf)
-                
-            #print("Jaccard: %.3f" %(jacc_score))
-            #imshow(pred_map[j,:,:,1],label_patches[j],np.uint8(image_patches[j]*128+128))
-            #imshow(pred_map[j,:,:,1],labelthreshold(pred_map[j,:,:,1],0.45),label_patches[j])
-                                                                         
-        if (i)%100==0:
-            print("Completed %i Time elapsed %.2f min"%(i,(time.time()-start_time)/60))
-            print(meta_dict['num'],meta_dict['den'])
+    # patch scores and the mined quadrant centres of the slide in one inference pass
+    # the points are the true centres of the quadrants their tumor fractions come from,
+    # (x + q, y + q) to (x + 3q, y + 3q) with q = image_size / 4
+    miner = HardMineSink(threshold=0.45, max_score=mining_threshold, score='jaccard', quadrants=True)
+    scores = run_inference(model, dataloader, [miner])[0]
+    for _, point_x, point_y, _, fraction in scores['mined']:
+        save_mined_points(point_x,point_y,fraction)
+    mined_points_writer.flush()
+    meta_dict = {'num': scores['num'], 'den': scores['den'], 'jaccs': scores['jaccard'].tolist()}
+    print("Completed Time elapsed %.2f min"%((time.time()-start_time)/60))
+    print(meta_dict['num'],meta_dict['den'])
     meta_dict['jaccs_index'] = meta_dict['num']/meta_dict['den']
     meta_dict['histogram'] = str(np.histogram(meta_dict['jaccs'], bins=11))
     with open(os.path.join(mined_points_path, sample_id+'.json'),'w') as f:
@@ -1,15 +1,19 @@
 import numpy as np 
 import os, sys
 import pandas as pd
-import openslide
 import csv
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
-from helpers.utils import *
+from helpers.mask_utils import *
+from helpers.sparse_heatmap import load_sparse_heatmap
+from helpers.label_pyramid import LabelPyramid
 
 PATCH_SIZE = 768
 THRESHOLD = 0.4
 LEVEL = 5
+# level of the label summed-area table, a 768 patch is 24 pixels at level 5
+LABEL_LEVEL = 5
+MAX_TUMOR_FRACTION = 0.05
 
 if __name__ == '__main__':
 
@@ -31,29 +35,22 @@ if __name__ == '__main__':
                 label_path = None
             print (patient_name)
             file_path = os.path.join(heatmaps_path, patient_name+'.npy')
-            hmap = np.load(file_path)
-            coords = np.where(hmap >= THRESHOLD)
-            for j in range(len(coords[0])):
-                x_coord = pow(2, LEVEL)*coords[0][j]
-                y_coord = pow(2, LEVEL)*coords[1][j]
-                # print (x_coord, y_coord)
-                # img_obj = openslide.OpenSlide(image_path)
-                # img = img_obj.read_region((x_coord - PATCH_SIZE//2, y_coord - PATCH_SIZE//2),
-                # 0,
-                # (PATCH_SIZE, PATCH_SIZE)).convert('RGB')
-
-                if label_path is not None:
-                    label_obj = openslide.OpenSlide(label_path)
-                    label_img = label_obj.read_region((x_coord - PATCH_SIZE//2, y_coord - PATCH_SIZE//2),
-                    0,
-                    (PATCH_SIZE, PATCH_SIZE)).convert('L')
-                else:
-                    label_img = np.zeros((PATCH_SIZE, PATCH_SIZE))
-
-                tumor_fraction = np.count_nonzero(label_img)/ np.prod(np.array(label_img).shape)
-                if tumor_fraction < 0.05:
-                    # imshow(img, label_img, title = ['Image', str(tumor_fraction)+ str()])
-                    probs_map.append((patient_name, str(x_coord), str(y_coord), str(tumor_fraction)))
+            if not os.path.exists(file_path):
+                # chunked probability map store
+                file_path = os.path.join(heatmaps_path, patient_name)
+            hmap = load_sparse_heatmap(file_path)
+            coords = hmap.threshold_coords(THRESHOLD)
+            x_coords = pow(2, LEVEL)*np.asarray(coords[0], dtype=np.int64)
+            y_coords = pow(2, LEVEL)*np.asarray(coords[1], dtype=np.int64)
+            # the label is read once per slide, the tumor fractions of all
+            # the candidate patches are table lookups
+            if label_path is not None:
+                tumor_fractions = LabelPyramid.from_slide(label_path, LABEL_LEVEL).tumor_fraction(
+                    x_coords, y_coords, PATCH_SIZE)
+            else:
+                tumor_fractions = np.zeros(len(x_coords))
+            for j in np.flatnonzero(tumor_fractions < MAX_TUMOR_FRACTION):
+                probs_map.append((patient_name, str(x_coords[j]), str(y_coords[j]), str(tumor_fractions[j])))
 
             with open(csv_path, 'w') as out:
                 csv_out = csv.writer(out)
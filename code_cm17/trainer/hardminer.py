@@ -26,8 +26,6 @@ from tensorflow.keras import backend as K
 # from tensorflow.keras.callbacks import ModelCheckpoint, LearningRateScheduler, TensorBoard
 # from tensorflow.keras import metrics
 
-from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms  # noqa
 
 import sklearn.metrics
 import io
@@ -41,7 +39,11 @@ from skimage.filters import threshold_otsu
 
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.getcwd())))
-from models.seg_models import unet_densenet121, get_inception_resnet_v2_unet_softmax
+from models.registry import load_model
+from dataloader.shared_batches import SharedBatchLoader
+from inference.sinks import HardMineSink, run_inference
+from helpers.mask_utils import patch_tissue_mask
+from helpers.io_utils import MinedPointsWriter
 # Random Seeds
 np.random.seed(0)
 random.seed(0)
@@ -292,7 +294,7 @@ def get_tumor_fraction(mask_image):
 
 
 # DataLoader Implementation
-class WSIStridedPatchDataset(Dataset):
+class WSIStridedPatchDataset(object):
     """
     Data producer that generate all the square grids, e.g. 3x3, of patches,
     from a WSI and its tissue mask, and their corresponding indices with
@@ -508,7 +510,6 @@ sampling_stride = image_size #At the 0 level
 
 #Model
 os.environ["CUDA_VISIBLE_DEVICES"] = '1'
-model = get_inception_resnet_v2_unet_softmax((None, None), weights=None)
 model_root_path = '../../results/saved_models/%s/' % (experiment_id)
 fold_path = os.path.join(model_root_path,'%dfold_%d'%(kfold_k,fold))
 model_path = glob.glob(os.path.join(fold_path,'sel-model.*.h5'))[0]
@@ -520,7 +521,7 @@ core_config.gpu_options.allow_growth = False
 core_config.gpu_options.per_process_gpu_memory_fraction=0.46
 session =tf.Session(config=core_config) 
 K.set_session(session)
-model.load_weights(model_path)
+model = load_model('inception_resnet_v2_unet', model_path)
 print ("Loaded Model Weights")
 print("Hardmining with model stored in %s"% model_path)
 
@@ -540,14 +541,16 @@ except FileExistsError:
         input()
 
         
+# the lines are appended to the files in bulk, once per slide
+mined_points_writer = MinedPointsWriter(mined_points_path)
+
 def save_mined_points(x,y,tf,jacc_score):
     if tf > 0.0:
         coord_type = 'tumor'
     else:
         coord_type = 'normal'
         
-    with open(os.path.join(mined_points_path,'%s.txt' % coord_type),'a') as f:
-        f.write('%s,%s,%d,%d,%f,%f\n'%(wsi_path,label_path,x,y,tf,jacc_score*100))
+    mined_points_writer.add(coord_type, '%s,%s,%d,%d,%f,%f\n'%(wsi_path,label_path,x,y,tf,jacc_score*100))
         
 #Get train ids from cv split file containing path to wsi images
 sample_ids = [ x.split('/')[-2] for x in list(pd.read_csv('../../data/raw-data/cross_val_splits_%d_whole/%s_fold_%d.csv'%(kfold_k,mode,fold))['Image_Path'])]
@@ -567,44 +570,21 @@ for i,sample_id in enumerate(sample_ids):
                                         flip=None, rotate=None,
                                         level=2, sampling_stride=sampling_stride//16, roi_masking=True)
     
-    meta_dict= {'num': 0, 'den': 0, 'jaccs':[]}
-
-    dataloader = DataLoader(dataset_obj, batch_size=batch_size, num_workers=0, drop_last=True)
+    dataloader = SharedBatchLoader(dataset_obj, batch_size=batch_size, num_workers=0, drop_last=True)
     dataset_obj.save_scaled_imgs()
     imsave(dataset_obj.get_mask(), dataset_obj.get_strided_mask(), dataset_obj._label_scld, dataset_obj._slide_scld, out=os.path.join(mined_points_path, sample_id+'.png'))
     
     print("Total iterations: %d and %d" % (dataloader.__len__(),dataloader.dataset.__len__()))
-    for i,(data, x, y, label) in enumerate(dataloader):
-        #print(i,x,y)
-        image_patches = data.cpu().data.numpy()
-        patch_mask = TissueMaskGenerationPatch(image_patches[0]*128+128)
-        label_patches = label.cpu().data.numpy()
-        
-        pred_map = model.predict(image_patches,verbose=0,batch_size=batch_size)
-        for j in range(batch_size):
-            wsi_img = image_patches[j]*128+128
-            patch_mask = TissueMaskGenerationPatch(wsi_img)
-            prediction = labelthreshold(pred_map[j,:,:,1],threshold=0.5)*patch_mask
-
-            jacc_score = calc_jacc_score(prediction,label_patches[j])
-            meta_dict['jaccs'].append(jacc_score)
-            meta_dict['num']+=int(np.sum(prediction*label_patches[j].clip(max=1)))
-            meta_dict['den']+=int(np.sum(np.logical_or(prediction,label_patches[j])))
-            
-            if jacc_score < mining_threshold:
-                tf = get_tumor_fraction(label_patches[j])
-                point_x = int(x[j]) + image_size//2
-                point_y = int(y[j]) + image_size//2
-                save_mined_points(point_x,point_y,tf,jacc_score)
-                
-            #print("Jaccard: %.3f" %(jacc_score))
-#             imshow(pred_map[j,:,:,1],label_patches[j],np.uint8(image_patches[j]*128+128))
-            #imshow(pred_map[j,:,:,1],labelthreshold(pred_map[j,:,:,1],0.45),label_patches[j])
-                                                                         
-        if (i)%100==0:
-            print("Completed %i Time elapsed %.2f min"%(i,(time.time()-start_time)/60))
-            print(meta_dict['num'],meta_dict['den'])
-    print("Fully completed %i Time elapsed %.2f min"%(i,(time.time()-start_time)/60))
+    # patch scores and mined points of the slide in one inference pass, the
+    # predictions are masked with the tissue of the patch
+    miner = HardMineSink(threshold=0.5, max_score=mining_threshold, score='jaccard',
+                         offset=image_size//2, patch_mask=patch_tissue_mask)
+    scores = run_inference(model, dataloader, [miner])[0]
+    for _, point_x, point_y, jacc_score, fraction in scores['mined']:
+        save_mined_points(point_x,point_y,fraction,jacc_score)
+    mined_points_writer.flush()
+    meta_dict = {'num': scores['num'], 'den': scores['den'], 'jaccs': scores['jaccard'].tolist()}
+    print("Fully completed Time elapsed %.2f min"%((time.time()-start_time)/60))
     print(meta_dict['num'],meta_dict['den'])
     meta_dict['jaccs_index'] = meta_dict['num']/meta_dict['den']
     print(meta_dict['jaccs_index'])
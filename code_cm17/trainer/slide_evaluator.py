@@ -0,0 +1,227 @@
+import os
+import sys
+import csv
+import time
+import logging
+import argparse
+
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
+from helpers.metrics import batch_dice
+from helpers.probs_map_store import ProbsMapStore, is_probs_map_store
+
+parser = argparse.ArgumentParser(description='Slide level Dice, Jaccard and precision/recall'
+                                 ' curves of stitched probability maps against the label masks,'
+                                 ' streamed tile by tile for many thresholds at once')
+parser.add_argument('cohort_csv', default=None, metavar='COHORT_CSV', type=str,
+                    help='csv with the Image_Path and Mask_Path of every slide'
+                    ' (Mask_Path empty for normal slides)')
+parser.add_argument('heatmaps_path', default=None, metavar='HEATMAPS_PATH', type=str,
+                    help='Directory of the probability maps, <slide>.npy or <slide> chunked store')
+parser.add_argument('out_dir', default=None, metavar='OUT_DIR', type=str,
+                    help='Directory of the per slide and cohort curves (csv)')
+parser.add_argument('--level', default=5, type=int, help='WSI level of the .npy maps, default 5')
+parser.add_argument('--store_level', default=0, type=int, help='pyramid level to read when'
+                    ' the map is a chunked store, default 0')
+parser.add_argument('--tile_size', default=1024, type=int, help='Side of the square tiles'
+                    ' streamed from the map and the label, in map pixels, default 1024')
+parser.add_argument('--n_bins', default=100, type=int, help='Probability bins, the thresholds'
+                    ' are k / n_bins, default 100')
+
+CURVE_FIELDS = ('threshold', 'tp', 'fp', 'fn', 'dice', 'jaccard', 'precision', 'recall')
+
+
+class ConfusionHistogram(object):
+    """
+    TP/FP/FN counts of every threshold k / n_bins, accumulated as two
+    histograms of the binned probabilities (tumor and non-tumor pixels):
+    a pixel is predicted positive at threshold k / n_bins if its bin is >= k,
+    so the counts of all the thresholds are reverse cumulative sums.
+    """
+    def __init__(self, n_bins=100):
+        self.n_bins = n_bins
+        self.positive = np.zeros(n_bins, dtype=np.int64)
+        self.negative = np.zeros(n_bins, dtype=np.int64)
+
+    @property
+    def thresholds(self):
+        return np.arange(self.n_bins) / float(self.n_bins)
+
+    def add(self, probs, labels):
+        """
+        Count a tile, probabilities in [0, 1] and labels (non-zero is tumor) of the same shape
+        """
+        # bin k holds [k / n_bins, (k + 1) / n_bins), compared with the thresholds
+        # themselves so p >= k / n_bins exactly when the bin is >= k
+        bins = np.clip(np.searchsorted(self.thresholds, np.asarray(probs).ravel(), side='right') - 1,
+                       0, self.n_bins - 1)
+        labels = np.asarray(labels).ravel() != 0
+        self.positive += np.bincount(bins[labels], minlength=self.n_bins)
+        self.negative += np.bincount(bins[~labels], minlength=self.n_bins)
+
+    def merge(self, other):
+        self.positive += other.positive
+        self.negative += other.negative
+
+    def counts(self):
+        """
+        (tp, fp, fn), [n_bins] arrays, one entry per threshold
+        """
+        tp = np.cumsum(self.positive[::-1])[::-1]
+        fp = np.cumsum(self.negative[::-1])[::-1]
+        return tp, fp, self.positive.sum() - tp
+
+    def curves(self):
+        """
+        Dict of [n_bins] arrays: threshold, tp, fp, fn, dice, jaccard,
+        precision and recall (1 where undefined, e.g. no tumor and no prediction)
+        """
+        tp, fp, fn = self.counts()
+        union = tp + fp + fn
+        return {'threshold': self.thresholds, 'tp': tp, 'fp': fp, 'fn': fn,
+                'dice': batch_dice(tp, tp + fp, tp + fn),
+                'jaccard': np.where(union == 0, 1.0, tp / np.maximum(union, 1)),
+                'precision': np.where(tp + fp == 0, 1.0, tp / np.maximum(tp + fp, 1)),
+                'recall': np.where(tp + fn == 0, 1.0, tp / np.maximum(tp + fn, 1))}
+
+
+class MapTiles(object):
+    """
+    Tiles of a probability map, a .npy file (memory mapped) or a chunked
+    store (only the chunks of the tile are read)
+    """
+    def __init__(self, path, level=5, store_level=0):
+        if is_probs_map_store(path):
+            self._store = ProbsMapStore(path)
+            self._store_level = store_level
+            self.shape = self._store.shape(store_level)
+            self.resolution = self._store.scale(store_level)
+        else:
+            self._store = None
+            self._map = np.load(path, mmap_mode='r')
+            self.shape = self._map.shape
+            self.resolution = pow(2, level)
+
+    def read(self, x0, x1, y0, y1):
+        if self._store is not None:
+            return self._store.read(self._store_level, (x0, x1), (y0, y1))
+        return np.asarray(self._map[x0:x1, y0:y1], dtype=np.float32)
+
+
+class LabelTiles(object):
+    """
+    Tiles of a label tif at the resolution of a map (level 0 pixels per map
+    pixel), indexed [x, y]: read at the closest finer level of the pyramid
+    and subsampled if the map resolution is not one of its levels
+    """
+    def __init__(self, label_path, resolution):
+        import openslide
+        self._slide = openslide.OpenSlide(label_path)
+        self.resolution = resolution
+        downsamples = np.asarray(self._slide.level_downsamples)
+        finer = np.flatnonzero(downsamples <= resolution + 1e-3)
+        self._level = int(finer[np.argmax(downsamples[finer])]) if len(finer) else 0
+        self._factor = max(int(round(resolution / downsamples[self._level])), 1)
+
+    def read(self, x0, x1, y0, y1):
+        factor = self._factor
+        region = self._slide.read_region((int(x0 * self.resolution), int(y0 * self.resolution)), self._level,
+                                         ((x1 - x0) * factor, (y1 - y0) * factor)).convert('L')
+        return np.array(region).T[::factor, ::factor]
+
+    def close(self):
+        self._slide.close()
+
+
+def evaluate_slide(map_path, label_path, level=5, store_level=0, tile_size=1024, n_bins=100):
+    """
+    ConfusionHistogram of a slide, the map and the label streamed tile by
+    tile (label_path None for a slide without tumor)
+    """
+    tiles = MapTiles(map_path, level, store_level)
+    labels = None if label_path is None else LabelTiles(label_path, tiles.resolution)
+    histogram = ConfusionHistogram(n_bins)
+    X, Y = tiles.shape
+    for x0 in range(0, X, tile_size):
+        for y0 in range(0, Y, tile_size):
+            x1, y1 = min(x0 + tile_size, X), min(y0 + tile_size, Y)
+            probs = tiles.read(x0, x1, y0, y1)
+            if labels is None:
+                label = np.zeros(probs.shape, dtype=np.uint8)
+            else:
+                label = labels.read(x0, x1, y0, y1)
+            histogram.add(probs, label)
+    if labels is not None:
+        labels.close()
+    return histogram
+
+
+def write_curves(path, curves):
+    with open(path, 'w') as f:
+        out = csv.writer(f)
+        out.writerow(CURVE_FIELDS)
+        for row in zip(*[curves[field] for field in CURVE_FIELDS]):
+            out.writerow(row)
+
+
+def best_threshold(curves, metric='dice'):
+    k = int(np.argmax(curves[metric]))
+    return curves['threshold'][k], curves[metric][k]
+
+
+def map_path_of(heatmaps_path, slide_name):
+    path = os.path.join(heatmaps_path, slide_name + '.npy')
+    if not os.path.exists(path):
+        # chunked probability map store
+        path = os.path.join(heatmaps_path, slide_name)
+    return path
+
+
+def run(args):
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    cohort = ConfusionHistogram(args.n_bins)
+    # the threshold closest to 0.5 (exactly 0.5 for an even n_bins)
+    half = int(np.argmin(np.abs(cohort.thresholds - 0.5)))
+    slide_dices = []
+    with open(args.cohort_csv) as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        slide_name = os.path.basename(row['Image_Path']).split('.')[0]
+        label_path = row.get('Mask_Path') or None
+        if label_path == 'empty':
+            label_path = None
+        start = time.time()
+        histogram = evaluate_slide(map_path_of(args.heatmaps_path, slide_name), label_path, args.level,
+                                   args.store_level, args.tile_size, args.n_bins)
+        curves = histogram.curves()
+        write_curves(os.path.join(args.out_dir, slide_name + '.csv'), curves)
+        cohort.merge(histogram)
+        slide_dices.append(curves['dice'])
+        threshold, dice = best_threshold(curves)
+        logging.info('{}: best dice {:.4f} at {:.2f}, jaccard at {:.2f} {:.4f}, {:.2f}s'.format(
+            slide_name, dice, threshold, curves['threshold'][half], curves['jaccard'][half], time.time() - start))
+
+    # pooled counts of all the slides, and the mean of the slide Dice
+    curves = cohort.curves()
+    curves['mean_slide_dice'] = np.mean(slide_dices, axis=0) if slide_dices else np.ones(args.n_bins)
+    write_curves(os.path.join(args.out_dir, 'cohort.csv'), curves)
+    with open(os.path.join(args.out_dir, 'cohort_mean_slide_dice.csv'), 'w') as f:
+        out = csv.writer(f)
+        out.writerow(('threshold', 'mean_slide_dice'))
+        for row in zip(curves['threshold'], curves['mean_slide_dice']):
+            out.writerow(row)
+    threshold, dice = best_threshold(curves)
+    mean_threshold, mean_dice = best_threshold(curves, 'mean_slide_dice')
+    logging.info('Cohort ({} slides): best pooled dice {:.4f} at {:.2f}, best mean slide dice {:.4f} at {:.2f}'
+                 .format(len(rows), dice, threshold, mean_dice, mean_threshold))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
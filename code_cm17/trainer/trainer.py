@@ -21,7 +21,7 @@ random.seed(0)
 tf.compat.v1.set_random_seed(0)
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
-from dataloader.training_data_loader import DataGeneratorCoordFly
+from dataloader.training_data_loader import DataGeneratorCoordFly, HardMiningCallback
 from helpers.utils import *
 from models.seg_models import unet_densenet121, get_inception_resnet_v2_unet_softmax
 from models.deeplabv3p_original import Deeplabv3
@@ -54,14 +54,17 @@ def train(args, train_tumor_coord_path, train_normal_coord_path, valid_tumor_coo
                           'shuffle': True,
                           'level': 0,
                           'samples_per_epoch': None,
-                          'transform': augmentation
+                          'transform': augmentation,
+                          'hard_mining': args.hard_mining,
+                          'mining_alpha': args.mining_alpha,
+                          'balance_slides': args.balance_slides
                          }
 
     valid_transform_params = {'image_size': (256, 256),
                           'batch_size': args.valid_bz,
                           'n_classes': 2,
                           'n_channels': 3,
-                          'shuffle': True,
+                          'shuffle': False,
                           'level': 0,
                           'samples_per_epoch': None,                        
                           'transform': None
@@ -70,6 +73,10 @@ def train(args, train_tumor_coord_path, train_normal_coord_path, valid_tumor_coo
     training_generator = DataGeneratorCoordFly(train_tumor_coord_path, train_normal_coord_path, **train_transform_params)
     validation_generator = DataGeneratorCoordFly(valid_tumor_coord_path, valid_normal_coord_path, **valid_transform_params)
     print ("No. of training and validation batches are:", training_generator.__len__(), validation_generator.__len__())
+    # Online hard example mining: the priorities of the training coordinates follow their loss
+    mining_callbacks = []
+    if args.hard_mining:
+        mining_callbacks.append(HardMiningCallback(training_generator, every=args.mining_every))
 
     # Model Configuration
     logdir_path = os.path.join(model_path, 'tb_logs')
@@ -95,7 +102,7 @@ def train(args, train_tumor_coord_path, train_normal_coord_path, valid_tumor_coo
             model.fit_generator(generator=training_generator,
                                     epochs=n_Epochs, verbose=1,
                                     validation_data=validation_generator,
-                                    callbacks=[lrSchedule, tbCallback, model_checkpoint],
+                                    callbacks=[lrSchedule, tbCallback, model_checkpoint] + mining_callbacks,
                                     use_multiprocessing=True,
                                     workers=6,
                                     initial_epoch=0)
@@ -118,7 +125,7 @@ def train(args, train_tumor_coord_path, train_normal_coord_path, valid_tumor_coo
             model.fit_generator(generator=training_generator,
                                     epochs=2, verbose=1,
                                     validation_data=validation_generator,
-                                    callbacks=[lrSchedule, tbCallback, model_checkpoint],
+                                    callbacks=[lrSchedule, tbCallback, model_checkpoint] + mining_callbacks,
                                     use_multiprocessing=True,
                                     workers=6,
                                     initial_epoch=0)
@@ -134,7 +141,7 @@ def train(args, train_tumor_coord_path, train_normal_coord_path, valid_tumor_coo
             model.fit_generator(generator=training_generator,
                                     epochs=n_Epochs, verbose=1,
                                     validation_data=validation_generator,
-                                    callbacks=[lrSchedule, tbCallback, model_checkpoint],
+                                    callbacks=[lrSchedule, tbCallback, model_checkpoint] + mining_callbacks,
                                     use_multiprocessing=True,
                                     workers=6,
                                     initial_epoch=2)
@@ -166,7 +173,7 @@ def train(args, train_tumor_coord_path, train_normal_coord_path, valid_tumor_coo
         model.fit_generator(generator=training_generator,
                                 epochs=n_Epochs, verbose=1,
                                 validation_data=validation_generator,
-                                callbacks=[lrSchedule, tbCallback, model_checkpoint],
+                                callbacks=[lrSchedule, tbCallback, model_checkpoint] + mining_callbacks,
                                 use_multiprocessing=True,
                                 workers=6,
                                 initial_epoch=initial_epoch)
@@ -184,6 +191,11 @@ if __name__ == '__main__':
     parser.add_argument('--valid_bz', default='32', type=int, help='batch size for inferencing (validation set at the end of every epoch)')
     parser.add_argument('--override', action='store_true', help='Whether to override the directory if the directory already exists')
     parser.add_argument('-r','--resume', action='store_true', help='Resume training if previous training was found')
+    parser.add_argument('--hard_mining', action='store_true', help='Online hard example mining: draw the training patches in proportion to their loss')
+    parser.add_argument('--mining_alpha', default=1.0, type=float, help='Priority exponent of the online hard mining, 0 is uniform')
+    parser.add_argument('--mining_every', default=20, type=int, help='Training batches between two online hard mining scoring batches,'
+                        ' each reads one more batch of patches, default 20 (5%% more slide I/O)')
+    parser.add_argument('--balance_slides', action='store_true', help='Draw the training centres and slides equally often instead of in proportion to their patches')
 
     args = parser.parse_args()
 